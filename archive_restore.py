@@ -0,0 +1,193 @@
+import dataclasses
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import tracing
+from database import Database
+
+RESTORE_JOBS = 4
+
+# Descriptions made of several words, as printed by pg_restore -l
+_MULTI_WORD_DESCS = sorted([
+    "ACCESS METHOD", "DEFAULT ACL", "EVENT TRIGGER", "FK CONSTRAINT", "FOREIGN DATA WRAPPER",
+    "FOREIGN SERVER", "FOREIGN TABLE", "INDEX ATTACH", "LARGE OBJECT", "MATERIALIZED VIEW",
+    "MATERIALIZED VIEW DATA", "OPERATOR CLASS", "OPERATOR FAMILY", "PUBLICATION TABLE",
+    "PUBLICATION TABLES IN SCHEMA", "ROW SECURITY", "SEQUENCE OWNED BY", "SEQUENCE SET",
+    "TABLE ATTACH", "TABLE DATA", "TEXT SEARCH CONFIGURATION",
+    "TEXT SEARCH DICTIONARY", "TEXT SEARCH PARSER", "TEXT SEARCH TEMPLATE", "USER MAPPING",
+], key=len, reverse=True)
+
+# Primary keys and replica identity indexes, with the constraint they belong to if any
+PRIMARY_KEYS_QUERY = """
+    SELECT n.nspname, c.relname, i.relname, con.conname
+    FROM pg_index x
+    JOIN pg_class c ON c.oid = x.indrelid
+    JOIN pg_class i ON i.oid = x.indexrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    LEFT JOIN pg_constraint con ON con.conindid = x.indexrelid AND con.conrelid = x.indrelid
+        AND con.contype IN ('p', 'u', 'x')
+    WHERE x.indisprimary OR x.indisreplident
+"""
+
+
+@dataclasses.dataclass
+class TocEntry:
+    line: str
+    dump_id: int
+    desc: str
+    schema: str
+    tag: str
+
+
+def parse_toc_line(line):
+    """
+    Parse one entry of a pg_restore -l listing, None for comments.
+
+    >>> parse_toc_line("3262; 2606 16390 CONSTRAINT included table_to_replicate table_to_replicate_pkey foo")
+    TocEntry(line='3262; 2606 16390 CONSTRAINT included table_to_replicate table_to_replicate_pkey foo', dump_id=3262, desc='CONSTRAINT', schema='included', tag='table_to_replicate table_to_replicate_pkey foo')
+    >>> parse_toc_line(";     Dumped from database version 17.2") is None
+    True
+    """
+    line = line.rstrip("\n")
+    if not line.strip() or line.startswith(";"):
+        return None
+    dump_id, _, rest = line.partition(";")
+    # Skip catalog table oid and object oid
+    rest = rest.split(None, 2)[2]
+    desc = next((candidate for candidate in _MULTI_WORD_DESCS if rest.startswith(candidate + " ")),
+                rest.split(" ", 1)[0])
+    schema, _, tag = rest[len(desc) + 1:].partition(" ")
+    return TocEntry(line, int(dump_id), desc, schema, tag)
+
+
+def is_primary_key(entry: TocEntry, primary_keys):
+    """
+    Whether the entry creates a primary key or a replica identity index.
+
+    pg_dump writes the REPLICA IDENTITY USING INDEX statement in the entry of
+    the index or constraint, it comes along with it.
+    """
+    if entry.desc == "INDEX":
+        # The tag is "<index> <owner>"
+        return (entry.schema, entry.tag.split(" ", 1)[0]) in primary_keys
+    if entry.desc != "CONSTRAINT":
+        return False
+    # The tag is "<table> <constraint> <owner>"
+    table, _, rest = entry.tag.partition(" ")
+    constraint = rest.split(" ", 1)[0]
+    return (entry.schema, table, constraint) in primary_keys
+
+
+class ArchiveRestore:
+    """
+    Restore engine working on a single pg_dump directory archive.
+
+    The schema is dumped once, the TOC of the archive is listed with
+    pg_restore -l and split into filtered lists, and every part is restored
+    with pg_restore -j --use-list.
+    """
+
+    def __init__(self, conn_sender_string, db_schemas, conn_receiver_string, jobs=RESTORE_JOBS, directory=None):
+        self.conn_sender_string = conn_sender_string
+        self.db_schemas = db_schemas
+        self.conn_receiver_string = conn_receiver_string
+        self.jobs = max(jobs, 1)
+        self.work_directory = directory
+        self._owns_directory = directory is None
+        self.archive = None
+
+    def dump(self):
+        if self.work_directory is None:
+            self.work_directory = tempfile.mkdtemp(prefix="pg_logical_replication_")
+        self.archive = os.path.join(self.work_directory, "schema")
+        command = [
+            "pg_dump",
+            "-d", self.conn_sender_string,
+            "-Fd",
+            "-f", self.archive,
+            "-T", "public.spatial_ref_sys",
+            "--schema-only",
+            "-N", "information_schema"
+        ]
+        for schema in self.db_schemas:
+            command.append("-n")
+            command.append(schema)
+
+        print(f" dump schema to archive {self.archive}")
+        print(" ".join(command))
+        with tracing.span("pg_dump archive", schemas=len(self.db_schemas)) as span:
+            result = subprocess.run(command)
+            span.set(returncode=result.returncode)
+        if result.returncode != 0:
+            print(f"Error pg_dump exited with code {result.returncode}", file=sys.stderr)
+            return False
+        return True
+
+    def toc(self, section):
+        if self.archive is None and not self.dump():
+            return []
+        command = ["pg_restore", "-l", f"--section={section}", self.archive]
+        listing = subprocess.run(command, stdout=subprocess.PIPE, text=True)
+        if listing.returncode != 0:
+            print(f"Error pg_restore -l exited with code {listing.returncode}", file=sys.stderr)
+            return []
+        return [entry for entry in map(parse_toc_line, listing.stdout.splitlines()) if entry is not None]
+
+    def primary_keys(self):
+        results = Database(self.conn_sender_string, None).execute_query(PRIMARY_KEYS_QUERY) or []
+        # Constraints are found by table and name in the TOC, indexes by name
+        return {(schema, table, constraint) if constraint is not None else (schema, index)
+                for schema, table, index, constraint in results}
+
+    def restore(self, name, entries, section):
+        if not entries:
+            print(f"pg_restore {name} : nothing to restore")
+            return True
+        list_file = os.path.join(self.work_directory, f"{name}.list")
+        with open(list_file, "w") as f:
+            f.writelines(f"{entry.line}\n" for entry in entries)
+
+        command = [
+            "pg_restore",
+            "-d", self.conn_receiver_string,
+            "-j", str(self.jobs),
+            "--no-owner",
+            "--no-acl",
+            f"--section={section}",
+            "--use-list", list_file,
+            self.archive
+        ]
+        print(f"pg_restore {name} begin ({len(entries)} entries)")
+        print(" ".join(command))
+        with tracing.span("pg_restore", step=name, section=section, entries=len(entries), jobs=self.jobs) as span:
+            result = subprocess.run(command)
+            span.set(returncode=result.returncode)
+        if result.returncode != 0:
+            print(f"Error pg_restore {name} exited with code {result.returncode}", file=sys.stderr)
+            return False
+        print(f"pg_restore {name} end")
+        return True
+
+    def restore_pre_data(self):
+        entries = [entry for entry in self.toc("pre-data")
+                   if not (entry.desc == "SCHEMA" and entry.tag.split(" ", 1)[0] == "public")]
+        return self.restore("pre-data", entries, "pre-data")
+
+    def restore_primary_keys(self):
+        primary_keys = self.primary_keys()
+        entries = [entry for entry in self.toc("post-data") if is_primary_key(entry, primary_keys)]
+        return self.restore("post-data-pk", entries, "post-data")
+
+    def restore_post_data_without_pk(self):
+        primary_keys = self.primary_keys()
+        entries = [entry for entry in self.toc("post-data") if not is_primary_key(entry, primary_keys)]
+        return self.restore("post-data-without-pk", entries, "post-data")
+
+    def close(self):
+        if self._owns_directory and self.work_directory is not None:
+            shutil.rmtree(self.work_directory, ignore_errors=True)
+            self.work_directory = None
+            self.archive = None
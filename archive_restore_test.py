@@ -0,0 +1,92 @@
+import subprocess
+
+from archive_restore import ArchiveRestore, is_primary_key, parse_toc_line
+
+TOC_POST_DATA = """;
+; Archive created at 2026-01-22 10:01:25 UTC
+;     dbname: foo_db
+;
+; Selected TOC Entries:
+;
+3262; 2606 16390 CONSTRAINT included table_to_replicate table_to_replicate_pkey foo
+3263; 2606 16400 CONSTRAINT included table_to_replicate table_to_replicate_name_key foo
+3264; 1259 16401 INDEX included idx_table_to_replicate_name foo
+3265; 2606 16402 FK CONSTRAINT included table_to_replicate2 table_to_replicate2_fk foo
+3266; 2606 16403 CONSTRAINT included table_to_replicate3 table_to_replicate3_code_key foo
+3267; 1259 16404 INDEX included idx_table_to_replicate4_code foo
+"""
+
+
+def completed(stdout=""):
+    return subprocess.CompletedProcess([], 0, stdout=stdout)
+
+
+def test_parse_toc_line_with_multi_word_desc():
+    entry = parse_toc_line("3265; 2606 16402 FK CONSTRAINT included table_to_replicate2 table_to_replicate2_fk foo")
+
+    assert entry.dump_id == 3265
+    assert entry.desc == "FK CONSTRAINT"
+    assert entry.schema == "included"
+    assert entry.tag == "table_to_replicate2 table_to_replicate2_fk foo"
+
+
+def test_is_primary_key_uses_catalog_names():
+    primary_keys = {("included", "table_to_replicate", "table_to_replicate_pkey")}
+    entries = [parse_toc_line(line) for line in TOC_POST_DATA.splitlines()]
+    entries = [entry for entry in entries if entry is not None]
+
+    assert [is_primary_key(entry, primary_keys) for entry in entries] == [True, False, False, False, False, False]
+
+
+def test_restore_primary_keys_then_the_rest(mocker, tmp_path):
+    run = mocker.patch("subprocess.run", side_effect=lambda command, **kwargs: completed(TOC_POST_DATA))
+    mocker.patch("archive_restore.Database.execute_query",
+                 return_value=[("included", "table_to_replicate", "table_to_replicate_pkey",
+                                "table_to_replicate_pkey")])
+    archive = ArchiveRestore("{primary}", ["included"], "{secondary}", jobs=3, directory=str(tmp_path))
+
+    assert archive.restore_primary_keys()
+    assert archive.restore_post_data_without_pk()
+
+    dump_command = run.call_args_list[0].args[0]
+    assert dump_command[:3] == ["pg_dump", "-d", "{primary}"]
+    assert "-Fd" in dump_command and "--schema-only" in dump_command
+    commands = [call.args[0] for call in run.call_args_list]
+    restore_commands = [command for command in commands if command[:2] == ["pg_restore", "-d"]]
+    assert len(restore_commands) == 2
+    assert restore_commands[0][restore_commands[0].index("-j") + 1] == "3"
+    assert (tmp_path / "post-data-pk.list").read_text().splitlines() == [
+        "3262; 2606 16390 CONSTRAINT included table_to_replicate table_to_replicate_pkey foo"]
+    assert len((tmp_path / "post-data-without-pk.list").read_text().splitlines()) == 5
+    assert [command[0] for command in commands].count("pg_dump") == 1
+
+
+def test_restore_primary_keys_with_replica_identities(mocker, tmp_path):
+    mocker.patch("subprocess.run", side_effect=lambda command, **kwargs: completed(TOC_POST_DATA))
+    # A unique constraint and a unique index used as replica identity
+    mocker.patch("archive_restore.Database.execute_query", return_value=[
+        ("included", "table_to_replicate", "table_to_replicate_pkey", "table_to_replicate_pkey"),
+        ("included", "table_to_replicate3", "table_to_replicate3_code_key", "table_to_replicate3_code_key"),
+        ("included", "table_to_replicate4", "idx_table_to_replicate4_code", None),
+    ])
+    archive = ArchiveRestore("{primary}", ["included"], "{secondary}", directory=str(tmp_path))
+
+    assert archive.restore_primary_keys()
+    assert archive.restore_post_data_without_pk()
+
+    assert (tmp_path / "post-data-pk.list").read_text().splitlines() == [
+        "3262; 2606 16390 CONSTRAINT included table_to_replicate table_to_replicate_pkey foo",
+        "3266; 2606 16403 CONSTRAINT included table_to_replicate3 table_to_replicate3_code_key foo",
+        "3267; 1259 16404 INDEX included idx_table_to_replicate4_code foo"]
+    assert [line.split(";")[0] for line in (tmp_path / "post-data-without-pk.list").read_text().splitlines()] == [
+        "3263", "3264", "3265"]
+
+
+def test_restore_pre_data_skips_public_schema(mocker, tmp_path):
+    toc = "10; 2615 2200 SCHEMA - public pg_database_owner\n11; 2615 16385 SCHEMA - included foo\n"
+    mocker.patch("subprocess.run", side_effect=lambda command, **kwargs: completed(toc))
+    archive = ArchiveRestore("{primary}", ["included"], "{secondary}", directory=str(tmp_path))
+
+    archive.restore_pre_data()
+
+    assert (tmp_path / "pre-data.list").read_text() == "11; 2615 16385 SCHEMA - included foo\n"
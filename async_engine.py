@@ -0,0 +1,344 @@
+import asyncio
+import contextlib
+import dataclasses
+import datetime
+import json
+import os
+import sys
+import time
+
+import psycopg
+from psycopg import conninfo
+from psycopg_pool import AsyncConnectionPool
+
+import post_data
+import sql_stream
+from connection_pool import POOL_SIZE, POOL_TIMEOUT_IN_SECONDS
+from primary import catalog_snapshot_query, db_infos_from_results, schema_excluded_string
+from progress import (MAX_INTERVAL_IN_SECONDS, MIN_INTERVAL_IN_SECONDS, PROGRESS_QUERY, SUBSCRIPTION_FILTER,
+                      next_interval)
+from publication import PUBLICATION_BATCH_SIZE, publication_queries
+from replication_start import (PRE_DATA_BATCH_SIZE, generate_password, is_restored_pre_data, post_data_command,
+                               pre_data_command)
+
+DUMPS_PER_PRIMARY = 2
+SYNCS_PER_TARGET = 4
+INDEX_BUILDS_PER_TARGET = 4
+
+
+class MigrationAborted(Exception):
+    pass
+
+
+@dataclasses.dataclass
+class EngineLimits:
+    # Concurrent pg_dump per primary server
+    dumps_per_primary: int = DUMPS_PER_PRIMARY
+    # Migrations in their initial copy per target server
+    syncs_per_target: int = SYNCS_PER_TARGET
+    # Post-data statements running at once per target server
+    index_builds_per_target: int = INDEX_BUILDS_PER_TARGET
+
+
+@dataclasses.dataclass
+class MigrationJob:
+    conn_primary: str
+    db_primary: str
+    conn_secondary: str
+    db_secondary: str
+    list_schema_excluded: list | None = None
+    # Connection string of the subscription, CONN_DB_PRIMARY_FULL by default
+    connection_primary_full: str | None = None
+
+
+@dataclasses.dataclass
+class JobResult:
+    job: MigrationJob
+    unique_name: str | None = None
+    error: str | None = None
+    duration: float = 0
+    phase_durations: dict = dataclasses.field(default_factory=dict)
+
+
+def server_key(conn_string):
+    """
+    Host and port of a connection string, the unit the limits apply to.
+
+    >>> server_key("host=pg1 port=5433 dbname=foo user=bar")
+    'pg1:5433'
+    >>> server_key("postgresql://foo@pg2/foo_db")
+    'pg2:5432'
+    """
+    params = conninfo.conninfo_to_dict(conn_string)
+    return f"{params.get('host') or 'localhost'}:{params.get('port') or 5432}"
+
+
+def dump_command(conn_string, db_schemas, section):
+    # The same dumps as replication_start
+    if section == "pre-data":
+        return pre_data_command(conn_string, db_schemas)
+    return post_data_command(conn_string, db_schemas)
+
+
+class AsyncMigrationEngine:
+    """
+    Drive many migrations at once on one event loop.
+
+    Each migration goes through the same steps as replication_start.main,
+    with non-blocking queries on AsyncConnectionPool pools (one per
+    connection string) and pg_dump run with asyncio.create_subprocess_exec.
+    Semaphores per server bound the dumps on each primary, the initial
+    copies and the post-data statements on each target.
+    """
+
+    def __init__(self, limits: EngineLimits = None, pool_size=POOL_SIZE,
+                 publication_batch_size=PUBLICATION_BATCH_SIZE, pre_data_batch_size=PRE_DATA_BATCH_SIZE,
+                 max_interval=MAX_INTERVAL_IN_SECONDS):
+        self.limits = limits or EngineLimits()
+        self.pool_size = pool_size
+        self.publication_batch_size = publication_batch_size
+        self.pre_data_batch_size = pre_data_batch_size
+        self.max_interval = max_interval
+        self._pools = {}
+        self._semaphores = {}
+        self._pools_lock = asyncio.Lock()
+
+    def semaphore(self, kind, conn_string):
+        key = (kind, server_key(conn_string))
+        if key not in self._semaphores:
+            self._semaphores[key] = asyncio.Semaphore(getattr(self.limits, kind))
+        return self._semaphores[key]
+
+    async def pool(self, conn_string) -> AsyncConnectionPool:
+        async with self._pools_lock:
+            if conn_string not in self._pools:
+                pool = AsyncConnectionPool(conn_string, min_size=1, max_size=self.pool_size,
+                                           timeout=POOL_TIMEOUT_IN_SECONDS, kwargs={"autocommit": True},
+                                           check=AsyncConnectionPool.check_connection, open=False)
+                await pool.open(wait=True, timeout=POOL_TIMEOUT_IN_SECONDS)
+                self._pools[conn_string] = pool
+            return self._pools[conn_string]
+
+    async def execute(self, conn_string, query, params=None, fetch=True):
+        pool = await self.pool(conn_string)
+        async with pool.connection() as conn:
+            try:
+                cursor = await conn.execute(query, params)
+                if fetch:
+                    return await cursor.fetchall()
+            except psycopg.Error as e:
+                print(f"Error {e} with query '{query}' on host '{conn_string}'", file=sys.stderr)
+                return None
+
+    async def close(self):
+        for pool in self._pools.values():
+            await pool.close()
+        self._pools = {}
+
+    async def dump_statements(self, conn_primary, db_schemas, section):
+        """Statements of one pg_dump section, read while pg_dump writes them."""
+        async with self.semaphore("dumps_per_primary", conn_primary):
+            command = dump_command(conn_primary, db_schemas, section)
+            print(" ".join(command))
+            process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE)
+            splitter = sql_stream.SqlStatementSplitter()
+            finished = False
+            try:
+                async for line in process.stdout:
+                    for statement in splitter.feed(line.decode()):
+                        # ignore "\restrict" and "\unrestrict" lines
+                        if not sql_stream.is_restrict_command(statement):
+                            yield statement
+                statement = splitter.flush()
+                if statement is not None and not sql_stream.is_restrict_command(statement):
+                    yield statement
+                finished = True
+            finally:
+                # Stopped by its reader, pg_dump would block on the unread pipe forever
+                if not finished and process.returncode is None:
+                    with contextlib.suppress(ProcessLookupError):
+                        process.kill()
+                if process.returncode is None:
+                    await process.wait()
+            # A failed pg_dump stops early, its statements are not the whole section
+            if process.returncode != 0:
+                raise MigrationAborted(f"pg_dump {section} exited with code {process.returncode}")
+
+    async def restore_pre_data(self, job, db_schemas):
+        async with await psycopg.AsyncConnection.connect(job.conn_secondary) as conn:
+            pending = 0
+            try:
+                async with contextlib.aclosing(self.dump_statements(job.conn_primary, db_schemas,
+                                                                    "pre-data")) as statements:
+                    async for statement in statements:
+                        if not is_restored_pre_data(statement):
+                            continue
+                        await conn.execute(statement)
+                        pending += 1
+                        if pending >= self.pre_data_batch_size:
+                            await conn.commit()
+                            pending = 0
+                await conn.commit()
+            except (psycopg.Error, MigrationAborted):
+                # The job fails, the next one would start on a partial schema
+                await conn.rollback()
+                raise
+
+    async def create_publication(self, job, publication_name, tables):
+        pool = await self.pool(job.conn_primary)
+        async with pool.connection() as conn:
+            created = False
+            for _, query, batch in publication_queries(publication_name, tables,
+                                                       batch_size=self.publication_batch_size):
+                try:
+                    await conn.execute(query)
+                except psycopg.Error as e:
+                    print(f"Error {e} with query '{query}' - adding its tables one by one", file=sys.stderr)
+                    if not created:
+                        await conn.execute(f"CREATE PUBLICATION {publication_name};")
+                    for schema, table in batch:
+                        try:
+                            await conn.execute(f"ALTER PUBLICATION {publication_name} ADD TABLE {schema}.{table};")
+                        except psycopg.Error as table_error:
+                            print(f"Table {schema}.{table} could not be added to publication {publication_name} : "
+                                  f"{table_error}", file=sys.stderr)
+                created = True
+
+    async def wait_for_initial_sync(self, conn_secondary, subscription_name):
+        interval = MIN_INTERVAL_IN_SECONDS
+        previous_ready = None
+        pool = await self.pool(conn_secondary)
+        async with pool.connection() as conn:
+            # Without subscription there is no table to wait for, and nothing was copied
+            cursor = await conn.execute("SELECT 1 FROM pg_subscription WHERE subname = %s", (subscription_name,))
+            if await cursor.fetchone() is None:
+                raise MigrationAborted(f"subscription {subscription_name} does not exist on the secondary")
+            while True:
+                cursor = await conn.execute(PROGRESS_QUERY + SUBSCRIPTION_FILTER, ([subscription_name],))
+                ready, total = await cursor.fetchone()
+                if ready >= total:
+                    print(f"The first step of logical replication is done for {subscription_name} : {ready}/{total}")
+                    return
+                progressed = previous_ready is not None and ready > previous_ready
+                interval = next_interval(interval, progressed, None, MIN_INTERVAL_IN_SECONDS, self.max_interval)
+                previous_ready = ready
+                await asyncio.sleep(interval)
+
+    async def run_post_data_units(self, conn_secondary, units):
+        settings = [unit.statement for unit in units if unit.kind == "setting"]
+        semaphore = self.semaphore("index_builds_per_target", conn_secondary)
+
+        async def run_group(group):
+            async with semaphore:
+                async with await psycopg.AsyncConnection.connect(conn_secondary, autocommit=True) as conn:
+                    for statement in settings:
+                        await conn.execute(statement)
+                    for unit in group:
+                        try:
+                            await conn.execute(unit.statement)
+                        except psycopg.Error as e:
+                            print(f"Error {e} with query '{unit.statement}' on host '{conn_secondary}'",
+                                  file=sys.stderr)
+
+        groups = {}
+        foreign_keys = []
+        others = []
+        for unit in units:
+            if unit.kind == "foreign_key":
+                foreign_keys.append(unit)
+            elif unit.kind != "setting" and unit.table is None:
+                others.append(unit)
+            elif unit.kind != "setting":
+                groups.setdefault(unit.table, []).append(unit)
+        # Foreign keys once every table is built, statements not bound to a table last
+        await asyncio.gather(*(run_group(group) for group in groups.values()))
+        await asyncio.gather(*(run_group([unit]) for unit in foreign_keys))
+        if others:
+            await run_group(others)
+
+    async def migrate(self, job: MigrationJob) -> JobResult:
+        result = JobResult(job)
+        start = time.monotonic()
+        phase_start = start
+
+        def phase_done(phase):
+            nonlocal phase_start
+            now = time.monotonic()
+            result.phase_durations[phase] = now - phase_start
+            phase_start = now
+
+        date_start = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        unique_name = f"{job.db_primary}_{date_start}"
+        result.unique_name = unique_name
+        connection_primary_full = job.connection_primary_full or os.environ.get('CONN_DB_PRIMARY_FULL')
+        try:
+            schema_excluded_str = schema_excluded_string(job.list_schema_excluded)
+            db_infos = db_infos_from_results(await self.execute(job.conn_primary,
+                                                                catalog_snapshot_query(schema_excluded_str)),
+                                             schema_excluded_str)
+            # pg_dump without -n would dump every schema
+            if not db_infos.db_schemas:
+                raise MigrationAborted(f"no schema read from the primary {job.db_primary}")
+            db_schemas = db_infos.db_schemas
+            print(f"{unique_name} : db_size {db_infos.db_size}, db_tables {db_infos.db_tables}")
+
+            results = await self.execute(job.conn_primary,
+                                         "SELECT count(rolname) FROM pg_roles WHERE rolname ='replication'")
+            if not results or results[0][0] == 0:
+                await self.execute(job.conn_primary,
+                                   f"CREATE USER replication LOGIN ENCRYPTED PASSWORD '{generate_password()}'; "
+                                   f"ALTER ROLE replication WITH REPLICATION", fetch=False)
+            for schema in db_schemas:
+                await self.execute(job.conn_primary, f"GRANT SELECT ON ALL TABLES IN SCHEMA {schema} TO replication; "
+                                                     f"GRANT USAGE ON SCHEMA {schema} TO replication", fetch=False)
+            phase_done("roles")
+
+            await self.restore_pre_data(job, db_schemas)
+            phase_done("pre_data")
+
+            # Post-data is dumped once: primary keys now, the rest after the initial copy
+            dump_post = post_data.PostData.parse([statement async for statement in
+                                                  self.dump_statements(job.conn_primary, db_schemas, "post-data")])
+            await self.run_post_data_units(job.conn_secondary, dump_post.primary_keys())
+            phase_done("primary_keys")
+
+            publication_name = f"publication_{unique_name}"
+            await self.create_publication(job, publication_name, db_infos.tables.publication_tables())
+            phase_done("publication")
+
+            subscription_name = f"subscription_{unique_name}"
+            async with self.semaphore("syncs_per_target", job.conn_secondary):
+                await self.execute(job.conn_secondary,
+                                   f"CREATE SUBSCRIPTION {subscription_name} CONNECTION '{connection_primary_full}' PUBLICATION {publication_name} with (copy_data=true, create_slot=true, enabled=true, slot_name='{subscription_name}');",
+                                   fetch=False)
+                await self.wait_for_initial_sync(job.conn_secondary, subscription_name)
+            phase_done("sync_wait")
+
+            await self.execute(job.conn_secondary, f"ALTER SUBSCRIPTION {subscription_name} DISABLE;", fetch=False)
+            await self.run_post_data_units(job.conn_secondary, dump_post.without_primary_keys())
+            await self.execute(job.conn_secondary, f"ALTER SUBSCRIPTION {subscription_name} ENABLE;", fetch=False)
+            phase_done("post_data")
+        except (psycopg.Error, OSError, MigrationAborted) as e:
+            print(f"Error {e} while migrating {job.db_primary} to {job.db_secondary}", file=sys.stderr)
+            result.error = str(e)
+        result.duration = time.monotonic() - start
+        return result
+
+    async def run(self, jobs) -> list:
+        try:
+            return await asyncio.gather(*(self.migrate(job) for job in jobs))
+        finally:
+            await self.close()
+
+
+def run_migrations(jobs, limits: EngineLimits = None, **engine_options) -> list:
+    return asyncio.run(AsyncMigrationEngine(limits, **engine_options).run(jobs))
+
+
+if __name__ == '__main__':
+    # A JSON list of jobs: [{"conn_primary": ..., "db_primary": ..., "conn_secondary": ..., "db_secondary": ...}]
+    with open(sys.argv[1]) as jobs_file:
+        jobs_list = [MigrationJob(**job) for job in json.load(jobs_file)]
+    for job_result in run_migrations(jobs_list):
+        status = "failed : " + job_result.error if job_result.error else "done"
+        print(f"{job_result.job.db_primary} -> {job_result.job.db_secondary} {status} in {job_result.duration:.1f}s")
@@ -0,0 +1,168 @@
+import asyncio
+
+import psycopg
+import pytest
+
+from async_engine import AsyncMigrationEngine, EngineLimits, MigrationAborted, MigrationJob
+from post_data import parse_units
+
+
+class FakeProcess:
+    def __init__(self, lines):
+        self.returncode = None
+        self.stdout = self._read(lines)
+
+    @staticmethod
+    async def _read(lines):
+        for line in lines:
+            yield line.encode()
+
+    def kill(self):
+        self.returncode = -9
+
+    async def wait(self):
+        self.returncode = 0
+        return 0
+
+
+class FailedProcess(FakeProcess):
+    async def wait(self):
+        self.returncode = 1
+        return 1
+
+
+class BlockedProcess(FakeProcess):
+    """pg_dump blocked writing to a pipe nobody reads anymore, until killed."""
+
+    def __init__(self, lines):
+        super().__init__(lines)
+        self.killed = asyncio.Event()
+        self.stdout = self._blocked(lines)
+
+    async def _blocked(self, lines):
+        for line in lines:
+            yield line.encode()
+        await self.killed.wait()
+
+    def kill(self):
+        self.killed.set()
+
+    async def wait(self):
+        await self.killed.wait()
+        self.returncode = -9
+        return -9
+
+
+def test_dump_statements_streams_pg_dump_output(mocker):
+    lines = ["\\restrict key\n", "SET a = 1;\n", "CREATE TABLE s.t (\n", "    a text DEFAULT ';'\n", ");\n"]
+    create_process = mocker.patch("asyncio.create_subprocess_exec", return_value=FakeProcess(lines))
+    engine = AsyncMigrationEngine()
+
+    async def collect():
+        return [statement async for statement in engine.dump_statements("host=pg1", ["s"], "pre-data")]
+
+    statements = asyncio.run(collect())
+
+    assert statements == ["SET a = 1;", "CREATE TABLE s.t (\n    a text DEFAULT ';'\n);"]
+    assert create_process.call_args.args[-2:] == ("-n", "s")
+
+
+def test_post_data_statements_are_bounded_per_target(mocker):
+    running = 0
+    peak = 0
+    executed = []
+
+    class FakeConnection:
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc_info):
+            return False
+
+        async def execute(self, statement):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            executed.append(statement)
+            running -= 1
+
+    async def connect(*args, **kwargs):
+        return FakeConnection()
+
+    mocker.patch("psycopg.AsyncConnection.connect", side_effect=connect)
+    units = parse_units([f"CREATE INDEX idx_{i} ON s.t{i} USING btree (a);" for i in range(6)]
+                        + ["ALTER TABLE ONLY s.t0\n    ADD CONSTRAINT fk FOREIGN KEY (b) REFERENCES s.t1(id);"])
+    engine = AsyncMigrationEngine(EngineLimits(index_builds_per_target=2))
+
+    asyncio.run(engine.run_post_data_units("host=pg2 dbname=a", units))
+
+    assert peak == 2
+    assert executed[-1].startswith("ALTER TABLE ONLY s.t0")
+    assert len(executed) == 7
+
+
+def test_dump_statements_kills_pg_dump_when_the_reader_stops(mocker):
+    process = BlockedProcess(["SET a = 1;\n", "SET b = 2;\n"])
+    mocker.patch("asyncio.create_subprocess_exec", return_value=process)
+    engine = AsyncMigrationEngine()
+
+    async def read_first():
+        statements = engine.dump_statements("host=pg1", ["s"], "pre-data")
+        first = await anext(statements)
+        await asyncio.wait_for(statements.aclose(), timeout=1)
+        return first
+
+    assert asyncio.run(read_first()) == "SET a = 1;"
+    assert process.returncode == -9
+
+
+def test_missing_subscription_fails_the_wait(mocker):
+    conn = mocker.AsyncMock()
+    conn.execute.return_value.fetchone.return_value = None
+    pool = mocker.MagicMock()
+    pool.connection.return_value.__aenter__.return_value = conn
+    engine = AsyncMigrationEngine()
+    mocker.patch.object(engine, "pool", mocker.AsyncMock(return_value=pool))
+
+    with pytest.raises(MigrationAborted):
+        asyncio.run(engine.wait_for_initial_sync("host=pg2", "subscription_a"))
+
+
+def test_job_without_catalog_is_aborted_before_pg_dump(mocker):
+    create_process = mocker.patch("asyncio.create_subprocess_exec")
+    engine = AsyncMigrationEngine()
+    mocker.patch.object(engine, "execute", mocker.AsyncMock(return_value=None))
+
+    result = asyncio.run(engine.migrate(MigrationJob("host=pg1", "a", "host=pg2", "a")))
+
+    assert result.error == "no schema read from the primary a"
+    create_process.assert_not_called()
+
+
+def test_failed_pg_dump_fails_the_dump(mocker):
+    mocker.patch("asyncio.create_subprocess_exec", return_value=FailedProcess(["SET a = 1;\n"]))
+    engine = AsyncMigrationEngine()
+
+    async def collect():
+        return [statement async for statement in engine.dump_statements("host=pg1", ["s"], "post-data")]
+
+    with pytest.raises(MigrationAborted, match="exited with code 1"):
+        asyncio.run(collect())
+
+
+def test_failing_pre_data_statement_fails_the_restore(mocker):
+    mocker.patch("asyncio.create_subprocess_exec",
+                 return_value=FakeProcess(["CREATE SCHEMA public;\n", "CREATE TABLE s.t (a int);\n"]))
+    conn = mocker.AsyncMock()
+    conn.execute.side_effect = psycopg.Error("<expected error>")
+    connect = mocker.patch("psycopg.AsyncConnection.connect", mocker.AsyncMock())
+    connect.return_value.__aenter__.return_value = conn
+    job = MigrationJob("host=pg1", "a", "host=pg2", "a")
+
+    with pytest.raises(psycopg.Error):
+        asyncio.run(AsyncMigrationEngine().restore_pre_data(job, ["s"]))
+
+    conn.execute.assert_called_once_with("CREATE TABLE s.t (a int);")
+    conn.rollback.assert_called_once()
+    conn.commit.assert_not_called()
@@ -0,0 +1,173 @@
+import argparse
+import dataclasses
+import datetime
+import json
+import os
+import subprocess
+import tempfile
+import time
+
+import psycopg
+from psycopg.conninfo import make_conninfo
+
+import planner
+import replication_start
+from database import Database
+from migration import MigrationStore
+from primary import Primary
+from replication_start import ReplicationOptions
+
+RESULTS_PATH = "benchmark_results.jsonl"
+BENCHMARK_DB = "bench_db"
+_INDEXED_COLUMNS = ("name", "value", "created_at")
+
+
+@dataclasses.dataclass
+class SchemaSpec:
+    schemas: int = 2
+    # Per schema
+    tables: int = 10
+    # Per table
+    rows: int = 1000
+    # Secondary indexes per table, at most one per indexed column
+    indexes: int = 1
+    # Share of the tables with a foreign key to the previous table of their schema
+    foreign_key_ratio: float = 0.5
+
+
+def has_foreign_key(spec: SchemaSpec, table_index):
+    return 0 < table_index <= round((spec.tables - 1) * spec.foreign_key_ratio)
+
+
+def generate_statements(spec: SchemaSpec):
+    """
+    SQL creating and filling the synthetic schemas of spec.
+
+    >>> statements = generate_statements(SchemaSpec(schemas=1, tables=2, rows=10, indexes=2, foreign_key_ratio=1))
+    >>> len(statements)
+    9
+    >>> "REFERENCES bench_0.t_0 (id)" in statements[5]
+    True
+    """
+    statements = []
+    for schema_index in range(spec.schemas):
+        schema = f"bench_{schema_index}"
+        statements.append(f"CREATE SCHEMA {schema};")
+        for table_index in range(spec.tables):
+            table = f"{schema}.t_{table_index}"
+            foreign_key = has_foreign_key(spec, table_index)
+            reference = f" REFERENCES {schema}.t_{table_index - 1} (id)" if foreign_key else ""
+            statements.append(f"CREATE TABLE {table} (id bigint PRIMARY KEY, parent_id bigint{reference}, "
+                              f"name text NOT NULL, value numeric, created_at timestamptz NOT NULL);")
+            for column in _INDEXED_COLUMNS[:spec.indexes]:
+                statements.append(f"CREATE INDEX t_{table_index}_{column}_idx ON {table} ({column});")
+            parent_id = f"(g % {spec.rows}) + 1" if foreign_key else "NULL"
+            statements.append(f"INSERT INTO {table} SELECT g, {parent_id}, md5(g::text), g * 1.5, "
+                              f"now() - g * interval '1 second' FROM generate_series(1, {spec.rows}) g;")
+    return statements
+
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def recreate_database(admin_conn_string, db_name):
+    with psycopg.connect(admin_conn_string, autocommit=True) as conn:
+        conn.execute(f"DROP DATABASE IF EXISTS {db_name} WITH (FORCE)")
+        conn.execute(f"CREATE DATABASE {db_name}")
+
+
+def drop_benchmark(primary_admin, secondary_admin, db_name):
+    conn_primary = make_conninfo(primary_admin, dbname=db_name)
+    conn_secondary = make_conninfo(secondary_admin, dbname=db_name)
+    results = replication_start.execute_query(
+        conn_secondary, f"select subname from pg_subscription where subname like 'subscription_{db_name}_%'")
+    if results:
+        replication_start.drop_subscriptions(conn_primary, conn_secondary, [result[0] for result in results])
+    for admin_conn_string in (secondary_admin, primary_admin):
+        with psycopg.connect(admin_conn_string, autocommit=True) as conn:
+            conn.execute(f"DROP DATABASE IF EXISTS {db_name} WITH (FORCE)")
+
+
+def run_benchmark(spec: SchemaSpec, primary_admin, secondary_admin, subscription_conn, db_name=BENCHMARK_DB,
+                  results_path=RESULTS_PATH, options: ReplicationOptions = None):
+    """
+    Migrate a synthetic database between two local servers and record the time of each phase.
+
+    The admin connection strings point to any database of each server, the
+    benchmark database is created on both. subscription_conn is how the
+    secondary reaches the primary. Results are appended as a JSON line.
+    """
+    options = options or ReplicationOptions()
+    conn_primary = make_conninfo(primary_admin, dbname=db_name)
+    conn_secondary = make_conninfo(secondary_admin, dbname=db_name)
+    recreate_database(primary_admin, db_name)
+    recreate_database(secondary_admin, db_name)
+
+    start = time.monotonic()
+    with psycopg.connect(conn_primary, autocommit=True) as conn:
+        for statement in generate_statements(spec):
+            conn.execute(statement)
+        conn.execute("ANALYZE")
+    generate_duration = time.monotonic() - start
+
+    start = time.monotonic()
+    db_infos = Primary(Database(conn_primary, db_name)).retrieve_db_infos(None)
+    discovery_duration = time.monotonic() - start
+    # Work of each phase as the planner measures it, calibrating its rates
+    work = planner.phase_work(planner.table_costs(Database(conn_primary, db_name), db_infos.db_schemas),
+                              planner.count_pre_data_statements(conn_primary, db_infos.db_schemas))
+
+    os.environ["CONN_DB_PRIMARY_FULL"] = make_conninfo(subscription_conn, dbname=db_name)
+    with tempfile.TemporaryDirectory() as state_directory:
+        options = dataclasses.replace(options, state_file=os.path.join(state_directory, "state.json"))
+        start = time.monotonic()
+        try:
+            completed = replication_start.main("benchmark", conn_primary, db_name, conn_secondary, db_name, None,
+                                               options)
+        finally:
+            total_duration = time.monotonic() - start
+            state = MigrationStore(options.state_file).load()
+            drop_benchmark(primary_admin, secondary_admin, db_name)
+
+    result = {
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": current_commit(),
+        "spec": dataclasses.asdict(spec),
+        "options": dataclasses.asdict(options) | {"state_file": None},
+        "db_size_bytes": db_infos.db_size_bytes,
+        "work": work,
+        "completed": completed,
+        "phases": {"generate": generate_duration, "catalog_discovery": discovery_duration,
+                   **(state.durations if state is not None else {})},
+        "total": total_duration,
+    }
+    with open(results_path, "a") as results_file:
+        results_file.write(json.dumps(result) + "\n")
+    print(f"Benchmark {spec} : {total_duration:.3f}s, phases {result['phases']}")
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time each replication phase on a synthetic database")
+    parser.add_argument("primary_admin", help="connection string to any database of the primary server")
+    parser.add_argument("secondary_admin", help="connection string to any database of the secondary server")
+    parser.add_argument("--subscription-conn", help="primary connection string as seen from the secondary, "
+                                                    "primary_admin by default")
+    parser.add_argument("--schemas", type=int, default=SchemaSpec.schemas)
+    parser.add_argument("--tables", type=int, default=SchemaSpec.tables)
+    parser.add_argument("--rows", type=int, default=SchemaSpec.rows)
+    parser.add_argument("--indexes", type=int, default=SchemaSpec.indexes)
+    parser.add_argument("--foreign-key-ratio", type=float, default=SchemaSpec.foreign_key_ratio)
+    parser.add_argument("--post-data-jobs", type=int, default=1)
+    parser.add_argument("--db-name", default=BENCHMARK_DB)
+    parser.add_argument("--results", default=RESULTS_PATH)
+    args = parser.parse_args()
+
+    run_benchmark(SchemaSpec(args.schemas, args.tables, args.rows, args.indexes, args.foreign_key_ratio),
+                  args.primary_admin, args.secondary_admin, args.subscription_conn or args.primary_admin,
+                  args.db_name, args.results, ReplicationOptions(post_data_jobs=args.post_data_jobs))
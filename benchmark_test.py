@@ -0,0 +1,19 @@
+from benchmark import SchemaSpec, generate_statements, has_foreign_key
+
+
+def test_generate_statements_density():
+    spec = SchemaSpec(schemas=3, tables=5, rows=100, indexes=3, foreign_key_ratio=0.5)
+
+    statements = generate_statements(spec)
+
+    assert sum(statement.startswith("CREATE SCHEMA") for statement in statements) == 3
+    assert sum(statement.startswith("CREATE TABLE") for statement in statements) == 15
+    assert sum(statement.startswith("CREATE INDEX") for statement in statements) == 45
+    assert sum("REFERENCES" in statement for statement in statements) == 6
+    assert "generate_series(1, 100)" in statements[-1]
+
+
+def test_foreign_keys_never_on_the_first_table():
+    spec = SchemaSpec(tables=4, foreign_key_ratio=1)
+
+    assert [has_foreign_key(spec, table_index) for table_index in range(4)] == [False, True, True, True]
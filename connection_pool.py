@@ -0,0 +1,84 @@
+import sys
+import threading
+
+from psycopg_pool import ConnectionPool, PoolTimeout
+
+POOL_SIZE = 4
+POOL_TIMEOUT_IN_SECONDS = 30
+
+# One pool per endpoint, keyed by connection string and shared by every
+# Database instance and execute_query call targeting the same server.
+_pools = {}
+_pools_users = {}
+_pools_lock = threading.Lock()
+
+
+def open_pool(conn_string, size=POOL_SIZE, timeout=POOL_TIMEOUT_IN_SECONDS):
+    with _pools_lock:
+        pool = _pools.get(conn_string)
+        if pool is not None:
+            _pools_users[conn_string] += 1
+            return pool
+
+        pool = ConnectionPool(conn_string,
+                              min_size=1,
+                              max_size=max(size, 1),
+                              kwargs={"autocommit": True},
+                              check=ConnectionPool.check_connection,
+                              timeout=timeout,
+                              open=False)
+        try:
+            pool.open(wait=True, timeout=timeout)
+        except PoolTimeout as e:
+            pool.close()
+            print(f"Error {e} on connection string {conn_string}", file=sys.stderr)
+            sys.exit(1)
+
+        _pools[conn_string] = pool
+        _pools_users[conn_string] = 1
+        return pool
+
+
+def get_pool(conn_string):
+    return _pools.get(conn_string)
+
+
+def close_pool(conn_string):
+    with _pools_lock:
+        pool = _pools.get(conn_string)
+        if pool is None:
+            return
+        _pools_users[conn_string] -= 1
+        if _pools_users[conn_string] > 0:
+            return
+        del _pools[conn_string]
+        del _pools_users[conn_string]
+    pool.close()
+
+
+def pool_stats(conn_string):
+    pool = _pools.get(conn_string)
+    if pool is None:
+        return None
+    stats = pool.get_stats()
+    connections_opened = stats.get("connections_num", 0)
+    requests = stats.get("requests_num", 0)
+    return {
+        "pool_size": stats.get("pool_size", 0),
+        "pool_max": stats.get("pool_max", 0),
+        "connections_opened": connections_opened,
+        "connections_reused": max(requests - connections_opened, 0),
+        "connections_lost": stats.get("connections_lost", 0),
+        "requests": requests,
+        "requests_wait_ms": stats.get("requests_wait_ms", 0),
+        "usage_ms": stats.get("usage_ms", 0),
+    }
+
+
+def execute_query(pool: ConnectionPool, query, fetch=True):
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(query)
+            if fetch:
+                return cur.fetchall()
+    return None
@@ -0,0 +1,61 @@
+from unittest.mock import sentinel
+
+import pytest
+
+import connection_pool
+
+
+@pytest.fixture(autouse=True)
+def mocked_pool_class(mocker):
+    mocked = mocker.patch("connection_pool.ConnectionPool")
+    yield mocked
+    connection_pool._pools.clear()
+    connection_pool._pools_users.clear()
+
+
+def test_open_pool_creates_one_pool_per_endpoint(mocked_pool_class):
+    pool = connection_pool.open_pool("{primary}", size=8)
+
+    assert connection_pool.open_pool("{primary}") is pool
+    assert connection_pool.get_pool("{primary}") is pool
+    assert connection_pool.get_pool("{secondary}") is None
+    mocked_pool_class.assert_called_once()
+    assert mocked_pool_class.call_args.kwargs["max_size"] == 8
+    assert mocked_pool_class.call_args.kwargs["kwargs"] == {"autocommit": True}
+    assert mocked_pool_class.call_args.kwargs["check"] is mocked_pool_class.check_connection
+
+
+def test_close_pool_waits_for_the_last_user():
+    pool = connection_pool.open_pool("{primary}")
+    connection_pool.open_pool("{primary}")
+
+    connection_pool.close_pool("{primary}")
+    pool.close.assert_not_called()
+    assert connection_pool.get_pool("{primary}") is pool
+
+    connection_pool.close_pool("{primary}")
+    pool.close.assert_called_once()
+    assert connection_pool.get_pool("{primary}") is None
+
+
+def test_pool_stats_count_reused_connections():
+    pool = connection_pool.open_pool("{primary}")
+    pool.get_stats.return_value = {"pool_size": 2, "pool_max": 4, "connections_num": 2,
+                                   "requests_num": 50, "requests_wait_ms": 12}
+
+    stats = connection_pool.pool_stats("{primary}")
+
+    assert stats["connections_opened"] == 2
+    assert stats["connections_reused"] == 48
+    assert stats["requests_wait_ms"] == 12
+    assert connection_pool.pool_stats("{secondary}") is None
+
+
+def test_execute_query_borrows_a_connection(mocker):
+    pool = mocker.MagicMock()
+    mock_cursor = pool.connection.return_value.__enter__.return_value.cursor.return_value.__enter__.return_value
+    mock_cursor.fetchall.return_value = sentinel.some_array
+
+    assert connection_pool.execute_query(pool, "SELECT 1;") is sentinel.some_array
+    assert connection_pool.execute_query(pool, "SELECT 1;", fetch=False) is None
+    assert mock_cursor.execute.call_count == 2
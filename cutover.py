@@ -0,0 +1,182 @@
+import argparse
+import dataclasses
+import datetime
+import sys
+import time
+
+import psycopg
+
+from database import Database
+
+CATCH_UP_TIMEOUT_IN_SECONDS = 300
+CATCH_UP_INTERVAL_IN_SECONDS = 0.2
+# Increments each sequence is moved past the primary's value on the secondary
+SEQUENCE_MARGIN = 1000
+
+CURRENT_LSN_QUERY = "SELECT pg_current_wal_lsn()::text"
+
+# WAL position applied and reported by each subscription, parallel apply workers included
+APPLIED_LSN_QUERY = """
+    SELECT subname, max(latest_end_lsn)::text, pg_wal_lsn_diff(%s::pg_lsn, max(latest_end_lsn))::bigint
+    FROM pg_stat_subscription
+    WHERE relid IS NULL AND subname = ANY(%s)
+    GROUP BY subname
+"""
+
+SUBSCRIPTIONS_QUERY = "SELECT subname FROM pg_subscription WHERE subname LIKE %s"
+
+SEQUENCES_QUERY = """
+    SELECT schemaname, sequencename, last_value, increment_by, min_value, max_value
+    FROM pg_sequences
+    WHERE schemaname NOT ILIKE 'pg_%%' AND schemaname <> ALL(%s)
+"""
+
+# Every sequence in one statement and one transaction
+SETVAL_QUERY = """
+    SELECT count(pg_catalog.setval(format('%%I.%%I', s.schema, s.name)::regclass, s.value))
+    FROM unnest(%s::text[], %s::text[], %s::bigint[]) AS s(schema, name, value)
+"""
+
+
+@dataclasses.dataclass
+class CutoverReport:
+    target_lsn: str | None = None
+    caught_up: bool = False
+    sequences: int = 0
+    # Sequences never used on the primary, left as they are
+    unused_sequences: int = 0
+    started_at: datetime.datetime | None = None
+    ended_at: datetime.datetime | None = None
+    catch_up_seconds: float = 0
+    sequences_seconds: float = 0
+
+    @property
+    def completed(self):
+        return self.ended_at is not None
+
+    @property
+    def window_seconds(self):
+        return (self.ended_at - self.started_at).total_seconds() if self.started_at and self.ended_at else 0
+
+
+def target_value(last_value, increment_by, min_value, max_value, margin=SEQUENCE_MARGIN):
+    """
+    Value given to a secondary sequence, margin increments past the primary's and within its bounds.
+
+    >>> target_value(41, 1, 1, 2 ** 63 - 1)
+    1041
+    >>> target_value(-5, -1, -100, -1)
+    -100
+    """
+    return min(max(last_value + margin * increment_by, min_value), max_value)
+
+
+def wait_for_lsn(conn_secondary, subscription_names, target_lsn, timeout=CATCH_UP_TIMEOUT_IN_SECONDS,
+                 interval=CATCH_UP_INTERVAL_IN_SECONDS):
+    """Wait until every subscription has applied the primary's WAL up to target_lsn, True once done."""
+    deadline = time.monotonic() + timeout
+    while True:
+        rows = conn_secondary.execute(APPLIED_LSN_QUERY, (target_lsn, list(subscription_names))).fetchall()
+        lag = {subname: lag_bytes for subname, _, lag_bytes in rows}
+        # A subscription without apply worker is disabled or failing, it never catches up by itself
+        behind = {subname: lag.get(subname) for subname in subscription_names
+                  if lag.get(subname) is None or lag[subname] > 0}
+        if not behind:
+            return True
+        if time.monotonic() >= deadline:
+            for subname, lag_bytes in behind.items():
+                print(f"Subscription {subname} is {lag_bytes if lag_bytes is not None else 'unknown'} bytes behind "
+                      f"{target_lsn}", file=sys.stderr)
+            return False
+        time.sleep(interval)
+
+
+def read_sequences(conn_primary, list_schema_excluded=None):
+    return conn_primary.execute(SEQUENCES_QUERY, (list(list_schema_excluded or []),)).fetchall()
+
+
+def sync_sequences(conn_secondary, sequences, margin=SEQUENCE_MARGIN):
+    """Set the secondary sequences past the primary's values in a single statement, returns the count."""
+    values = [(schema, name, target_value(last_value, increment_by, min_value, max_value, margin))
+              for schema, name, last_value, increment_by, min_value, max_value in sequences
+              if last_value is not None]
+    if not values:
+        return 0
+    schemas, names, targets = (list(column) for column in zip(*values))
+    with conn_secondary.transaction():
+        return conn_secondary.execute(SETVAL_QUERY, (schemas, names, targets)).fetchone()[0]
+
+
+def cutover(primary: Database, secondary: Database, subscription_pattern, list_schema_excluded=None,
+            margin=SEQUENCE_MARGIN, timeout=CATCH_UP_TIMEOUT_IN_SECONDS) -> CutoverReport:
+    """
+    Make the secondary ready to take the writes, once they are frozen on the primary.
+
+    The window starts with the call: the primary's current LSN is the
+    position every subscription must have applied, then the sequences are
+    read from the primary in one query and set on the secondary in one
+    statement. The window ends when the secondary has its sequences.
+    """
+    report = CutoverReport(started_at=datetime.datetime.now(datetime.timezone.utc))
+    start = time.monotonic()
+    with primary.connection() as conn_primary, secondary.connection() as conn_secondary:
+        subscription_names = [row[0] for row in
+                              conn_secondary.execute(SUBSCRIPTIONS_QUERY, (subscription_pattern,)).fetchall()]
+        if not subscription_names:
+            print(f"No subscription matching {subscription_pattern} on host {secondary.conn_string}",
+                  file=sys.stderr)
+            return report
+        report.target_lsn = conn_primary.execute(CURRENT_LSN_QUERY).fetchone()[0]
+        report.caught_up = wait_for_lsn(conn_secondary, subscription_names, report.target_lsn, timeout)
+        report.catch_up_seconds = time.monotonic() - start
+        if not report.caught_up:
+            print(f"Subscriptions not caught up with {report.target_lsn} after {timeout}s, sequences left as "
+                  f"they are", file=sys.stderr)
+            return report
+
+        sequences_start = time.monotonic()
+        sequences = read_sequences(conn_primary, list_schema_excluded)
+        report.unused_sequences = sum(1 for sequence in sequences if sequence[2] is None)
+        report.sequences = sync_sequences(conn_secondary, sequences, margin)
+        report.sequences_seconds = time.monotonic() - sequences_start
+    report.ended_at = datetime.datetime.now(datetime.timezone.utc)
+    return report
+
+
+def print_report(report: CutoverReport, output=sys.stdout):
+    print(f"Caught up with {report.target_lsn} in {report.catch_up_seconds:.3f}s", file=output)
+    print(f"Sequences : {report.sequences} set, {report.unused_sequences} never used, "
+          f"in {report.sequences_seconds:.3f}s", file=output)
+    print(f"Write downtime : {report.started_at.isoformat()} -> {report.ended_at.isoformat()} "
+          f"({report.window_seconds:.3f}s)", file=output)
+
+
+def main(conn_primary, db_primary, conn_secondary, list_schema_excluded=None, margin=SEQUENCE_MARGIN,
+         timeout=CATCH_UP_TIMEOUT_IN_SECONDS):
+    try:
+        report = cutover(Database(conn_primary, db_primary), Database(conn_secondary, None),
+                         f"subscription_{db_primary}_%", list_schema_excluded, margin, timeout)
+    except psycopg.Error as e:
+        print(f"Error {e} during the cutover of database {db_primary}", file=sys.stderr)
+        return None
+    if report.completed:
+        print_report(report)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Wait for the subscriptions to apply all the primary's WAL and "
+                                                 "copy the sequences, once the writes are frozen on the primary")
+    parser.add_argument("connection_primary")
+    parser.add_argument("db_name_primary")
+    parser.add_argument("connection_secondary")
+    parser.add_argument("schema_excluded_list", nargs="?")
+    parser.add_argument("--margin", type=int, default=SEQUENCE_MARGIN,
+                        help="increments each sequence is moved past the primary's value")
+    parser.add_argument("--timeout", type=float, default=CATCH_UP_TIMEOUT_IN_SECONDS)
+    args = parser.parse_args()
+
+    report = main(args.connection_primary, args.db_name_primary, args.connection_secondary,
+                  args.schema_excluded_list.split(",") if args.schema_excluded_list else None,
+                  args.margin, args.timeout)
+    sys.exit(0 if report is not None and report.completed else 1)
@@ -0,0 +1,57 @@
+import cutover
+from cutover import SETVAL_QUERY, sync_sequences, wait_for_lsn
+
+
+def mocked_connection(mocker, *results):
+    conn = mocker.MagicMock()
+    conn.execute.return_value.fetchall.side_effect = results
+    return conn
+
+
+def test_wait_for_lsn_until_every_subscription_caught_up(mocker):
+    mocker.patch("time.sleep")
+    conn = mocked_connection(mocker,
+                             [("sub_1", "0/10", 16), ("sub_2", "0/20", 0)],
+                             [("sub_1", "0/20", 0), ("sub_2", "0/20", 0)])
+
+    assert wait_for_lsn(conn, ["sub_1", "sub_2"], "0/20")
+    assert conn.execute.call_count == 2
+
+
+def test_wait_for_lsn_gives_up_on_a_subscription_without_worker(mocker):
+    mocker.patch("time.monotonic", side_effect=[0, 1, 2])
+    mocker.patch("time.sleep")
+    conn = mocked_connection(mocker, [("sub_1", "0/20", 0)], [("sub_1", "0/20", 0)])
+
+    assert not wait_for_lsn(conn, ["sub_1", "sub_2"], "0/20", timeout=1)
+
+
+def test_sync_sequences_in_one_statement(mocker):
+    conn = mocker.MagicMock()
+    conn.execute.return_value.fetchone.return_value = (2,)
+    sequences = [("s", "a_id_seq", 41, 1, 1, 2 ** 63 - 1),
+                 ("s", "b_id_seq", None, 1, 1, 2 ** 63 - 1),
+                 ("s", "c_id_seq", 2 ** 31 - 10, 1, 1, 2 ** 31 - 1)]
+
+    assert sync_sequences(conn, sequences, margin=100) == 2
+    conn.execute.assert_called_once_with(SETVAL_QUERY, (["s", "s"], ["a_id_seq", "c_id_seq"],
+                                                        [141, 2 ** 31 - 1]))
+
+
+def test_cutover_reports_the_write_downtime_window(mocker):
+    conn_primary = mocker.MagicMock()
+    conn_primary.execute.return_value.fetchone.return_value = ("0/20",)
+    conn_primary.execute.return_value.fetchall.return_value = [("s", "a_id_seq", 41, 1, 1, 100000)]
+    conn_secondary = mocked_connection(mocker, [("subscription_db_1",)], [("subscription_db_1", "0/20", 0)])
+    conn_secondary.execute.return_value.fetchone.return_value = (1,)
+    primary = mocker.MagicMock()
+    primary.connection.return_value.__enter__.return_value = conn_primary
+    secondary = mocker.MagicMock()
+    secondary.connection.return_value.__enter__.return_value = conn_secondary
+
+    report = cutover.cutover(primary, secondary, "subscription_db_%")
+
+    assert report.caught_up and report.completed
+    assert report.target_lsn == "0/20"
+    assert report.sequences == 1
+    assert report.window_seconds >= report.sequences_seconds
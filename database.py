@@ -1,8 +1,12 @@
+import contextlib
 import sys
 
 import psycopg
 from psycopg import Error
 
+import connection_pool
+import tracing
+
 
 class Database:
     def __init__(self, conn_string, db_name):
@@ -18,7 +22,41 @@ class Database:
                 f"Error {e} on connection string {self.conn_string}", file=sys.stderr)
             sys.exit(1)
 
+    @contextlib.contextmanager
+    def connection(self):
+        # Borrow a connection from the endpoint pool when one is open,
+        # otherwise open a dedicated connection for the duration of the block.
+        pool = connection_pool.get_pool(self.conn_string)
+        if pool is not None:
+            with pool.connection() as conn:
+                yield conn
+            return
+
+        conn = self.get_db_connection()
+        try:
+            yield conn
+        finally:
+            if conn is not None:
+                conn.close()
+
     def execute_query(self, query, fetch=True):
+        with tracing.span("sql", statement=tracing.statement_attribute(query), db=self.db_name) as span:
+            results = self._execute_query(query, fetch)
+            if isinstance(results, list):
+                span.set(rows=len(results))
+            return results
+
+    def _execute_query(self, query, fetch):
+        pool = connection_pool.get_pool(self.conn_string)
+        if pool is not None:
+            try:
+                return connection_pool.execute_query(pool, query, fetch)
+            except Error as e:
+                tracing.record_error(e)
+                print(
+                    f"Error {e} with query '{query}' on host '{self.conn_string}'", file=sys.stderr)
+                return None
+
         conn = self.get_db_connection()
         if conn is None:
             return None
@@ -30,10 +68,9 @@ class Database:
                     results = cur.fetchall()
                     return results
         except Error as e:
+            tracing.record_error(e)
             print(
                 f"Error {e} with query '{query}' on host '{self.conn_string}'", file=sys.stderr)
             return None
         finally:
             conn.close()
-
-
@@ -81,6 +81,43 @@ def test_database_execute_query_on_error(mocker, capsys):
     mock_connection.close.assert_called_once()
 
 
+def test_database_execute_query_uses_endpoint_pool(mocker):
+    db = Database("{string connection}", "db_name")
+    mock_pool = mocker.MagicMock()
+    mocker.patch("connection_pool.get_pool", return_value=mock_pool)
+    mocked_connect = mocker.patch("psycopg.connect")
+    mock_cursor = mock_pool.connection.return_value.__enter__.return_value.cursor.return_value.__enter__.return_value
+    mock_cursor.fetchall.return_value = sentinel.some_array
+
+    result = db.execute_query("SELECT 1;")
+
+    assert result == sentinel.some_array
+    mocked_connect.assert_not_called()
+
+
+def test_database_execute_query_on_pool_error(mocker, capsys):
+    db = Database("{string connection}", "db_name")
+    mock_pool = mocker.MagicMock()
+    mocker.patch("connection_pool.get_pool", return_value=mock_pool)
+    mock_pool.connection.return_value.__enter__.side_effect = psycopg.Error("<expected error>")
+
+    result = db.execute_query("SELECT 1;")
+
+    assert result is None
+    assert capsys.readouterr().err == "Error <expected error> with query 'SELECT 1;' on host '{string connection}'\n"
+
+
+def test_database_connection_closes_dedicated_connection(mocker):
+    db = Database("{string connection}", "db_name")
+    mock_connection = mocker.MagicMock()
+    mocker.patch("psycopg.connect", return_value=mock_connection)
+
+    with db.connection() as conn:
+        assert conn is mock_connection
+
+    mock_connection.close.assert_called_once()
+
+
 class DatabaseStub(Database):
     def __init__(self):
         self.recorded_queries = {}
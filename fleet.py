@@ -0,0 +1,219 @@
+import concurrent.futures
+import dataclasses
+import datetime
+import json
+import os
+import sys
+import time
+import tomllib
+
+import replication_start
+from async_engine import server_key
+from database import Database
+from primary import Primary
+from replication_start import ReplicationOptions
+
+MAX_CONCURRENT = 4
+MAX_PER_PRIMARY = 1
+MAX_PER_SECONDARY = 2
+REPORT_PATH = "fleet_report.json"
+# ReplicationOptions naming a resource of one migration, only set in the options of a pair
+PAIR_OPTIONS = ("state_file", "metrics_port")
+
+
+@dataclasses.dataclass
+class FleetPair:
+    conn_primary: str
+    db_primary: str
+    conn_secondary: str
+    db_secondary: str | None = None
+    schema_excluded: list | None = None
+    options: dict = dataclasses.field(default_factory=dict)
+    # Connection string of the subscriptions, CONN_DB_PRIMARY_FULL by default
+    connection_primary_full: str | None = None
+    db_size_bytes: int | None = None
+
+    def __post_init__(self):
+        if self.db_secondary is None:
+            self.db_secondary = self.db_primary
+
+
+@dataclasses.dataclass
+class FleetManifest:
+    pairs: list
+    # ReplicationOptions fields applied to every pair, overridden by each pair's options
+    defaults: dict = dataclasses.field(default_factory=dict)
+    max_concurrent: int = MAX_CONCURRENT
+    max_per_primary: int = MAX_PER_PRIMARY
+    max_per_secondary: int = MAX_PER_SECONDARY
+    report: str = REPORT_PATH
+
+    def replication_options(self, pair: FleetPair) -> ReplicationOptions:
+        return ReplicationOptions(**{**self.defaults, **pair.options})
+
+
+@dataclasses.dataclass
+class PairReport:
+    db_primary: str
+    db_secondary: str
+    primary: str
+    secondary: str
+    status: str
+    db_size_bytes: int | None = None
+    started_at: str | None = None
+    duration: float = 0
+    throughput_bytes_per_second: float | None = None
+    error: str | None = None
+
+
+def load_manifest(path) -> FleetManifest:
+    """Read a fleet manifest in JSON, TOML or YAML, YAML requiring PyYAML."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".toml":
+        with open(path, "rb") as manifest_file:
+            content = tomllib.load(manifest_file)
+    elif extension in (".yaml", ".yml"):
+        try:
+            import yaml
+        except ImportError:
+            print("PyYAML is required to read a YAML manifest, use JSON or TOML instead", file=sys.stderr)
+            sys.exit(1)
+        with open(path) as manifest_file:
+            content = yaml.safe_load(manifest_file)
+    else:
+        with open(path) as manifest_file:
+            content = json.load(manifest_file)
+    pairs = [FleetPair(**pair) for pair in content.pop("pairs", [])]
+    shared = [name for name in PAIR_OPTIONS if name in content.get("defaults", {})]
+    if shared:
+        print(f"{', '.join(shared)} can't be shared by the pairs, set them in the options of each pair",
+              file=sys.stderr)
+        sys.exit(1)
+    return FleetManifest(pairs, **content)
+
+
+def failed_report(pair: FleetPair, error) -> PairReport:
+    return PairReport(pair.db_primary, pair.db_secondary, server_key(pair.conn_primary),
+                      server_key(pair.conn_secondary), "failed", pair.db_size_bytes,
+                      datetime.datetime.now().isoformat(), error=error)
+
+
+def measure_pairs(pairs):
+    """
+    Fill db_size_bytes of each pair, return the pairs largest first and the
+    reports of the pairs whose primary could not be read.
+    """
+    measured = []
+    failures = []
+    for pair in pairs:
+        try:
+            db_infos = Primary(Database(pair.conn_primary, pair.db_primary)).retrieve_db_infos(pair.schema_excluded)
+        except SystemExit as e:
+            # Connection errors exit the single database script
+            print(f"{pair.db_primary} : primary unreachable, skipped", file=sys.stderr)
+            failures.append(failed_report(pair, f"exit {e.code}"))
+            continue
+        except Exception as e:
+            print(f"{pair.db_primary} : error {e}, skipped", file=sys.stderr)
+            failures.append(failed_report(pair, str(e)))
+            continue
+        pair.db_size_bytes = db_infos.db_size_bytes
+        print(f"{pair.db_primary} : {db_infos.db_size}")
+        measured.append(pair)
+    return sorted(measured, key=lambda pair: -(pair.db_size_bytes or 0)), failures
+
+
+class FleetScheduler:
+    """
+    Run pairs in the given order, at most max_concurrent at once.
+
+    A pair only starts while its primary runs fewer than max_per_primary
+    migrations and its secondary fewer than max_per_secondary. A pair
+    waiting for a busy host doesn't hold back the following ones.
+    """
+
+    def __init__(self, run_pair, max_concurrent=MAX_CONCURRENT, max_per_primary=MAX_PER_PRIMARY,
+                 max_per_secondary=MAX_PER_SECONDARY):
+        self.run_pair = run_pair
+        self.max_concurrent = max(max_concurrent, 1)
+        self.max_per_primary = max(max_per_primary, 1)
+        self.max_per_secondary = max(max_per_secondary, 1)
+
+    def run(self, pairs) -> list:
+        pending = list(pairs)
+        running = {}
+        primaries = {}
+        secondaries = {}
+        results = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_concurrent) as executor:
+            while pending or running:
+                for pair in list(pending):
+                    if len(running) >= self.max_concurrent:
+                        break
+                    primary, secondary = server_key(pair.conn_primary), server_key(pair.conn_secondary)
+                    if (primaries.get(primary, 0) >= self.max_per_primary
+                            or secondaries.get(secondary, 0) >= self.max_per_secondary):
+                        continue
+                    pending.remove(pair)
+                    primaries[primary] = primaries.get(primary, 0) + 1
+                    secondaries[secondary] = secondaries.get(secondary, 0) + 1
+                    running[executor.submit(self.run_pair, pair)] = (primary, secondary)
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    primary, secondary = running.pop(future)
+                    primaries[primary] -= 1
+                    secondaries[secondary] -= 1
+                    results.append(future.result())
+        return results
+
+
+def run_pair(manifest: FleetManifest, pair: FleetPair) -> PairReport:
+    report = failed_report(pair, None)
+    start = time.monotonic()
+    try:
+        completed = replication_start.main("fleet", pair.conn_primary, pair.db_primary, pair.conn_secondary,
+                                           pair.db_secondary, pair.schema_excluded,
+                                           manifest.replication_options(pair), pair.connection_primary_full)
+        report.status = "done" if completed else "stopped"
+    except SystemExit as e:
+        # Connection errors exit the single database script
+        report.error = f"exit {e.code}"
+    except Exception as e:
+        report.error = str(e)
+    report.duration = time.monotonic() - start
+    if pair.db_size_bytes and report.duration > 0:
+        report.throughput_bytes_per_second = pair.db_size_bytes / report.duration
+    print(f"{pair.db_primary} -> {pair.db_secondary} : {report.status} in {report.duration:.1f}s")
+    return report
+
+
+def write_report(path, reports, duration):
+    done = [report for report in reports if report.status == "done"]
+    total_bytes = sum(report.db_size_bytes or 0 for report in done)
+    summary = {
+        "pairs": len(reports),
+        "done": len(done),
+        "failed": len(reports) - len(done),
+        "duration": duration,
+        "bytes": total_bytes,
+        "throughput_bytes_per_second": total_bytes / duration if duration > 0 else None,
+        "migrations": [dataclasses.asdict(report) for report in reports],
+    }
+    with open(path, "w") as report_file:
+        json.dump(summary, report_file, indent=2)
+    print(f"Fleet : {summary['done']}/{summary['pairs']} migrations done in {duration:.1f}s, report in {path}")
+    return summary
+
+
+def main(manifest_path):
+    manifest = load_manifest(manifest_path)
+    start = time.monotonic()
+    pairs, failures = measure_pairs(manifest.pairs)
+    scheduler = FleetScheduler(lambda pair: run_pair(manifest, pair), manifest.max_concurrent,
+                               manifest.max_per_primary, manifest.max_per_secondary)
+    reports = failures + scheduler.run(pairs)
+    return write_report(manifest.report, reports, time.monotonic() - start)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
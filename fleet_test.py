@@ -0,0 +1,123 @@
+import json
+import threading
+import time
+
+import pytest
+
+from fleet import FleetPair, FleetScheduler, PairReport, load_manifest, measure_pairs, run_pair, write_report
+
+TOML_MANIFEST = """
+max_per_primary = 1
+report = "report.json"
+
+[defaults]
+post_data_jobs = 4
+
+[[pairs]]
+conn_primary = "host=pg1 dbname=a"
+db_primary = "a"
+conn_secondary = "host=pg9 dbname=a"
+schema_excluded = ["archive"]
+
+[[pairs]]
+conn_primary = "host=pg1 dbname=b"
+db_primary = "b"
+conn_secondary = "host=pg9 dbname=b2"
+db_secondary = "b2"
+options = { post_data_jobs = 8, shards = 2 }
+"""
+
+
+def test_load_toml_manifest(tmp_path):
+    path = tmp_path / "fleet.toml"
+    path.write_text(TOML_MANIFEST)
+
+    manifest = load_manifest(str(path))
+
+    assert [(pair.db_primary, pair.db_secondary) for pair in manifest.pairs] == [("a", "a"), ("b", "b2")]
+    assert manifest.pairs[0].schema_excluded == ["archive"]
+    assert manifest.max_per_primary == 1
+    assert manifest.replication_options(manifest.pairs[0]).post_data_jobs == 4
+    assert manifest.replication_options(manifest.pairs[1]).post_data_jobs == 8
+    assert manifest.replication_options(manifest.pairs[1]).shards == 2
+
+
+def test_load_json_manifest(tmp_path):
+    path = tmp_path / "fleet.json"
+    path.write_text(json.dumps({"pairs": [{"conn_primary": "host=pg1", "db_primary": "a",
+                                           "conn_secondary": "host=pg2"}]}))
+
+    assert load_manifest(str(path)).pairs == [FleetPair("host=pg1", "a", "host=pg2", "a")]
+
+
+def test_scheduler_caps_migrations_per_primary():
+    running = {}
+    peaks = {}
+    lock = threading.Lock()
+
+    def run(pair):
+        with lock:
+            running[pair.conn_primary] = running.get(pair.conn_primary, 0) + 1
+            peaks[pair.conn_primary] = max(peaks.get(pair.conn_primary, 0), running[pair.conn_primary])
+        time.sleep(0.01)
+        with lock:
+            running[pair.conn_primary] -= 1
+        return pair.db_primary
+
+    pairs = [FleetPair(f"host=pg{i % 2}", f"db{i}", "host=pg9") for i in range(6)]
+
+    results = FleetScheduler(run, max_concurrent=4, max_per_primary=1, max_per_secondary=4).run(pairs)
+
+    assert sorted(results) == [f"db{i}" for i in range(6)]
+    assert peaks == {"host=pg0": 1, "host=pg1": 1}
+
+
+def test_run_pair_reports_exit(mocker):
+    mocker.patch("replication_start.main", side_effect=SystemExit(1))
+    manifest = mocker.MagicMock()
+
+    report = run_pair(manifest, FleetPair("host=pg1", "a", "host=pg2", db_size_bytes=1000))
+
+    assert (report.status, report.error, report.primary) == ("failed", "exit 1", "pg1:5432")
+
+
+def test_write_report(tmp_path):
+    reports = [PairReport("a", "a", "pg1:5432", "pg2:5432", "done", 1000, duration=10),
+               PairReport("b", "b", "pg1:5432", "pg2:5432", "failed", 500, duration=1)]
+
+    summary = write_report(str(tmp_path / "report.json"), reports, 20)
+
+    assert (summary["done"], summary["failed"], summary["throughput_bytes_per_second"]) == (1, 1, 50)
+    assert json.loads((tmp_path / "report.json").read_text())["migrations"][1]["db_primary"] == "b"
+
+
+def test_run_pair_passes_its_subscription_connection(mocker):
+    main = mocker.patch("replication_start.main", return_value=True)
+    manifest = mocker.MagicMock()
+
+    report = run_pair(manifest, FleetPair("host=pg1", "a", "host=pg2", connection_primary_full="host=pg1 user=r"))
+
+    assert report.status == "done"
+    assert main.call_args.args[-1] == "host=pg1 user=r"
+
+
+def test_measure_pairs_reports_unreachable_primaries(mocker):
+    def retrieve_db_infos(self, list_schema_excluded):
+        if self.db.db_name == "a":
+            raise SystemExit(1)
+        return mocker.MagicMock(db_size_bytes=1000, db_size="1000 bytes")
+
+    mocker.patch("primary.Primary.retrieve_db_infos", retrieve_db_infos)
+
+    pairs, failures = measure_pairs([FleetPair("host=pg1", "a", "host=pg2"), FleetPair("host=pg1", "b", "host=pg2")])
+
+    assert [pair.db_primary for pair in pairs] == ["b"]
+    assert [(report.db_primary, report.status, report.error) for report in failures] == [("a", "failed", "exit 1")]
+
+
+def test_manifest_rejects_shared_state_file(tmp_path):
+    path = tmp_path / "fleet.json"
+    path.write_text(json.dumps({"defaults": {"state_file": "state.json"}, "pairs": []}))
+
+    with pytest.raises(SystemExit):
+        load_manifest(str(path))
@@ -0,0 +1,132 @@
+import concurrent.futures
+import dataclasses
+import re
+import sys
+import threading
+
+import psycopg
+
+import tracing
+from database import Database
+from post_data import POST_DATA_JOBS, ParallelPostDataExecutor, PostDataUnit, split_name, table_key
+
+READY_TABLES_QUERY = """
+    SELECT n.nspname, c.relname
+    FROM pg_subscription_rel sr
+    JOIN pg_class c ON c.oid = sr.srrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE sr.srsubstate = 'r' AND c.relname <> 'spatial_ref_sys'
+"""
+SUBSCRIPTION_FILTER = " AND sr.srsubid IN (SELECT oid FROM pg_subscription WHERE subname = ANY(%s))"
+
+_CREATE_INDEX = re.compile(r"CREATE(\s+UNIQUE)?\s+INDEX\s+(\S+)\s+ON\s+(?!ONLY\s)", re.IGNORECASE)
+
+
+def concurrent_index(unit: PostDataUnit):
+    """
+    Rewrite an index build so it doesn't block the apply worker, None when not possible.
+
+    >>> concurrent_index(PostDataUnit("CREATE UNIQUE INDEX idx ON s.t USING btree (a);", "index", "s.t")).statement
+    'CREATE UNIQUE INDEX CONCURRENTLY idx ON s.t USING btree (a);'
+    >>> concurrent_index(PostDataUnit("CREATE INDEX idx ON ONLY s.p USING btree (a);", "index", "s.p")) is None
+    True
+    """
+    if unit.kind != "index" or not _CREATE_INDEX.match(unit.statement):
+        return None
+    statement = _CREATE_INDEX.sub(lambda match: f"CREATE{match.group(1) or ''} INDEX CONCURRENTLY "
+                                                f"{match.group(2)} ON ", unit.statement, count=1)
+    return dataclasses.replace(unit, statement=statement)
+
+
+class IncrementalIndexScheduler(ParallelPostDataExecutor):
+    """
+    Build the post-data objects of each table as soon as its initial copy is ready.
+
+    Call poll (or the instance itself, as an on_progress callback) while the
+    initial sync runs: tables newly in the 'r' state get their CREATE [UNIQUE]
+    INDEX statements built with CONCURRENTLY on the worker connections.
+    Constraints, triggers, replica identities and every other statement
+    would lock the table against the apply worker, they are left for
+    remaining_units with the failed builds.
+    """
+
+    def __init__(self, db: Database, units, subscription_names=None, jobs=POST_DATA_JOBS,
+                 maintenance_work_mem=None, max_parallel_maintenance_workers=None, on_executed=None):
+        super().__init__(db.conn_string, jobs, maintenance_work_mem, max_parallel_maintenance_workers,
+                         on_executed)
+        self.db = db
+        self.units = units
+        self.query = READY_TABLES_QUERY
+        self.params = None
+        if subscription_names:
+            self.query += SUBSCRIPTION_FILTER
+            self.params = (list(subscription_names),)
+        self._settings = [unit.statement for unit in units if unit.kind == "setting"]
+        self._groups = {}
+        self._originals = {}
+        for unit in units:
+            rewritten = concurrent_index(unit)
+            if rewritten is not None:
+                # Keep the rewritten unit alive so its id stays unique
+                self._originals[id(rewritten)] = (rewritten, unit)
+                self._groups.setdefault(table_key(unit.table), []).append(rewritten)
+        self._built_early = {id(original) for _, original in self._originals.values()}
+        self._scheduled = set()
+        self._futures = []
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs)
+        # Built during the sync wait, their spans belong to its trace
+        self._parent_span = tracing.current_span()
+
+    def poll(self):
+        with self.db.connection() as conn:
+            ready_tables = conn.execute(self.query, self.params).fetchall()
+        for schema, table in ready_tables:
+            key = (schema, table)
+            if key in self._scheduled or key not in self._groups:
+                continue
+            self._scheduled.add(key)
+            group = self._groups[key]
+            print(f"Table {schema}.{table} is ready, building {len(group)} indexes")
+            self._futures.append(self._executor.submit(self._run_units, group, None))
+
+    def __call__(self, progress=None):
+        try:
+            self.poll()
+        except psycopg.Error as e:
+            print(f"Error {e} while looking for ready tables on host '{self.conn_string}'", file=sys.stderr)
+
+    def wait(self):
+        concurrent.futures.wait(self._futures)
+        self._executor.shutdown()
+        # An interrupted concurrent build leaves an invalid index behind
+        for unit, _ in self._report.failures:
+            if id(unit) in self._originals:
+                _, original = self._originals[id(unit)]
+                schema, _ = split_name(original.table)
+                index_name = _CREATE_INDEX.match(original.statement).group(2)
+                drop = f"DROP INDEX IF EXISTS {schema}.{index_name};" if schema else \
+                    f"DROP INDEX IF EXISTS {index_name};"
+                try:
+                    self._connection().execute(drop)
+                except psycopg.Error as e:
+                    print(f"Error {e} with query '{drop}' on host '{self.conn_string}'", file=sys.stderr)
+        for conn in self._connections:
+            conn.close()
+        self._connections = []
+        self._local = threading.local()
+        return self._report
+
+    def _original(self, unit):
+        return self._originals[id(unit)][1] if id(unit) in self._originals else unit
+
+    def remaining_units(self):
+        """Units still to run, in dump order: all but the indexes built on the ready tables."""
+        failed = {id(self._original(unit)) for unit, _ in self._report.failures}
+        remaining = []
+        for unit in self.units:
+            if unit.kind == "primary_key":
+                continue
+            if (id(unit) not in self._built_early or table_key(unit.table) not in self._scheduled
+                    or id(unit) in failed):
+                remaining.append(unit)
+        return remaining
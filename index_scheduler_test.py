@@ -0,0 +1,83 @@
+import psycopg
+
+from index_scheduler import IncrementalIndexScheduler
+from post_data import parse_units
+
+STATEMENTS = [
+    "SET statement_timeout = 0;",
+    "ALTER TABLE ONLY s.a\n    ADD CONSTRAINT a_pkey PRIMARY KEY (id);",
+    "CREATE INDEX a_name_idx ON s.a USING btree (name);",
+    "CREATE UNIQUE INDEX b_name_idx ON s.b USING btree (name);",
+    "CREATE TRIGGER b_trg AFTER INSERT ON s.b FOR EACH ROW EXECUTE FUNCTION s.f();",
+    "ALTER TABLE ONLY s.a\n    ADD CONSTRAINT a_b_fk FOREIGN KEY (b_id) REFERENCES s.b(id);",
+    "ALTER INDEX s.parent_idx ATTACH PARTITION s.child_idx;",
+    "ALTER TABLE ONLY s.b\n    ADD CONSTRAINT b_code_key UNIQUE (code);",
+    "ALTER TABLE ONLY s.b\n    ADD CONSTRAINT b_check CHECK ((id > 0));",
+]
+
+
+def mocked_secondary(mocker, ready_tables):
+    db = mocker.MagicMock()
+    db.conn_string = "{secondary}"
+    db.connection.return_value.__enter__.return_value.execute.return_value.fetchall.side_effect = ready_tables
+    return db
+
+
+def test_scheduler_builds_ready_tables_concurrently(mocker):
+    executed = []
+    conn = mocker.MagicMock()
+    conn.execute.side_effect = lambda query, params=None: executed.append(query)
+    mocker.patch("psycopg.connect", return_value=conn)
+    db = mocked_secondary(mocker, [[("s", "a")], [("s", "a"), ("s", "b")]])
+    units = [unit for unit in parse_units(STATEMENTS) if unit.kind != "primary_key"]
+    scheduler = IncrementalIndexScheduler(db, units, ["sub_1"], jobs=2)
+
+    scheduler.poll()
+    scheduler.poll()
+    report = scheduler.wait()
+
+    assert report.executed == 2
+    assert "CREATE INDEX CONCURRENTLY a_name_idx ON s.a USING btree (name);" in executed
+    assert "CREATE UNIQUE INDEX CONCURRENTLY b_name_idx ON s.b USING btree (name);" in executed
+    assert "SET statement_timeout = 0;" in executed
+    assert [unit.statement for unit in scheduler.remaining_units()] == [
+        STATEMENTS[0], STATEMENTS[4], STATEMENTS[5], STATEMENTS[6], STATEMENTS[7], STATEMENTS[8]]
+
+
+def test_scheduler_leaves_constraints_and_triggers_to_post_data(mocker):
+    executed = []
+    conn = mocker.MagicMock()
+    conn.execute.side_effect = lambda query, params=None: executed.append(query)
+    mocker.patch("psycopg.connect", return_value=conn)
+    db = mocked_secondary(mocker, [[("s", "b")]])
+    units = [unit for unit in parse_units(STATEMENTS) if unit.kind != "primary_key"]
+    scheduler = IncrementalIndexScheduler(db, units, jobs=1)
+
+    scheduler.poll()
+    scheduler.wait()
+
+    assert STATEMENTS[7] not in executed
+    assert STATEMENTS[4] not in executed
+    assert STATEMENTS[7] in [unit.statement for unit in scheduler.remaining_units()]
+
+
+def test_scheduler_leaves_unready_tables_and_failures(mocker):
+    conn = mocker.MagicMock()
+
+    def execute(query, params=None):
+        if query.startswith("CREATE INDEX CONCURRENTLY"):
+            raise psycopg.Error("<expected error>")
+
+    conn.execute.side_effect = execute
+    mocker.patch("psycopg.connect", return_value=conn)
+    db = mocked_secondary(mocker, [[("s", "a")]])
+    units = [unit for unit in parse_units(STATEMENTS) if unit.kind != "primary_key"]
+    scheduler = IncrementalIndexScheduler(db, units, jobs=1)
+
+    scheduler()
+    scheduler.wait()
+
+    conn.execute.assert_any_call("DROP INDEX IF EXISTS s.a_name_idx;")
+    assert [unit.statement for unit in scheduler.remaining_units()] == [
+        STATEMENTS[0], STATEMENTS[2], STATEMENTS[3], STATEMENTS[4], STATEMENTS[5], STATEMENTS[6], STATEMENTS[7],
+        STATEMENTS[8]]
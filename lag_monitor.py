@@ -0,0 +1,244 @@
+import argparse
+import contextlib
+import dataclasses
+import datetime
+import http.server
+import json
+import sys
+import threading
+import time
+
+import psycopg
+
+from database import Database
+
+SAMPLING_INTERVAL_IN_SECONDS = 1
+METRICS_PREFIX = "pg_logical_replication"
+
+SUBSCRIPTIONS_QUERY = "SELECT subname, subslotname FROM pg_subscription WHERE subname LIKE %s"
+
+# Slots of the subscriptions with their walsender, one row per slot
+PRIMARY_QUERY = """
+    SELECT s.slot_name, s.active,
+           pg_wal_lsn_diff(pg_current_wal_lsn(), s.confirmed_flush_lsn)::bigint,
+           pg_wal_lsn_diff(pg_current_wal_lsn(), s.restart_lsn)::bigint,
+           pg_wal_lsn_diff(s.confirmed_flush_lsn, '0/0')::bigint,
+           extract(epoch FROM r.replay_lag)::float8
+    FROM pg_replication_slots s
+    LEFT JOIN pg_stat_replication r ON r.pid = s.active_pid
+    WHERE s.slot_name = ANY(%s)
+"""
+
+# Apply workers of the subscriptions (table sync workers have a relid)
+SECONDARY_QUERY = """
+    SELECT subname,
+           pg_wal_lsn_diff(received_lsn, '0/0')::bigint,
+           extract(epoch FROM now() - latest_end_time)::float8
+    FROM pg_stat_subscription
+    WHERE relid IS NULL AND subname = ANY(%s)
+"""
+
+
+@dataclasses.dataclass
+class LagSample:
+    subscription: str
+    slot_name: str
+    time: str
+    active: bool = False
+    lag_bytes: int | None = None
+    retained_wal_bytes: int | None = None
+    lag_seconds: float | None = None
+    apply_rate_bytes_per_second: float | None = None
+    received_position: int | None = None
+
+    def metrics(self):
+        labels = {"subscription": self.subscription, "slot": self.slot_name}
+        return [
+            ("slot_active", "Whether the replication slot is in use", labels, int(self.active)),
+            ("lag_bytes", "WAL bytes not yet confirmed by the subscriber", labels, self.lag_bytes),
+            ("retained_wal_bytes", "WAL bytes retained on the primary by the slot", labels,
+             self.retained_wal_bytes),
+            ("lag_seconds", "Replication lag in seconds", labels, self.lag_seconds),
+            ("apply_rate_bytes_per_second", "WAL bytes confirmed by the subscriber per second", labels,
+             self.apply_rate_bytes_per_second),
+        ]
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_prometheus(metrics):
+    """
+    Render (name, help, labels, value) metrics in the Prometheus text format.
+
+    >>> print(format_prometheus([("lag_bytes", "Lag", {"slot": "s1"}, 42)]), end="")
+    # HELP pg_logical_replication_lag_bytes Lag
+    # TYPE pg_logical_replication_lag_bytes gauge
+    pg_logical_replication_lag_bytes{slot="s1"} 42
+    """
+    lines = []
+    described = set()
+    for name, help_text, labels, value in sorted(metrics, key=lambda metric: metric[0]):
+        if value is None:
+            continue
+        full_name = f"{METRICS_PREFIX}_{name}"
+        if full_name not in described:
+            described.add(full_name)
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} gauge")
+        label_str = ",".join(f'{key}="{_escape_label(label)}"' for key, label in labels.items())
+        lines.append(f"{full_name}{{{label_str}}} {value}" if label_str else f"{full_name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class LagMonitor:
+    """
+    Sample replication lag and apply throughput of the subscriptions matching a pattern.
+
+    Each sample is one query on the primary (pg_replication_slots joined with
+    pg_stat_replication) and one on the secondary (pg_stat_subscription), on
+    connections kept open between samples.
+    """
+
+    def __init__(self, primary: Database, secondary: Database, subscription_pattern):
+        self.primary = primary
+        self.secondary = secondary
+        self.subscription_pattern = subscription_pattern
+        self._stack = None
+        self._primary_conn = None
+        self._secondary_conn = None
+        self._slots = {}
+        self._previous = {}
+
+    def __enter__(self):
+        self._stack = contextlib.ExitStack()
+        self._primary_conn = self._stack.enter_context(self.primary.connection())
+        self._secondary_conn = self._stack.enter_context(self.secondary.connection())
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stack.close()
+        self._stack = None
+
+    def refresh_subscriptions(self):
+        rows = self._secondary_conn.execute(SUBSCRIPTIONS_QUERY, (self.subscription_pattern,)).fetchall()
+        self._slots = {slot_name: subscription for subscription, slot_name in rows if slot_name is not None}
+        return self._slots
+
+    def sample(self, now=None):
+        now = time.monotonic() if now is None else now
+        if not self._slots:
+            self.refresh_subscriptions()
+        sample_time = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        slots = self._primary_conn.execute(PRIMARY_QUERY, (list(self._slots),)).fetchall()
+        workers = {subscription: (received, seconds) for subscription, received, seconds in
+                   self._secondary_conn.execute(SECONDARY_QUERY, (list(self._slots.values()),)).fetchall()}
+
+        samples = []
+        for slot_name, active, lag_bytes, retained, confirmed, replay_lag in slots:
+            subscription = self._slots[slot_name]
+            received, since_latest_end = workers.get(subscription, (None, None))
+            lag_seconds = replay_lag
+            if lag_seconds is None and lag_bytes is not None:
+                lag_seconds = 0.0 if lag_bytes <= 0 else since_latest_end
+            rate = None
+            previous = self._previous.get(slot_name)
+            if previous is not None and confirmed is not None and now > previous[0]:
+                rate = max(confirmed - previous[1], 0) / (now - previous[0])
+            if confirmed is not None:
+                self._previous[slot_name] = (now, confirmed)
+            samples.append(LagSample(subscription, slot_name, sample_time, active, lag_bytes, retained,
+                                     lag_seconds, rate, received))
+        return samples
+
+    def run(self, on_samples, interval=SAMPLING_INTERVAL_IN_SECONDS, stop_event=None):
+        stop_event = stop_event or threading.Event()
+        while not stop_event.is_set():
+            start = time.monotonic()
+            try:
+                on_samples(self.sample(start))
+            except psycopg.Error as e:
+                print(f"Error {e} while sampling the replication lag", file=sys.stderr)
+            stop_event.wait(max(interval - (time.monotonic() - start), 0))
+
+
+def write_json_lines(output=sys.stdout):
+    def on_samples(samples):
+        for sample in samples:
+            output.write(json.dumps(dataclasses.asdict(sample)) + "\n")
+        output.flush()
+
+    return on_samples
+
+
+class MetricsServer:
+    """Serve the metrics returned by collect in the Prometheus text format on /metrics."""
+
+    def __init__(self, port, collect):
+        collect_metrics = collect
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = format_prometheus(collect_metrics()).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("", port), Handler)
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main(conn_primary, conn_secondary, subscription_pattern, interval=SAMPLING_INTERVAL_IN_SECONDS,
+         prometheus_port=None):
+    latest = []
+
+    def keep_latest(samples):
+        latest[:] = samples
+
+    server = None
+    on_samples = write_json_lines()
+    if prometheus_port is not None:
+        server = MetricsServer(prometheus_port,
+                               lambda: [metric for sample in latest for metric in sample.metrics()]).start()
+        on_samples = keep_latest
+        print(f"Serving replication lag metrics on :{prometheus_port}/metrics")
+
+    try:
+        with LagMonitor(Database(conn_primary, None), Database(conn_secondary, None), subscription_pattern) as monitor:
+            monitor.run(on_samples, interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server is not None:
+            server.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replication lag and apply throughput of logical subscriptions")
+    parser.add_argument("connection_primary")
+    parser.add_argument("connection_secondary")
+    parser.add_argument("subscription_pattern", help="LIKE pattern of the subscriptions, e.g. subscription_mydb_%%")
+    parser.add_argument("--interval", type=float, default=SAMPLING_INTERVAL_IN_SECONDS)
+    parser.add_argument("--prometheus-port", type=int, default=None,
+                        help="serve metrics in the Prometheus text format instead of writing JSON lines")
+    args = parser.parse_args()
+
+    main(args.connection_primary, args.connection_secondary, args.subscription_pattern, args.interval,
+         args.prometheus_port)
@@ -0,0 +1,63 @@
+import io
+import json
+import urllib.request
+
+from lag_monitor import LagMonitor, LagSample, MetricsServer, format_prometheus, write_json_lines
+
+
+def mocked_monitor(mocker, primary_rows, secondary_rows):
+    primary = mocker.MagicMock()
+    secondary = mocker.MagicMock()
+    primary_conn = primary.connection.return_value.__enter__.return_value
+    secondary_conn = secondary.connection.return_value.__enter__.return_value
+    primary_conn.execute.return_value.fetchall.side_effect = primary_rows
+    secondary_conn.execute.return_value.fetchall.side_effect = secondary_rows
+    return LagMonitor(primary, secondary, "subscription_db_%"), primary_conn
+
+
+def test_sample_computes_lag_and_apply_rate(mocker):
+    monitor, primary_conn = mocked_monitor(
+        mocker,
+        [[("slot_1", True, 1000, 5000, 20000, None)], [("slot_1", True, 0, 4000, 26000, 0.5)]],
+        [[("sub_1", "slot_1")], [("sub_1", 21000, 3.0)], [("sub_1", 26000, 0.1)]])
+
+    with monitor:
+        first = monitor.sample(now=10)
+        second = monitor.sample(now=12)
+
+    assert (first[0].subscription, first[0].lag_bytes, first[0].retained_wal_bytes) == ("sub_1", 1000, 5000)
+    assert first[0].lag_seconds == 3.0
+    assert first[0].apply_rate_bytes_per_second is None
+    assert second[0].lag_seconds == 0.5
+    assert second[0].apply_rate_bytes_per_second == 3000
+    assert primary_conn.execute.call_args.args[1] == (["slot_1"],)
+
+
+def test_format_prometheus_skips_unknown_values():
+    sample = LagSample("sub_1", "slot_1", "2026-01-22T10:01:25+00:00", True, 10, 20, None, None)
+
+    text = format_prometheus(sample.metrics())
+
+    assert 'pg_logical_replication_lag_bytes{subscription="sub_1",slot="slot_1"} 10' in text
+    assert 'pg_logical_replication_slot_active{subscription="sub_1",slot="slot_1"} 1' in text
+    assert "lag_seconds" not in text
+
+
+def test_write_json_lines():
+    output = io.StringIO()
+
+    write_json_lines(output)([LagSample("sub_1", "slot_1", "t", lag_bytes=10)])
+
+    assert json.loads(output.getvalue())["lag_bytes"] == 10
+
+
+def test_metrics_server_serves_prometheus_text():
+    server = MetricsServer(0, lambda: [("lag_bytes", "Lag", {"slot": "s1"}, 42)]).start()
+    try:
+        port = server.server.server_address[1]
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+            body = response.read().decode()
+    finally:
+        server.stop()
+
+    assert 'pg_logical_replication_lag_bytes{slot="s1"} 42' in body
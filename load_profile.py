@@ -0,0 +1,177 @@
+import dataclasses
+import queue
+import sys
+import threading
+import time
+
+import psycopg
+
+from database import Database
+from index_scheduler import READY_TABLES_QUERY, SUBSCRIPTION_FILTER
+from publication import batches
+
+VACUUM_JOBS = 4
+
+RELOPTIONS_QUERY = """
+SELECT n.nspname, c.relname, c.reloptions, t.reloptions, c.reltoastrelid <> 0
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+LEFT JOIN pg_class t ON t.oid = c.reltoastrelid
+WHERE c.relkind = 'r' AND (n.nspname, c.relname) IN ({tables})
+"""
+RELOPTIONS_BATCH_SIZE = 500
+# Sorted after every table, stops a worker once the queue is drained
+_STOP = (float("inf"), ())
+
+
+def autovacuum_setting(reloptions):
+    """
+    >>> autovacuum_setting(["fillfactor=90", "autovacuum_enabled=false"])
+    'false'
+    >>> autovacuum_setting(None) is None
+    True
+    """
+    for option in reloptions or []:
+        name, _, value = option.partition("=")
+        if name == "autovacuum_enabled":
+            return value
+    return None
+
+
+def restore_statement(schema, table, saved):
+    """
+    Statement giving back a table the autovacuum settings it had before the load.
+
+    >>> restore_statement("s", "t", [None, "false", True])
+    'ALTER TABLE s.t RESET (autovacuum_enabled), SET (toast.autovacuum_enabled = false);'
+    """
+    table_setting, toast_setting, has_toast = saved
+    actions = [f"SET (autovacuum_enabled = {table_setting})" if table_setting is not None
+               else "RESET (autovacuum_enabled)"]
+    if has_toast:
+        actions.append(f"SET (toast.autovacuum_enabled = {toast_setting})" if toast_setting is not None
+                       else "RESET (toast.autovacuum_enabled)")
+    return f"ALTER TABLE {schema}.{table} {', '.join(actions)};"
+
+
+@dataclasses.dataclass
+class VacuumReport:
+    vacuumed: int = 0
+    duration: float = 0
+    failures: list = dataclasses.field(default_factory=list)
+
+
+class BulkLoadProfile:
+    """
+    Target-side settings for the initial copy of the tables.
+
+    disable turns autovacuum off on the copied tables and returns their
+    previous settings, to be saved so a restart can still restore them. Call
+    poll (or the instance itself, as an on_progress callback) while the
+    initial sync runs: tables newly in the 'r' state get their settings back
+    and a VACUUM (ANALYZE), largest tables first, on jobs connections.
+    on_vacuumed is called with the (schema, table) of each table vacuumed.
+    """
+
+    def __init__(self, db: Database, table_sizes: dict, subscription_names=None, jobs=VACUUM_JOBS, saved=None,
+                 done=(), on_vacuumed=None):
+        self.db = db
+        self.table_sizes = table_sizes
+        self.jobs = max(jobs, 1)
+        # "schema.table" -> [autovacuum_enabled, toast.autovacuum_enabled, has a toast table] before the load
+        self.saved = dict(saved or {})
+        self.on_vacuumed = on_vacuumed
+        self.query = READY_TABLES_QUERY
+        self.params = None
+        if subscription_names:
+            self.query += SUBSCRIPTION_FILTER
+            self.params = (list(subscription_names),)
+        self._ready = set(tuple(key) for key in done)
+        self._queue = queue.PriorityQueue()
+        self._workers = []
+        self._report = VacuumReport()
+        self._report_lock = threading.Lock()
+        self._start = time.monotonic()
+
+    def disable(self):
+        tables = list(self.table_sizes)
+        for batch in batches(tables, RELOPTIONS_BATCH_SIZE):
+            keys = ", ".join(f"('{schema}', '{table}')" for schema, table in batch)
+            for schema, table, reloptions, toast_reloptions, has_toast in \
+                    self.db.execute_query(RELOPTIONS_QUERY.format(tables=keys)) or []:
+                self.saved.setdefault(f"{schema}.{table}", [autovacuum_setting(reloptions),
+                                                            autovacuum_setting(toast_reloptions), has_toast])
+        for key, (_, _, has_toast) in self.saved.items():
+            options = "autovacuum_enabled = false, toast.autovacuum_enabled = false" if has_toast else \
+                "autovacuum_enabled = false"
+            self.db.execute_query(f"ALTER TABLE {key} SET ({options});", fetch=False)
+        print(f"Autovacuum disabled on {len(self.saved)} tables during the initial copy")
+        return self.saved
+
+    def restore(self, schema, table):
+        saved = self.saved.get(f"{schema}.{table}")
+        if saved is not None:
+            self.db.execute_query(restore_statement(schema, table, saved), fetch=False)
+
+    def poll(self):
+        with self.db.connection() as conn:
+            ready_tables = conn.execute(self.query, self.params).fetchall()
+        for schema, table in ready_tables:
+            key = (schema, table)
+            if key in self._ready:
+                continue
+            self._ready.add(key)
+            self.restore(schema, table)
+            self._queue.put((-(self.table_sizes.get(key) or 0), key))
+        # Started once the tables of this poll are queued, so the largest ones go first
+        while len(self._workers) < min(self.jobs, len(self._ready)):
+            worker = threading.Thread(target=self._vacuum_worker, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def __call__(self, progress=None):
+        try:
+            self.poll()
+        except psycopg.Error as e:
+            print(f"Error {e} while looking for ready tables on host '{self.db.conn_string}'", file=sys.stderr)
+
+    def _vacuum_worker(self):
+        conn = None
+        try:
+            while True:
+                _, key = self._queue.get()
+                if not key:
+                    return
+                schema, table = key
+                statement = f"VACUUM (ANALYZE) {schema}.{table};"
+                try:
+                    if conn is None:
+                        conn = psycopg.connect(self.db.conn_string, autocommit=True)
+                    conn.execute(statement)
+                    with self._report_lock:
+                        self._report.vacuumed += 1
+                    if self.on_vacuumed is not None:
+                        self.on_vacuumed(key)
+                except psycopg.Error as e:
+                    print(f"Error {e} with query '{statement}' on host '{self.db.conn_string}'", file=sys.stderr)
+                    with self._report_lock:
+                        self._report.failures.append((key, str(e)))
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def wait(self) -> VacuumReport:
+        """Wait for the vacuums of the ready tables, and give every other table its settings back."""
+        for _ in self._workers:
+            self._queue.put(_STOP)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        for key in self.saved:
+            schema, _, table = key.partition(".")
+            if (schema, table) not in self._ready:
+                self.restore(schema, table)
+        self._report.duration = time.monotonic() - self._start
+        print(f"VACUUM (ANALYZE) : {self._report.vacuumed} tables in {self._report.duration:.3f}s, "
+              f"{len(self._report.failures)} errors")
+        return self._report
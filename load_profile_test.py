@@ -0,0 +1,60 @@
+from load_profile import BulkLoadProfile
+
+
+def mocked_secondary(mocker, ready_tables, reloptions=None):
+    db = mocker.MagicMock()
+    db.conn_string = "{secondary}"
+    db.execute_query.return_value = reloptions
+    db.connection.return_value.__enter__.return_value.execute.return_value.fetchall.side_effect = ready_tables
+    return db
+
+
+def test_disable_saves_the_previous_settings(mocker):
+    db = mocked_secondary(mocker, [], [("s", "a", ["autovacuum_enabled=true"], None, True),
+                                       ("s", "b", None, None, False)])
+    profile = BulkLoadProfile(db, {("s", "a"): 10, ("s", "b"): 20})
+
+    saved = profile.disable()
+
+    assert saved == {"s.a": ["true", None, True], "s.b": [None, None, False]}
+    db.execute_query.assert_any_call(
+        "ALTER TABLE s.a SET (autovacuum_enabled = false, toast.autovacuum_enabled = false);", fetch=False)
+    db.execute_query.assert_any_call("ALTER TABLE s.b SET (autovacuum_enabled = false);", fetch=False)
+
+
+def test_ready_tables_are_restored_and_vacuumed_largest_first(mocker):
+    executed = []
+    conn = mocker.MagicMock()
+    conn.execute.side_effect = lambda query, params=None: executed.append(query)
+    mocker.patch("psycopg.connect", return_value=conn)
+    db = mocked_secondary(mocker, [[("s", "a"), ("s", "b")], [("s", "a"), ("s", "b")]])
+    vacuumed = []
+    profile = BulkLoadProfile(db, {("s", "a"): 10, ("s", "b"): 20, ("s", "c"): 30}, ["sub_1"], jobs=1,
+                              saved={"s.a": [None, None, False], "s.b": ["true", None, False],
+                                     "s.c": [None, None, False]},
+                              on_vacuumed=vacuumed.append)
+
+    profile.poll()
+    profile.poll()
+    report = profile.wait()
+
+    assert executed == ["VACUUM (ANALYZE) s.b;", "VACUUM (ANALYZE) s.a;"]
+    assert vacuumed == [("s", "b"), ("s", "a")]
+    assert report.vacuumed == 2
+    restored = [call.args[0] for call in db.execute_query.call_args_list]
+    assert restored == ["ALTER TABLE s.a RESET (autovacuum_enabled);",
+                        "ALTER TABLE s.b SET (autovacuum_enabled = true);",
+                        "ALTER TABLE s.c RESET (autovacuum_enabled);"]
+
+
+def test_done_tables_are_not_vacuumed_again(mocker):
+    connect = mocker.patch("psycopg.connect")
+    db = mocked_secondary(mocker, [[("s", "a")]])
+    profile = BulkLoadProfile(db, {("s", "a"): 10}, saved={"s.a": [None, None, False]}, done=[["s", "a"]])
+
+    profile()
+    report = profile.wait()
+
+    connect.assert_not_called()
+    db.execute_query.assert_not_called()
+    assert report.vacuumed == 0
@@ -0,0 +1,155 @@
+import dataclasses
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from typing import Callable
+
+import tracing
+
+PHASES = ("roles", "grants", "replica_identity", "pre_data", "primary_keys", "publication", "load_profile",
+          "snapshot_copy", "subscription", "sync_wait", "post_data", "enable")
+# Items are marked done often, the state file is rewritten at most this often meanwhile
+SAVE_INTERVAL_IN_SECONDS = 5
+
+
+def item_key(statement):
+    """
+    Short stable key of a statement, used to record it as done.
+
+    >>> item_key("CREATE INDEX idx ON s.t USING btree (a);")
+    '7921748c6bc6c6ee'
+    """
+    return hashlib.sha1(statement.encode()).hexdigest()[:16]
+
+
+@dataclasses.dataclass
+class MigrationState:
+    unique_name: str
+    db_primary: str
+    db_secondary: str
+    completed: list = dataclasses.field(default_factory=list)
+    # Objects done inside a phase, by phase
+    items: dict = dataclasses.field(default_factory=dict)
+    # Number of statements committed inside a phase, by phase
+    positions: dict = dataclasses.field(default_factory=dict)
+    # Decisions taken by the phases that a restart must reuse
+    data: dict = dataclasses.field(default_factory=dict)
+    # Seconds spent in each phase, summed over restarts
+    durations: dict = dataclasses.field(default_factory=dict)
+
+    def is_completed(self, phase):
+        return phase in self.completed
+
+    def done_items(self, phase):
+        return set(self.items.get(phase, ()))
+
+    def position(self, phase):
+        return self.positions.get(phase, 0)
+
+
+class MigrationStore:
+    """Migration state as a JSON file replaced atomically on each save, only kept in memory without a path."""
+
+    def __init__(self, path=None):
+        self.path = path
+
+    def load(self) -> MigrationState | None:
+        if self.path is None or not os.path.exists(self.path):
+            return None
+        with open(self.path) as state_file:
+            return MigrationState(**json.load(state_file))
+
+    def save(self, state: MigrationState):
+        if self.path is None:
+            return
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "w") as state_file:
+            json.dump(dataclasses.asdict(state), state_file, indent=2)
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        os.replace(temporary_path, self.path)
+
+
+@dataclasses.dataclass
+class Phase:
+    name: str
+    run: Callable
+    # Returns True when the target already has the result of the phase
+    done: Callable | None = None
+
+
+class Migration:
+    """
+    Run the phases of a migration in order, continuing from the last completed one.
+
+    A phase is recorded as completed once run returns, unless it returns
+    False to stop the migration. Phases record the objects they finish with
+    mark_item and set_position, so a restarted phase skips them.
+    """
+
+    def __init__(self, state: MigrationState, store: MigrationStore = None,
+                 save_interval=SAVE_INTERVAL_IN_SECONDS):
+        self.state = state
+        self.store = store or MigrationStore()
+        self.save_interval = save_interval
+        self._lock = threading.Lock()
+        self._saved_at = time.monotonic()
+
+    def run(self, phases) -> bool:
+        for phase in phases:
+            if self.state.is_completed(phase.name):
+                print(f"Phase {phase.name} already completed")
+                continue
+            if phase.done is not None and phase.done():
+                print(f"Phase {phase.name} already done on the target")
+                self.complete(phase.name)
+                continue
+            print(f"Phase {phase.name} started")
+            start = time.monotonic()
+            try:
+                with tracing.span("phase", phase=phase.name, unique_name=self.state.unique_name) as span:
+                    result = phase.run()
+                    span.set(stopped=result is False)
+            finally:
+                duration = time.monotonic() - start
+                self.state.durations[phase.name] = self.state.durations.get(phase.name, 0) + duration
+                print(f"Phase {phase.name} took {duration:.3f}s")
+                self.flush()
+            if result is False:
+                print(f"Phase {phase.name} stopped the migration", file=sys.stderr)
+                return False
+            self.complete(phase.name)
+        return True
+
+    def complete(self, phase):
+        with self._lock:
+            if phase not in self.state.completed:
+                self.state.completed.append(phase)
+            self._save()
+
+    def mark_item(self, phase, item):
+        with self._lock:
+            self.state.items.setdefault(phase, []).append(item)
+            if time.monotonic() - self._saved_at >= self.save_interval:
+                self._save()
+
+    def set_position(self, phase, position):
+        with self._lock:
+            self.state.positions[phase] = position
+            self._save()
+
+    def record(self, key, value):
+        with self._lock:
+            self.state.data[key] = value
+            self._save()
+
+    def flush(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        self.store.save(self.state)
+        self._saved_at = time.monotonic()
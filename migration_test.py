@@ -0,0 +1,100 @@
+import io
+import json
+
+from migration import Migration, MigrationState, MigrationStore, Phase
+from primary import DbInfos, TableInventory
+from replication_start import ReplicationContext, ReplicationOptions, replication_phases
+
+
+def replication_context(migration, **kwargs):
+    return ReplicationContext("host=pg1", "db", "host=pg2", "db", ReplicationOptions(), migration, **kwargs)
+
+
+def phase(ctx, name):
+    return next(phase for phase in replication_phases(ctx) if phase.name == name)
+
+
+def test_migration_runs_remaining_phases_and_records_them(tmp_path):
+    store = MigrationStore(str(tmp_path / "state.json"))
+    state = MigrationState("db_20260122_100125", "db", "db", completed=["roles"])
+    executed = []
+    phases = [
+        Phase("roles", lambda: executed.append("roles")),
+        Phase("grants", lambda: executed.append("grants"), done=lambda: True),
+        Phase("pre_data", lambda: executed.append("pre_data")),
+    ]
+
+    assert Migration(state, store).run(phases)
+
+    assert executed == ["pre_data"]
+    with open(store.path) as state_file:
+        assert json.load(state_file)["completed"] == ["roles", "grants", "pre_data"]
+
+
+def test_migration_stops_on_a_phase_returning_false():
+    state = MigrationState("db_20260122_100125", "db", "db")
+    phases = [Phase("sync_wait", lambda: False), Phase("post_data", lambda: None)]
+
+    assert not Migration(state).run(phases)
+
+    assert state.completed == []
+
+
+def test_migration_restart_keeps_unique_name_items_and_positions(tmp_path):
+    store = MigrationStore(str(tmp_path / "state.json"))
+    migration = Migration(MigrationState("db_20260122_100125", "db", "db"), store, save_interval=3600)
+
+    def interrupted_phase():
+        migration.set_position("pre_data", 1000)
+        migration.mark_item("post_data", "7921748c6bc6c6ee")
+        raise KeyboardInterrupt
+
+    try:
+        migration.run([Phase("pre_data", interrupted_phase)])
+    except KeyboardInterrupt:
+        pass
+
+    state = MigrationStore(store.path).load()
+    assert state.unique_name == "db_20260122_100125"
+    assert state.position("pre_data") == 1000
+    assert state.done_items("post_data") == {"7921748c6bc6c6ee"}
+    assert not state.is_completed("pre_data")
+
+
+def test_memory_store_has_no_state():
+    store = MigrationStore()
+    store.save(MigrationState("db_20260122_100125", "db", "db"))
+
+    assert store.load() is None
+
+
+def test_migration_records_phase_durations():
+    state = MigrationState("db_20260122_100125", "db", "db")
+
+    Migration(state).run([Phase("roles", lambda: None), Phase("grants", lambda: None)])
+
+    assert set(state.durations) == {"roles", "grants"}
+
+
+def test_failing_pre_data_dump_leaves_the_phase_to_do(mocker):
+    migration = Migration(MigrationState("db_20260122_100125", "db", "db"))
+    ctx = replication_context(migration, db_infos=DbInfos(["s"], "1 MB", 0, "", TableInventory()))
+    dump = mocker.MagicMock(stdout=io.StringIO(""), returncode=1)
+    mocker.patch("subprocess.Popen", return_value=dump)
+    mocker.patch("psycopg.connect")
+
+    assert not migration.run([phase(ctx, "pre_data")])
+
+    assert migration.state.completed == []
+
+
+def test_failing_archive_restore_leaves_the_phase_to_do(mocker):
+    migration = Migration(MigrationState("db_20260122_100125", "db", "db"))
+    archive = mocker.MagicMock()
+    archive.restore_pre_data.return_value = True
+    archive.restore_primary_keys.return_value = False
+    ctx = replication_context(migration, archive=archive)
+
+    assert not migration.run([phase(ctx, "pre_data"), phase(ctx, "primary_keys")])
+
+    assert migration.state.completed == ["pre_data"]
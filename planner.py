@@ -0,0 +1,294 @@
+import argparse
+import dataclasses
+import datetime
+import json
+import statistics
+import subprocess
+import sys
+
+from psycopg.conninfo import conninfo_to_dict, make_conninfo
+
+import replication_start
+import sql_stream
+from database import Database
+from migration import Migration, MigrationState
+from primary import DbInfos, Primary
+from publication import publication_queries
+from replica_identity import ReplicaIdentityAnalyzer
+from replication_start import ReplicationContext, ReplicationOptions
+
+# Work done per second by each phase when no past run is available: statements for
+# pre_data, table bytes for primary_keys and sync_wait, table bytes scanned by each
+# index build or foreign key validation and per job for post_data
+DEFAULT_RATES = {
+    "pre_data": 100,
+    "primary_keys": 64 * 1024 * 1024,
+    "sync_wait": 32 * 1024 * 1024,
+    "post_data": 64 * 1024 * 1024,
+}
+WORK_UNITS = {"pre_data": "statements", "primary_keys": "bytes", "sync_wait": "bytes", "post_data": "bytes"}
+
+TABLE_COSTS_QUERY = """
+SELECT n.nspname, c.relname, pg_table_size(c.oid),
+       count(i.indexrelid) FILTER (WHERE NOT i.indisprimary),
+       coalesce(sum(pg_relation_size(i.indexrelid)) FILTER (WHERE NOT i.indisprimary), 0),
+       bool_or(coalesce(i.indisprimary, false)),
+       (SELECT count(*) FROM pg_constraint con WHERE con.conrelid = c.oid AND con.contype = 'f')
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+LEFT JOIN pg_index i ON i.indrelid = c.oid
+WHERE c.relkind = 'r' AND n.nspname IN ({schemas}) AND c.relname <> 'spatial_ref_sys'
+GROUP BY n.nspname, c.relname, c.oid
+"""
+
+
+@dataclasses.dataclass
+class TableCost:
+    schema: str
+    name: str
+    bytes: int
+    indexes: int = 0
+    index_bytes: int = 0
+    has_primary_key: bool = False
+    foreign_keys: int = 0
+
+    @property
+    def index_work(self):
+        # Each index build scans the table
+        return self.bytes * self.indexes
+
+    @property
+    def foreign_key_work(self):
+        # Each foreign key validation scans the table
+        return self.bytes * self.foreign_keys
+
+
+def read_only_conninfo(conn_string):
+    """
+    The connection string with transactions read-only by default.
+
+    >>> conninfo_to_dict(read_only_conninfo("host=pg1 options='-c work_mem=64MB'"))["options"]
+    '-c work_mem=64MB -c default_transaction_read_only=on'
+    """
+    params = conninfo_to_dict(conn_string)
+    options = params.get("options")
+    params["options"] = f"{options} -c default_transaction_read_only=on" if options else \
+        "-c default_transaction_read_only=on"
+    return make_conninfo(**params)
+
+
+def table_costs(db: Database, db_schemas) -> list:
+    if not db_schemas:
+        return []
+    schemas = ", ".join(f"'{schema}'" for schema in db_schemas)
+    results = db.execute_query(TABLE_COSTS_QUERY.format(schemas=schemas)) or []
+    return [TableCost(schema, name, size or 0, indexes, index_bytes or 0, bool(has_primary_key), foreign_keys)
+            for schema, name, size, indexes, index_bytes, has_primary_key, foreign_keys in results]
+
+
+def count_pre_data_statements(conn_string, db_schemas):
+    dump = subprocess.Popen(replication_start.pre_data_command(conn_string, db_schemas), stdout=subprocess.PIPE,
+                            text=True)
+    try:
+        return sum(1 for statement in sql_stream.statements(dump.stdout)
+                   if replication_start.is_restored_pre_data(statement))
+    finally:
+        dump.stdout.close()
+        dump.wait()
+
+
+def phase_work(costs, pre_data_statements):
+    """
+    Work of each phase, in the units of WORK_UNITS.
+
+    >>> phase_work([TableCost("s", "a", 100, indexes=2, has_primary_key=True, foreign_keys=1),
+    ...             TableCost("s", "b", 50)], 10)
+    {'pre_data': 10, 'primary_keys': 100, 'sync_wait': 150, 'post_data': 300}
+    """
+    return {
+        "pre_data": pre_data_statements,
+        "primary_keys": sum(cost.bytes for cost in costs if cost.has_primary_key),
+        "sync_wait": sum(cost.bytes for cost in costs),
+        "post_data": sum(cost.index_work + cost.foreign_key_work for cost in costs),
+    }
+
+
+def calibrate(paths, defaults=None):
+    """
+    Rates of each phase from past runs, JSON lines with the work and the durations
+    of their phases as written by benchmark.py. The median of the runs is kept.
+    """
+    samples = {}
+    for path in paths:
+        try:
+            with open(path) as history:
+                lines = history.readlines()
+        except OSError as e:
+            print(f"Error {e} reading history {path}", file=sys.stderr)
+            continue
+        for line in lines:
+            if not line.strip():
+                continue
+            run = json.loads(line)
+            work = run.get("work") or {}
+            phases = run.get("phases") or {}
+            jobs = max((run.get("options") or {}).get("post_data_jobs") or 1, 1)
+            for phase in DEFAULT_RATES:
+                if work.get(phase) and phases.get(phase):
+                    # post_data work is shared by its jobs
+                    rate = work[phase] / phases[phase] / (jobs if phase == "post_data" else 1)
+                    samples.setdefault(phase, []).append(rate)
+    rates = dict(defaults or DEFAULT_RATES)
+    rates.update({phase: statistics.median(values) for phase, values in samples.items()})
+    return rates
+
+
+def estimate(costs, work, rates, options: ReplicationOptions):
+    """Seconds of each phase, and of the window the subscriptions stay disabled."""
+    jobs = max(options.post_data_jobs, 1)
+    durations = {phase: work[phase] / rates[phase] for phase in ("pre_data", "primary_keys", "sync_wait")}
+    # The largest table builds its indexes on one connection whatever the number of jobs
+    largest = max((cost.index_work + cost.foreign_key_work for cost in costs), default=0)
+    durations["post_data"] = max(work["post_data"] / jobs, largest) / rates["post_data"]
+    if options.deferred_indexes:
+        # Secondary indexes are built during the initial copy, only foreign keys wait for the disabled window
+        foreign_key_work = sum(cost.foreign_key_work for cost in costs)
+        window = max(foreign_key_work / jobs, max((cost.foreign_key_work for cost in costs), default=0))
+        durations["disabled_window"] = window / rates["post_data"]
+    else:
+        durations["disabled_window"] = durations["post_data"]
+    return durations
+
+
+@dataclasses.dataclass
+class Plan:
+    db_infos: DbInfos
+    costs: list
+    work: dict
+    durations: dict
+    # (phase, statement or command) in execution order
+    steps: list = dataclasses.field(default_factory=list)
+
+    @property
+    def total(self):
+        return sum(duration for phase, duration in self.durations.items() if phase != "disabled_window")
+
+
+def plan_steps(ctx: ReplicationContext, pre_data_statements, identity_fixes=()):
+    options = ctx.options
+    steps = [("roles", replication_start.create_role_query("********"))]
+    steps += [("grants", replication_start.grant_query(schema)) for schema in ctx.db_schemas]
+    steps += [("replica_identity", statement) for statement in identity_fixes]
+    steps.append(("pre_data", " ".join(replication_start.pre_data_command("<primary>", ctx.db_schemas))))
+    batch_size = max(options.pre_data_batch_size, 1)
+    batches = -(-pre_data_statements // batch_size)
+    steps.append(("pre_data", f"{pre_data_statements} statements committed in {batches} batches of {batch_size}"))
+
+    dump_post = ctx.post_data()
+    steps += [("primary_keys", unit.statement) for unit in dump_post.primary_keys()]
+
+    whole_schemas = replication_start.publication_whole_schemas(ctx.db_infos, options)
+    shards = ctx.shards()
+    for shard in shards:
+        publication_name = f"publication_{ctx.unique_name}{shard.suffix(options.shards)}"
+        for kind, query, tables in publication_queries(publication_name, shard.tables, whole_schemas,
+                                                       options.publication_batch_size):
+            steps.append(("publication", query))
+    if options.load_profile:
+        tables = sum(len(shard.tables) for shard in shards)
+        steps.append(("load_profile", f"ALTER TABLE ... SET (autovacuum_enabled = false) on {tables} tables, "
+                                      f"then VACUUM (ANALYZE) each ready table on {options.vacuum_jobs} jobs"))
+    for shard in shards:
+        suffix = shard.suffix(options.shards)
+        subscription_name = f"subscription_{ctx.unique_name}{suffix}"
+        if options.initial_copy == "snapshot":
+            steps.append(("snapshot_copy", f"CREATE_REPLICATION_SLOT \"{subscription_name}\" LOGICAL pgoutput "
+                                           f"EXPORT_SNAPSHOT, then pg_dump/pg_restore -j {options.restore_jobs} "
+                                           f"of {len(shard.tables)} tables"))
+        steps.append(("subscription", replication_start.subscription_query(
+            subscription_name, "********", f"publication_{ctx.unique_name}{suffix}", options.initial_copy)))
+
+    for shard in shards:
+        steps.append(("post_data", f"ALTER SUBSCRIPTION subscription_{ctx.unique_name}"
+                                   f"{shard.suffix(options.shards)} DISABLE;"))
+    steps += [("post_data", unit.statement) for unit in dump_post.without_primary_keys()]
+    for shard in shards:
+        steps.append(("enable", f"ALTER SUBSCRIPTION subscription_{ctx.unique_name}"
+                                f"{shard.suffix(options.shards)} ENABLE;"))
+    return steps
+
+
+def build_plan(conn_primary, db_primary, db_secondary, list_schema_excluded, options: ReplicationOptions = None,
+               rates=None):
+    """Collect the costs of a migration and the statements it would run, without writing anything."""
+    options = options or ReplicationOptions()
+    rates = rates or DEFAULT_RATES
+    conn_primary = read_only_conninfo(conn_primary)
+    db_infos = Primary(Database(conn_primary, db_primary)).retrieve_db_infos(list_schema_excluded)
+    costs = table_costs(Database(conn_primary, db_primary), db_infos.db_schemas)
+    pre_data_statements = count_pre_data_statements(conn_primary, db_infos.db_schemas or [])
+    identity_fixes = []
+    if options.replica_identity != "off":
+        analyzer = ReplicaIdentityAnalyzer(Primary(Database(conn_primary, db_primary)),
+                                           options.hotspot_bytes_per_second)
+        tables = analyzer.analyze(db_infos.db_schemas)
+        analyzer.report(tables)
+        if options.replica_identity == "fix":
+            identity_fixes = [table.fix() for table in analyzer.flagged(tables) if table.fix() is not None]
+    work = phase_work(costs, pre_data_statements)
+
+    date_start = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    # The state stays in memory, nothing is recorded
+    ctx = ReplicationContext(conn_primary, db_primary, None, db_secondary, options,
+                             Migration(MigrationState(f"{db_primary}_{date_start}", db_primary, db_secondary)),
+                             db_infos=db_infos)
+    return Plan(db_infos, costs, work, estimate(costs, work, rates, options), plan_steps(ctx, pre_data_statements, identity_fixes))
+
+
+def format_duration(seconds):
+    return str(datetime.timedelta(seconds=round(seconds)))
+
+
+def print_plan(plan: Plan, output=sys.stdout):
+    print(f"db_schemas : {plan.db_infos.db_schemas}", file=output)
+    print(f"db_size : {plan.db_infos.db_size}", file=output)
+    print(f"db_tables : {plan.db_infos.db_tables}", file=output)
+    print(f"indexes : {sum(cost.indexes for cost in plan.costs)} "
+          f"({sum(cost.index_bytes for cost in plan.costs)} bytes), "
+          f"foreign keys : {sum(cost.foreign_keys for cost in plan.costs)}", file=output)
+    print("", file=output)
+    for phase, duration in plan.durations.items():
+        work = f"{plan.work[phase]} {WORK_UNITS[phase]}" if phase in plan.work else ""
+        print(f"{phase:<16} {work:<28} {format_duration(duration)}", file=output)
+    print(f"{'total':<16} {'':<28} {format_duration(plan.total)}", file=output)
+    print("", file=output)
+    for phase, step in plan.steps:
+        print(f"[{phase}] {step}", file=output)
+
+
+def main(conn_primary, db_primary, db_secondary, list_schema_excluded, options=None, history=()):
+    plan = build_plan(conn_primary, db_primary, db_secondary, list_schema_excluded, options, calibrate(history))
+    print_plan(plan)
+    return plan
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Print the statements and the estimated duration of a replication, "
+                                                 "without writing anything")
+    parser.add_argument("conn_primary")
+    parser.add_argument("db_primary")
+    parser.add_argument("db_secondary", nargs="?")
+    parser.add_argument("schema_excluded_list", nargs="?")
+    parser.add_argument("--history", action="append", default=[],
+                        help="JSON lines of past runs calibrating the rates, as written by benchmark.py")
+    parser.add_argument("--post-data-jobs", type=int, default=1)
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--deferred-indexes", action="store_true")
+    parser.add_argument("--initial-copy", choices=("subscription", "snapshot"), default="subscription")
+    args = parser.parse_args()
+
+    main(args.conn_primary, args.db_primary, args.db_secondary or args.db_primary,
+         args.schema_excluded_list.split(",") if args.schema_excluded_list else None,
+         ReplicationOptions(post_data_jobs=args.post_data_jobs, shards=args.shards,
+                            deferred_indexes=args.deferred_indexes, initial_copy=args.initial_copy),
+         args.history)
@@ -0,0 +1,56 @@
+import json
+
+from planner import DEFAULT_RATES, TableCost, calibrate, estimate, phase_work, plan_steps
+from migration import Migration, MigrationState
+from post_data import PostData
+from primary import DbInfos, TableInventory
+from replication_start import ReplicationContext, ReplicationOptions
+
+
+def test_calibrate_keeps_the_median_of_past_runs(tmp_path):
+    history = tmp_path / "benchmark_results.jsonl"
+    runs = [{"work": {"sync_wait": 1000, "post_data": 4000}, "phases": {"sync_wait": seconds, "post_data": 1},
+             "options": {"post_data_jobs": 4}} for seconds in (1, 2, 10)]
+    history.write_text("".join(json.dumps(run) + "\n" for run in runs))
+
+    rates = calibrate([str(history)])
+
+    assert rates["sync_wait"] == 500
+    assert rates["post_data"] == 1000
+    assert rates["pre_data"] == DEFAULT_RATES["pre_data"]
+
+
+def test_estimate_post_data_is_bound_by_the_largest_table():
+    costs = [TableCost("s", "big", 1000, indexes=3), TableCost("s", "small", 100, indexes=1, foreign_keys=1)]
+    rates = {"pre_data": 10, "primary_keys": 100, "sync_wait": 100, "post_data": 100}
+    work = phase_work(costs, 20)
+
+    durations = estimate(costs, work, rates, ReplicationOptions(post_data_jobs=8))
+
+    assert durations["pre_data"] == 2
+    assert durations["post_data"] == 30
+    assert durations["disabled_window"] == 30
+    deferred = estimate(costs, work, rates, ReplicationOptions(post_data_jobs=8, deferred_indexes=True))
+    assert deferred["disabled_window"] == 1
+
+
+def test_plan_steps_in_execution_order(mocker):
+    tables = TableInventory()
+    tables.append("s", "a", 1, "r", 100, 200, 10, "d", True)
+    tables.append("s", "b", 2, "r", 50, 100, 10, "d", True)
+    ctx = ReplicationContext("host=pg1", "db", None, "db", ReplicationOptions(publication_batch_size=1),
+                             Migration(MigrationState("db_20260122_100125", "db", "db")),
+                             db_infos=DbInfos(["s"], "1 MB", 2, "", tables))
+    mocker.patch.object(ctx, "post_data", return_value=PostData.parse([
+        "ALTER TABLE ONLY s.a\n    ADD CONSTRAINT a_pkey PRIMARY KEY (id);",
+        "CREATE INDEX b_idx ON s.b USING btree (a);",
+    ]))
+
+    steps = plan_steps(ctx, 1500)
+
+    assert [phase for phase, _ in steps] == ["roles", "grants", "pre_data", "pre_data", "primary_keys",
+                                             "publication", "publication", "subscription", "post_data",
+                                             "post_data", "enable"]
+    assert steps[3][1] == "1500 statements committed in 2 batches of 1000"
+    assert "PASSWORD '********'" in steps[0][1]
+    assert steps[-1][1] == "ALTER SUBSCRIPTION subscription_db_20260122_100125 ENABLE;"
@@ -0,0 +1,330 @@
+import concurrent.futures
+import dataclasses
+import re
+import sys
+import threading
+import time
+
+import psycopg
+
+import sql_stream
+import tracing
+
+POST_DATA_JOBS = 4
+
+# Optionally quoted, optionally schema-qualified relation name
+_NAME = r'(?:"(?:[^"]|"")+"|[^\s.(")]+)(?:\.(?:"(?:[^"]|"")+"|[^\s.(")]+))?'
+
+# Statement type read from its first keywords, a single pattern then parses each type
+_HEAD = re.compile(r"(SET|SELECT|ALTER|CREATE)\s+(?:OR\s+REPLACE\s+|UNIQUE\s+|CONSTRAINT\s+)?(\w+)", re.IGNORECASE)
+_SETTING = re.compile(r"(?:SET\s|SELECT\s+pg_catalog\.set_config\s*\()", re.IGNORECASE)
+_ALTER_TABLE = re.compile(rf"ALTER\s+TABLE\s+(?:ONLY\s+)?({_NAME})\s+(.*)", re.IGNORECASE | re.DOTALL)
+_CONSTRAINT = re.compile(rf"ADD\s+CONSTRAINT\s+\S+\s+(?:(?P<primary_key>PRIMARY\s+KEY\b)|(?P<unique>UNIQUE\b)"
+                         rf"|(?P<foreign_key>FOREIGN\s+KEY\b.*?\bREFERENCES\s+(?P<referenced>{_NAME})))?",
+                         re.IGNORECASE | re.DOTALL)
+_CREATE = {
+    "INDEX": ("index", re.compile(rf"CREATE\s+(?:UNIQUE\s+)?INDEX\s+\S+\s+ON\s+(?:ONLY\s+)?({_NAME})", re.IGNORECASE)),
+    "TRIGGER": ("trigger", re.compile(rf"CREATE\s+(?:CONSTRAINT\s+)?TRIGGER\s+\S+\s.*?\sON\s+({_NAME})",
+                                      re.IGNORECASE | re.DOTALL)),
+    "RULE": ("rule", re.compile(rf"CREATE\s+(?:OR\s+REPLACE\s+)?RULE\s+\S+\s.*?\sTO\s+({_NAME})",
+                                re.IGNORECASE | re.DOTALL)),
+    "POLICY": ("table", re.compile(rf"CREATE\s+POLICY\s+\S+\s+ON\s+({_NAME})", re.IGNORECASE)),
+}
+_NAME_PART = re.compile(r'"(?:[^"]|"")+"|[^\s.(")]+')
+_IDENTIFIER = r'(?:"(?:[^"]|"")+"|[^\s.(");]+)'
+_REPLICA_IDENTITY = re.compile(rf"REPLICA\s+IDENTITY\s+USING\s+INDEX\s+({_IDENTIFIER})", re.IGNORECASE)
+_UNIQUE_INDEX_NAME = re.compile(rf"CREATE\s+UNIQUE\s+INDEX\s+({_IDENTIFIER})\s", re.IGNORECASE)
+# Unique constraints are backed by an index of the same name
+_CONSTRAINT_NAME = re.compile(rf"ALTER\s+TABLE\s+(?:ONLY\s+)?{_NAME}\s+ADD\s+CONSTRAINT\s+({_IDENTIFIER})\s",
+                              re.IGNORECASE)
+
+
+def split_name(name):
+    """
+    Split a relation name as written by pg_dump into (schema, relation), still quoted.
+
+    >>> split_name('"My Schema".table_1')
+    ('"My Schema"', 'table_1')
+    """
+    parts = _NAME_PART.findall(name)
+    if len(parts) == 1:
+        return None, parts[0]
+    return parts[0], parts[1]
+
+
+def unquote(identifier):
+    """
+    >>> unquote('"My ""quoted"" Table"')
+    'My "quoted" Table'
+    """
+    if identifier.startswith('"') and identifier.endswith('"'):
+        return identifier[1:-1].replace('""', '"')
+    return identifier
+
+
+def table_key(name):
+    """
+    Catalog (schema, relation) pair of a relation name as written by pg_dump.
+
+    >>> table_key('included."Table"')
+    ('included', 'Table')
+    """
+    schema, relation = split_name(name)
+    return (unquote(schema) if schema is not None else None), unquote(relation)
+
+
+@dataclasses.dataclass
+class PostDataUnit:
+    statement: str
+    kind: str
+    table: str | None = None
+    referenced_table: str | None = None
+
+
+def parse_unit(statement) -> PostDataUnit:
+    """
+    Classify one post-data statement and find the table it is built on.
+
+    Kinds are setting, primary_key, unique, foreign_key, constraint (check
+    and exclusion), index, trigger, rule, replica_identity (an index used as
+    replica identity), table (other table changes) and other.
+
+    >>> parse_unit("CREATE INDEX idx ON ONLY s.t USING btree (a);")
+    PostDataUnit(statement='CREATE INDEX idx ON ONLY s.t USING btree (a);', kind='index', table='s.t', referenced_table=None)
+    >>> parse_unit("ALTER TABLE ONLY s.a\\n    ADD CONSTRAINT fk FOREIGN KEY (b_id) REFERENCES s.b(id);").referenced_table
+    's.b'
+    """
+    head = _HEAD.match(statement)
+    if head is None:
+        return PostDataUnit(statement, "other")
+    verb, noun = head.group(1).upper(), head.group(2).upper()
+
+    if verb in ("SET", "SELECT"):
+        if _SETTING.match(statement):
+            return PostDataUnit(statement, "setting")
+    elif verb == "ALTER":
+        match = _ALTER_TABLE.match(statement) if noun == "TABLE" else None
+        if match:
+            table, action = match.groups()
+            if _REPLICA_IDENTITY.match(action):
+                return PostDataUnit(statement, "replica_identity", table)
+            constraint = _CONSTRAINT.match(action)
+            if constraint is None:
+                return PostDataUnit(statement, "table", table)
+            return PostDataUnit(statement, constraint.lastgroup or "constraint", table, constraint.group("referenced"))
+    elif noun in _CREATE:
+        kind, pattern = _CREATE[noun]
+        match = pattern.match(statement)
+        if match:
+            return PostDataUnit(statement, kind, match.group(1))
+    return PostDataUnit(statement, "other")
+
+
+def parse_units(statements):
+    return [parse_unit(statement) for statement in statements]
+
+
+@dataclasses.dataclass
+class PostData:
+    """
+    The classified statements of a post-data dump.
+
+    Parsed once from the dump, then read by the primary key restore, the
+    restore of everything else and the parallel executor.
+
+    >>> dump = PostData.parse(["\\\\restrict key", "SET a = 1;",
+    ...                        "ALTER TABLE ONLY s.t\\n    ADD CONSTRAINT t_pkey PRIMARY KEY (id);",
+    ...                        "CREATE INDEX idx ON s.t USING btree (a);"])
+    >>> [unit.kind for unit in dump.primary_keys()]
+    ['setting', 'primary_key']
+    >>> dump.script(dump.without_primary_keys())
+    'SET a = 1;\\nCREATE INDEX idx ON s.t USING btree (a);'
+    """
+    units: list
+
+    @classmethod
+    def parse(cls, statements):
+        # psql \restrict and \unrestrict meta-commands are not SQL
+        return cls([parse_unit(statement) for statement in statements
+                    if not sql_stream.is_restrict_command(statement)])
+
+    def of_kind(self, *kinds):
+        return [unit for unit in self.units if unit.kind in kinds]
+
+    def settings(self):
+        return self.of_kind("setting")
+
+    def _keys(self):
+        # Replica identity indexes are found by their schema and name
+        identities = set()
+        for unit in self.of_kind("replica_identity"):
+            schema, _ = split_name(unit.table)
+            identities.add((schema, _REPLICA_IDENTITY.search(unit.statement).group(1)))
+        keys = set()
+        for unit in self.units:
+            if unit.kind in ("primary_key", "replica_identity"):
+                keys.add(id(unit))
+            elif unit.kind in ("index", "unique") and identities:
+                name = (_UNIQUE_INDEX_NAME if unit.kind == "index" else _CONSTRAINT_NAME).match(unit.statement)
+                if name is not None and (split_name(unit.table)[0], name.group(1)) in identities:
+                    keys.add(id(unit))
+        return keys
+
+    def primary_keys(self):
+        """
+        Primary keys and replica identity indexes, after the settings of the dump.
+
+        They are what the apply uses to find the rows to update or delete.
+        """
+        keys = self._keys()
+        return [unit for unit in self.units if unit.kind == "setting" or id(unit) in keys]
+
+    def without_primary_keys(self):
+        keys = self._keys()
+        return [unit for unit in self.units if id(unit) not in keys]
+
+    def counts(self):
+        counts = {}
+        for unit in self.units:
+            counts[unit.kind] = counts.get(unit.kind, 0) + 1
+        return counts
+
+    @staticmethod
+    def script(units):
+        return "\n".join(unit.statement for unit in units)
+
+
+@dataclasses.dataclass
+class PostDataReport:
+    executed: int = 0
+    duration: float = 0
+    failures: list = dataclasses.field(default_factory=list)
+    # Units not started because the run was stopped
+    skipped: list = dataclasses.field(default_factory=list)
+
+
+class ParallelPostDataExecutor:
+    """
+    Run post-data units on a pool of connections to the target.
+
+    Units of one table run in dump order on one connection while tables are
+    built in parallel. A foreign key starts once the units of both its table
+    and the referenced table are done, and statements not bound to a table
+    run last. Settings units are replayed on every connection. Once stop_event
+    is set, units not started yet are reported as skipped. on_executed is
+    called with each unit executed successfully.
+    """
+
+    def __init__(self, conn_string, jobs=POST_DATA_JOBS, maintenance_work_mem=None,
+                 max_parallel_maintenance_workers=None, on_executed=None):
+        self.conn_string = conn_string
+        self.jobs = max(jobs, 1)
+        self.maintenance_work_mem = maintenance_work_mem
+        self.max_parallel_maintenance_workers = max_parallel_maintenance_workers
+        self.on_executed = on_executed
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._settings = []
+        self._report = PostDataReport()
+        self._report_lock = threading.Lock()
+        self._parent_span = None
+
+    def run(self, units, stop_event=None) -> PostDataReport:
+        start = time.monotonic()
+        self._parent_span = tracing.current_span()
+        self._report = PostDataReport()
+        self._settings = [unit.statement for unit in units if unit.kind == "setting"]
+        groups = {}
+        foreign_keys = []
+        others = []
+        for unit in units:
+            if unit.kind == "setting":
+                continue
+            if unit.kind == "foreign_key":
+                foreign_keys.append(unit)
+            elif unit.table is None:
+                others.append(unit)
+            else:
+                groups.setdefault(unit.table, []).append(unit)
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                pending = {executor.submit(self._run_units, group, stop_event): table
+                           for table, group in groups.items()}
+                done_tables = set()
+                waiting_keys = foreign_keys
+                while pending or waiting_keys:
+                    still_waiting = []
+                    for unit in waiting_keys:
+                        if ((unit.table not in groups or unit.table in done_tables)
+                                and (unit.referenced_table not in groups or unit.referenced_table in done_tables)):
+                            pending[executor.submit(self._run_units, [unit], stop_event)] = None
+                        else:
+                            still_waiting.append(unit)
+                    waiting_keys = still_waiting
+                    if not pending:
+                        break
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        table = pending.pop(future)
+                        if table is not None:
+                            done_tables.add(table)
+
+                executor.submit(self._run_units, others, stop_event).result()
+        finally:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+            self._local = threading.local()
+
+        self._report.duration = time.monotonic() - start
+        return self._report
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = psycopg.connect(self.conn_string, autocommit=True)
+            with self._connections_lock:
+                self._connections.append(conn)
+            if self.maintenance_work_mem is not None:
+                conn.execute("SELECT set_config('maintenance_work_mem', %s, false)",
+                             (str(self.maintenance_work_mem),))
+            if self.max_parallel_maintenance_workers is not None:
+                conn.execute("SELECT set_config('max_parallel_maintenance_workers', %s, false)",
+                             (str(self.max_parallel_maintenance_workers),))
+            for statement in self._settings:
+                conn.execute(statement)
+            self._local.conn = conn
+        return conn
+
+    def _original(self, unit):
+        return unit
+
+    def _run_units(self, units, stop_event):
+        if not units:
+            return
+        try:
+            conn = self._connection()
+        except psycopg.Error as e:
+            print(f"Error {e} on connection string {self.conn_string}", file=sys.stderr)
+            with self._report_lock:
+                self._report.failures.extend((unit, str(e)) for unit in units)
+            return
+        for position, unit in enumerate(units):
+            if stop_event is not None and stop_event.is_set():
+                with self._report_lock:
+                    self._report.skipped.extend(units[position:])
+                return
+            try:
+                with tracing.span("sql", self._parent_span, statement=tracing.statement_attribute(unit.statement),
+                                  kind=unit.kind, table=unit.table):
+                    conn.execute(unit.statement)
+                with self._report_lock:
+                    self._report.executed += 1
+                if self.on_executed is not None:
+                    self.on_executed(self._original(unit))
+            except psycopg.Error as e:
+                print(f"Error {e} with query '{unit.statement}' on host '{self.conn_string}'", file=sys.stderr)
+                with self._report_lock:
+                    self._report.failures.append((unit, str(e)))
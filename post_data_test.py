@@ -0,0 +1,170 @@
+import threading
+
+import psycopg
+
+import sql_stream
+from post_data import ParallelPostDataExecutor, PostData, PostDataUnit, parse_unit, parse_units
+
+
+def test_parse_unit_kinds():
+    statements = [
+        "SET statement_timeout = 0;",
+        "SELECT pg_catalog.set_config('search_path', '', false);",
+        "ALTER TABLE ONLY s.t\n    ADD CONSTRAINT t_pkey PRIMARY KEY (id);",
+        "ALTER TABLE ONLY s.t\n    ADD CONSTRAINT t_name_key UNIQUE (name);",
+        "ALTER TABLE ONLY s.a\n    ADD CONSTRAINT a_t_fk FOREIGN KEY (t_id) REFERENCES s.t(id);",
+        "CREATE UNIQUE INDEX idx ON s.t USING btree (name);",
+        "CREATE TRIGGER trg AFTER INSERT OR UPDATE ON s.t FOR EACH ROW EXECUTE FUNCTION s.f();",
+        "CREATE RULE r AS\n    ON INSERT TO s.t DO INSTEAD NOTHING;",
+        "CREATE POLICY p ON s.t USING (true);",
+        "ALTER TABLE ONLY s.t CLUSTER ON idx;",
+        "ALTER TABLE ONLY s.t REPLICA IDENTITY USING INDEX idx;",
+        "ALTER INDEX s.parent_idx ATTACH PARTITION s.child_idx;",
+    ]
+
+    units = parse_units(statements)
+
+    assert [(unit.kind, unit.table, unit.referenced_table) for unit in units] == [
+        ("setting", None, None),
+        ("setting", None, None),
+        ("primary_key", "s.t", None),
+        ("unique", "s.t", None),
+        ("foreign_key", "s.a", "s.t"),
+        ("index", "s.t", None),
+        ("trigger", "s.t", None),
+        ("rule", "s.t", None),
+        ("table", "s.t", None),
+        ("table", "s.t", None),
+        ("replica_identity", "s.t", None),
+        ("other", None, None),
+    ]
+
+
+def test_parse_unit_with_quoted_names():
+    unit = parse_unit('CREATE INDEX "Idx" ON ONLY "My Schema"."My Table" USING btree (a);')
+
+    assert unit.table == '"My Schema"."My Table"'
+
+
+def test_post_data_keeps_every_statement_of_the_dump():
+    dump = [
+        "\\restrict abc\n",
+        "SET statement_timeout = 0;\n",
+        "\n",
+        "--\n",
+        "-- Name: t t_pkey; Type: CONSTRAINT; Schema: s; Owner: -\n",
+        "--\n",
+        "\n",
+        "ALTER TABLE ONLY s.t\n",
+        "    ADD CONSTRAINT t_pkey PRIMARY KEY (id);\n",
+        "\n",
+        "ALTER TABLE ONLY s.t\n",
+        "    ADD CONSTRAINT t_check CHECK ((id > 0));\n",
+        "\n",
+        "CREATE INDEX t_a_idx ON s.t USING btree (a);\n",
+        "\n",
+        "ALTER TABLE ONLY s.u\n",
+        "    ADD CONSTRAINT u_t_fk FOREIGN KEY (t_id) REFERENCES s.t(id);\n",
+        "\n",
+        "\\unrestrict abc\n",
+    ]
+
+    post_data = PostData.parse(sql_stream.statements(dump))
+
+    assert post_data.counts() == {"setting": 1, "primary_key": 1, "constraint": 1, "index": 1, "foreign_key": 1}
+    assert post_data.script(post_data.primary_keys()) == (
+        "SET statement_timeout = 0;\nALTER TABLE ONLY s.t\n    ADD CONSTRAINT t_pkey PRIMARY KEY (id);")
+    assert [unit.kind for unit in post_data.without_primary_keys()] == ["setting", "constraint", "index",
+                                                                        "foreign_key"]
+
+
+def test_post_data_restores_replica_identity_indexes_with_primary_keys():
+    post_data = PostData.parse([
+        "CREATE UNIQUE INDEX t_code_key ON s.t USING btree (code);",
+        "CREATE UNIQUE INDEX u_code_key ON s.u USING btree (code);",
+        "ALTER TABLE ONLY s.t REPLICA IDENTITY USING INDEX t_code_key;",
+    ])
+
+    assert [unit.statement for unit in post_data.without_primary_keys()] == [
+        "CREATE UNIQUE INDEX u_code_key ON s.u USING btree (code);"]
+    assert len(post_data.primary_keys()) == 2
+
+
+def test_post_data_restores_replica_identity_constraints_with_primary_keys():
+    # pg_dump writes the unique constraint, then the replica identity using its index
+    post_data = PostData.parse([
+        "SET statement_timeout = 0;",
+        "ALTER TABLE ONLY s.t\n    ADD CONSTRAINT t_code_key UNIQUE (code);",
+        "ALTER TABLE ONLY s.u\n    ADD CONSTRAINT u_code_key UNIQUE (code);",
+        "ALTER TABLE ONLY s.t REPLICA IDENTITY USING INDEX t_code_key;",
+    ])
+
+    assert post_data.script(post_data.primary_keys()) == (
+        "SET statement_timeout = 0;\nALTER TABLE ONLY s.t\n    ADD CONSTRAINT t_code_key UNIQUE (code);\n"
+        "ALTER TABLE ONLY s.t REPLICA IDENTITY USING INDEX t_code_key;")
+    assert [unit.statement for unit in post_data.without_primary_keys()] == [
+        "SET statement_timeout = 0;", "ALTER TABLE ONLY s.u\n    ADD CONSTRAINT u_code_key UNIQUE (code);"]
+
+
+def test_executor_orders_foreign_keys_and_others(mocker):
+    executed = []
+    connections = []
+
+    def connect(*args, **kwargs):
+        conn = mocker.MagicMock()
+        conn.execute.side_effect = lambda query, params=None: executed.append(query)
+        connections.append(conn)
+        return conn
+
+    mocker.patch("psycopg.connect", side_effect=connect)
+    units = [
+        PostDataUnit("SET a = 1;", "setting"),
+        PostDataUnit("other", "other"),
+        PostDataUnit("fk a->b", "foreign_key", "s.a", "s.b"),
+        PostDataUnit("index a", "index", "s.a"),
+        PostDataUnit("index b", "index", "s.b"),
+        PostDataUnit("trigger b", "trigger", "s.b"),
+    ]
+
+    report = ParallelPostDataExecutor("{conn}", jobs=2, maintenance_work_mem="1GB").run(units)
+
+    assert report.executed == 5
+    assert report.failures == []
+    assert executed.index("fk a->b") > executed.index("index a")
+    assert executed.index("fk a->b") > executed.index("trigger b")
+    assert executed[-1] == "other"
+    assert executed.count("SET a = 1;") == len(connections)
+    for conn in connections:
+        conn.execute.assert_any_call("SELECT set_config('maintenance_work_mem', %s, false)", ("1GB",))
+        conn.close.assert_called_once()
+
+
+def test_executor_reports_failures_and_continues(mocker):
+    conn = mocker.MagicMock()
+    mocker.patch("psycopg.connect", return_value=conn)
+
+    def execute(query, params=None):
+        if query == "index a":
+            raise psycopg.Error("<expected error>")
+
+    conn.execute.side_effect = execute
+    units = [PostDataUnit("index a", "index", "s.a"), PostDataUnit("trigger a", "trigger", "s.a")]
+
+    report = ParallelPostDataExecutor("{conn}", jobs=1).run(units)
+
+    assert report.executed == 1
+    assert [(unit.statement, error) for unit, error in report.failures] == [("index a", "<expected error>")]
+
+
+def test_executor_reports_units_skipped_once_stopped(mocker):
+    stop_event = threading.Event()
+    conn = mocker.MagicMock()
+    conn.execute.side_effect = lambda query, params=None: stop_event.set()
+    mocker.patch("psycopg.connect", return_value=conn)
+    units = [PostDataUnit("index a", "index", "s.a"), PostDataUnit("trigger a", "trigger", "s.a"),
+             PostDataUnit("fk a->b", "foreign_key", "s.a", "s.b")]
+
+    report = ParallelPostDataExecutor("{conn}", jobs=1).run(units, stop_event)
+
+    assert report.executed == 1
+    assert [unit.statement for unit in report.skipped] == ["trigger a", "fk a->b"]
@@ -1,43 +1,159 @@
+import array
 import dataclasses
+import typing
 
 from database import Database
 
+CATALOG_SNAPSHOT_QUERY = """
+WITH schemas AS (
+    SELECT schema_name::text AS schema_name FROM information_schema.schemata WHERE schema_name NOT ILIKE 'pg_%'{schema_filter}
+), tables AS (
+    SELECT json_build_array(
+               n.nspname, c.relname, c.oid, c.relkind,
+               pg_table_size(c.oid), pg_total_relation_size(c.oid), c.reltuples::bigint, c.relreplident,
+               EXISTS (SELECT 1 FROM pg_constraint con WHERE con.conrelid = c.oid AND con.contype = 'p'),
+               (SELECT pn.nspname || '.' || p.relname
+                FROM pg_inherits i
+                JOIN pg_class p ON p.oid = i.inhparent
+                JOIN pg_namespace pn ON pn.oid = p.relnamespace
+                WHERE i.inhrelid = c.oid AND p.relkind = 'p')
+           ) AS record
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    -- information_schema tables are created by initdb and can't be published
+    WHERE c.relkind IN ('r', 'p') AND n.nspname IN (SELECT schema_name FROM schemas)
+      AND n.nspname <> 'information_schema'
+)
+SELECT (SELECT array_agg(schema_name) FROM schemas),
+       pg_size_pretty(pg_database_size(current_database())),
+       pg_database_size(current_database()),
+       (SELECT json_agg(record) FROM tables)
+"""
+
+
+def catalog_snapshot_query(schema_excluded_str=""):
+    schema_filter = ""
+    if schema_excluded_str != "":
+        schema_filter = f" AND schema_name NOT IN ({schema_excluded_str})"
+    return CATALOG_SNAPSHOT_QUERY.format(schema_filter=schema_filter)
+
+
+def schema_excluded_string(list_schema_excluded):
+    if list_schema_excluded is None:
+        return ""
+    return ",".join([f"'{schema}'" for schema in list_schema_excluded])
+
+
+def db_infos_from_results(results, schema_excluded_str) -> DbInfos:
+    db_schemas = None
+    db_size = None
+    db_size_bytes = None
+    db_tables = None
+    tables = TableInventory()
+    if results and results[0]:
+        schemas, db_size, db_size_bytes, records = results[0]
+        if schemas:
+            db_schemas = list(schemas)
+        for record in records or []:
+            # Also filtered by the query, snapshots of other sources may still have them
+            if record[0] != "information_schema":
+                tables.append(*record)
+        db_tables = len(tables)
+    return DbInfos(db_schemas, db_size, db_tables, schema_excluded_str, tables, db_size_bytes)
+
 
 class Primary:
     def __init__(self, db: Database):
         self.db = db
 
     def retrieve_db_infos(self, list_schema_excluded) -> DbInfos:
-        schema_excluded_str = ""
-        if list_schema_excluded is None:
-            schema_query = "SELECT schema_name FROM information_schema.schemata WHERE schema_name NOT ILIKE 'pg_%'"
-        else:
-            schema_excluded_str = ",".join(
-                [f"'{schema}'" for schema in list_schema_excluded])
-            schema_query = f"SELECT schema_name FROM information_schema.schemata WHERE schema_name NOT ILIKE 'pg_%' AND schema_name NOT IN ({schema_excluded_str});"
-        results = self.db.execute_query(schema_query)
-        db_schemas = None
-        if results and results[0]:
-            db_schemas = [schema[0] for schema in results]
-
-        results = self.db.execute_query(
-            f"SELECT pg_size_pretty(pg_database_size('{self.db.db_name}'))")
-        db_size = None
-        if results and results[0]:
-            db_size = results[0][0]
-
-        results = self.db.execute_query(
-            "SELECT count(*) from pg_stat_user_tables")
-        db_tables = None
-        if results and results[0]:
-            db_tables = results[0][0]
-        return DbInfos(db_schemas, db_size, db_tables, schema_excluded_str)
+        # Schemas, database size and per-table records in a single round-trip
+        schema_excluded_str = schema_excluded_string(list_schema_excluded)
+        results = self.db.execute_query(catalog_snapshot_query(schema_excluded_str))
+        return db_infos_from_results(results, schema_excluded_str)
 
 
 @dataclasses.dataclass
 class DbInfos:
-    def __init__(self, db_schemas, db_size, db_tables, schema_excluded_str):
+    def __init__(self, db_schemas, db_size, db_tables, schema_excluded_str, tables=None, db_size_bytes=None):
         self.db_schemas = db_schemas
         self.db_size = db_size
         self.db_tables = db_tables
         self.schema_excluded_str = schema_excluded_str
+        self.tables = tables if tables is not None else TableInventory()
+        self.db_size_bytes = db_size_bytes
+
+
+class TableInfo(typing.NamedTuple):
+    schema: str
+    name: str
+    oid: int
+    relkind: str
+    size: int
+    total_size: int
+    row_estimate: int
+    replica_identity: str
+    has_primary_key: bool
+    parent: str | None
+
+
+class TableInventory:
+    """
+    Compact column store of the tables found in the catalog snapshot.
+
+    Numbers are kept in typed arrays and single-letter codes in byte
+    arrays, so a database with tens of thousands of tables stays small.
+    Records are materialized as TableInfo on access.
+    """
+
+    __slots__ = ("schemas", "names", "oids", "relkinds", "sizes", "total_sizes", "row_estimates",
+                 "replica_identities", "has_primary_keys", "parents")
+
+    def __init__(self):
+        self.schemas = []
+        self.names = []
+        self.oids = array.array("q")
+        self.relkinds = bytearray()
+        self.sizes = array.array("q")
+        self.total_sizes = array.array("q")
+        self.row_estimates = array.array("q")
+        self.replica_identities = bytearray()
+        self.has_primary_keys = bytearray()
+        self.parents = {}
+
+    def append(self, schema, name, oid, relkind, size, total_size, row_estimate, replica_identity,
+               has_primary_key, parent=None):
+        if parent is not None:
+            self.parents[len(self.names)] = parent
+        self.schemas.append(schema)
+        self.names.append(name)
+        self.oids.append(oid)
+        self.relkinds.append(ord(relkind))
+        self.sizes.append(size or 0)
+        self.total_sizes.append(total_size or 0)
+        self.row_estimates.append(row_estimate if row_estimate is not None else -1)
+        self.replica_identities.append(ord(replica_identity))
+        self.has_primary_keys.append(1 if has_primary_key else 0)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, index) -> TableInfo:
+        return TableInfo(self.schemas[index], self.names[index], self.oids[index], chr(self.relkinds[index]),
+                         self.sizes[index], self.total_sizes[index], self.row_estimates[index],
+                         chr(self.replica_identities[index]), bool(self.has_primary_keys[index]),
+                         self.parents.get(index))
+
+    def __iter__(self):
+        for index in range(len(self.names)):
+            yield self[index]
+
+    def publication_tables(self):
+        """Tables holding data to replicate, as (schema, table) pairs."""
+        return [(self.schemas[i], self.names[i]) for i in range(len(self.names))
+                if self.relkinds[i] == ord("r") and self.names[i] != "spatial_ref_sys"]
+
+    def table_sizes(self, total=False):
+        sizes = self.total_sizes if total else self.sizes
+        return {(self.schemas[i], self.names[i]): sizes[i] for i in range(len(self.names))
+                if self.relkinds[i] == ord("r")}
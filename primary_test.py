@@ -1,51 +1,52 @@
 from database_test import DatabaseStub
-from primary import Primary
+from primary import Primary, TableInventory, catalog_snapshot_query
+
+TABLE_RECORDS = [
+    ["schema_1", "table_1", 16390, "r", 8192, 16384, 2, "d", True, None],
+    ["schema_1", "parent", 16400, "p", 0, 0, -1, "d", True, None],
+    ["schema_1", "parent_2026", 16410, "r", 4096, 8192, 10, "f", False, "schema_1.parent"],
+    ["schema_2", "spatial_ref_sys", 16420, "r", 100, 200, 1, "d", True, None],
+]
 
 
 def test_retrieve_db_infos():
     db = DatabaseStub()
     primary = Primary(db)
-    db.on_query_return("SELECT schema_name FROM information_schema.schemata WHERE schema_name NOT ILIKE 'pg_%'",
-                       [["schema_1"], ["schema_2"]])
-    db.on_query_return("SELECT pg_size_pretty(pg_database_size('db_name'))",
-                       [[321]])
-    db.on_query_return("SELECT count(*) from pg_stat_user_tables",
-                       [[123]])
+    db.on_query_return(catalog_snapshot_query(),
+                       [[["schema_1", "schema_2"], "321 kB", 328704, TABLE_RECORDS]])
 
     db_infos = primary.retrieve_db_infos(None)
 
     assert db_infos.db_schemas == ["schema_1", "schema_2"]
-    assert db_infos.db_size == 321
-    assert db_infos.db_tables == 123
+    assert db_infos.db_size == "321 kB"
+    assert db_infos.db_size_bytes == 328704
+    assert db_infos.db_tables == 4
     assert db_infos.schema_excluded_str == ""
+    assert db_infos.tables.publication_tables() == [("schema_1", "table_1"), ("schema_1", "parent_2026")]
+    assert db_infos.tables.table_sizes(total=True) == {("schema_1", "table_1"): 16384,
+                                                       ("schema_1", "parent_2026"): 8192,
+                                                       ("schema_2", "spatial_ref_sys"): 200}
 
 
 def test_retrieve_db_infos_with_list_schema_excluded():
     db = DatabaseStub()
     primary = Primary(db)
-    db.on_query_return("SELECT schema_name FROM information_schema.schemata WHERE schema_name NOT ILIKE 'pg_%' AND schema_name NOT IN ('schema_1','schema_2');",
-                       [["schema_3"]])
-    db.on_query_return("SELECT pg_size_pretty(pg_database_size('db_name'))",
-                       [[321]])
-    db.on_query_return("SELECT count(*) from pg_stat_user_tables",
-                       [[123]])
+    db.on_query_return(catalog_snapshot_query("'schema_1','schema_2'"),
+                       [[["schema_3"], "321 kB", 328704, None]])
 
     db_infos = primary.retrieve_db_infos(["schema_1", "schema_2"])
 
+    assert "AND schema_name NOT IN ('schema_1','schema_2')" in catalog_snapshot_query("'schema_1','schema_2'")
     assert db_infos.db_schemas == ["schema_3"]
-    assert db_infos.db_size == 321
-    assert db_infos.db_tables == 123
+    assert db_infos.db_size == "321 kB"
+    assert db_infos.db_tables == 0
     assert db_infos.schema_excluded_str == "'schema_1','schema_2'"
 
 
 def test_retrieve_db_infos_with_no_results():
     db = DatabaseStub()
     primary = Primary(db)
-    db.on_query_return("SELECT schema_name FROM information_schema.schemata WHERE schema_name NOT ILIKE 'pg_%' AND schema_name NOT IN ('schema_1');",
-                       [])
-    db.on_query_return("SELECT pg_size_pretty(pg_database_size('db_name'))",
-                       None)
-    db.on_query_return("SELECT count(*) from pg_stat_user_tables",
+    db.on_query_return(catalog_snapshot_query("'schema_1'"),
                        [])
 
     db_infos = primary.retrieve_db_infos(["schema_1"])
@@ -53,6 +54,34 @@ def test_retrieve_db_infos_with_no_results():
     assert db_infos.db_schemas is None
     assert db_infos.db_size is None
     assert db_infos.db_tables is None
+    assert len(db_infos.tables) == 0
     assert db_infos.schema_excluded_str == "'schema_1'"
 
 
+def test_table_inventory_records():
+    inventory = TableInventory()
+    for record in TABLE_RECORDS:
+        inventory.append(*record)
+
+    partition = inventory[2]
+
+    assert partition.name == "parent_2026"
+    assert partition.relkind == "r"
+    assert partition.replica_identity == "f"
+    assert partition.has_primary_key is False
+    assert partition.parent == "schema_1.parent"
+    assert [table.parent for table in inventory] == [None, None, "schema_1.parent", None]
+
+
+def test_retrieve_db_infos_leaves_information_schema_tables_out():
+    db = DatabaseStub()
+    primary = Primary(db)
+    records = TABLE_RECORDS[:1] + [["information_schema", "sql_features", 13450, "r", 65536, 73728, 755, "d",
+                                    False, None]]
+    db.on_query_return(catalog_snapshot_query(), [[["information_schema", "schema_1"], "321 kB", 328704, records]])
+
+    db_infos = primary.retrieve_db_infos(None)
+
+    assert [table.schema for table in db_infos.tables] == ["schema_1"]
+    assert db_infos.db_tables == 1
+    assert db_infos.tables.publication_tables() == [("schema_1", "table_1")]
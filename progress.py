@@ -0,0 +1,194 @@
+import collections
+import dataclasses
+import datetime
+import json
+import sys
+import time
+
+import psycopg
+
+import tracing
+from database import Database
+
+MIN_INTERVAL_IN_SECONDS = 0.5
+MAX_INTERVAL_IN_SECONDS = 30
+THROUGHPUT_WINDOW_IN_SECONDS = 60
+
+PROGRESS_QUERY = """
+    SELECT count(*) FILTER (WHERE srsubstate = 'r'), count(*)
+    FROM pg_subscription_rel
+    JOIN pg_class ON srrelid = pg_class.oid
+    WHERE relname <> 'spatial_ref_sys'
+"""
+SUBSCRIPTION_FILTER = " AND srsubid IN (SELECT oid FROM pg_subscription WHERE subname = ANY(%s))"
+
+RELATIONS_PROGRESS_QUERY = """
+    SELECT n.nspname, c.relname, sr.srsubstate, coalesce(pc.bytes_processed, 0), ss.pid IS NOT NULL
+    FROM pg_subscription_rel sr
+    JOIN pg_class c ON c.oid = sr.srrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    LEFT JOIN pg_stat_progress_copy pc ON pc.relid = sr.srrelid
+    LEFT JOIN pg_stat_subscription ss ON ss.subid = sr.srsubid AND ss.relid = sr.srrelid
+    WHERE c.relname <> 'spatial_ref_sys'
+"""
+# States whose data is fully copied: synchronized, ready and, since PostgreSQL 15, finished copy
+_COPIED_STATES = ("s", "r", "f")
+
+
+@dataclasses.dataclass
+class SyncProgress:
+    ready: int
+    total: int
+    elapsed: float
+    interval: float = 0
+
+    @property
+    def done(self):
+        return self.ready >= self.total
+
+
+def next_interval(interval, progressed, remaining_seconds, min_interval, max_interval):
+    """
+    Adapt the polling interval to the observed completion rate.
+
+    The interval is halved while relations keep reaching the ready state and
+    doubled while nothing moves, and never exceeds half of the estimated
+    remaining time so the end of the sync is noticed quickly.
+
+    >>> next_interval(4, progressed=False, remaining_seconds=None, min_interval=0.5, max_interval=30)
+    8
+    >>> next_interval(4, progressed=True, remaining_seconds=3, min_interval=0.5, max_interval=30)
+    1.5
+    """
+    interval = max(interval / 2, min_interval) if progressed else interval * 2
+    if remaining_seconds is not None:
+        interval = min(interval, max(remaining_seconds / 2, min_interval))
+    return min(max(interval, min_interval), max_interval)
+
+
+def wait_for_initial_sync(db: Database, subscription_names=None, timeout=None, on_progress=None,
+                          min_interval=MIN_INTERVAL_IN_SECONDS, max_interval=MAX_INTERVAL_IN_SECONDS,
+                          sleep=time.sleep) -> SyncProgress:
+    """
+    Wait until every relation of the subscriptions reaches the ready state.
+
+    One aggregate query runs per tick on a single connection held for the
+    whole wait. on_progress is called with a SyncProgress after each tick,
+    and TimeoutError is raised when timeout seconds elapse first.
+    """
+    query = PROGRESS_QUERY
+    params = None
+    if subscription_names:
+        query += SUBSCRIPTION_FILTER
+        params = (list(subscription_names),)
+
+    start = time.monotonic()
+    interval = min(min_interval, max_interval)
+    previous = None
+    rate = None
+    with tracing.span("sync wait", subscriptions=len(subscription_names or ())) as wait_span, db.connection() as conn:
+        while True:
+            with tracing.span("sync tick") as tick_span:
+                ready, total = conn.execute(query, params).fetchone()
+                tick_span.set(ready=ready, total=total)
+            wait_span.add("ticks")
+            now = time.monotonic()
+            progress = SyncProgress(ready, total, now - start)
+            if not progress.done:
+                progressed = previous is not None and ready > previous.ready
+                if progressed:
+                    observed = (ready - previous.ready) / max(progress.elapsed - previous.elapsed, 1e-3)
+                    # Moving average of relations reaching ready per second
+                    rate = observed if rate is None else (rate + observed) / 2
+                remaining_seconds = (total - ready) / rate if rate else None
+                interval = next_interval(interval, progressed, remaining_seconds, min_interval, max_interval)
+                progress.interval = interval
+            if on_progress is not None:
+                on_progress(progress)
+            if progress.done:
+                wait_span.set(ready=ready, total=total)
+                return progress
+            previous = progress
+
+            delay = interval
+            if timeout is not None:
+                if progress.elapsed >= timeout:
+                    raise TimeoutError(f"Initial sync not finished after {timeout}s : {ready}/{total}")
+                delay = min(delay, timeout - progress.elapsed)
+            sleep(delay)
+
+
+class ByteProgressTracker:
+    """
+    Byte-level progress of the initial sync, written as JSON lines.
+
+    Relation sizes come from the primary. Relations in a copied state count
+    for their whole size and relations being copied for the bytes reported
+    by pg_stat_progress_copy. Throughput is measured over a sliding window
+    and gives the ETA. An instance can be passed as on_progress to
+    wait_for_initial_sync.
+    """
+
+    def __init__(self, db: Database, table_sizes, output=sys.stdout, window=THROUGHPUT_WINDOW_IN_SECONDS,
+                 subscription_names=None):
+        self.db = db
+        self.table_sizes = table_sizes
+        self.output = output
+        self.window = window
+        self.query = RELATIONS_PROGRESS_QUERY
+        self.params = None
+        if subscription_names:
+            self.query += SUBSCRIPTION_FILTER.replace("srsubid", "sr.srsubid")
+            self.params = (list(subscription_names),)
+        self._samples = collections.deque()
+
+    def sample(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self.db.connection() as conn:
+            relations = conn.execute(self.query, self.params).fetchall()
+
+        bytes_total = 0
+        bytes_done = 0
+        ready = 0
+        copying = []
+        for schema, table, state, bytes_processed, syncing in relations:
+            size = self.table_sizes.get((schema, table), 0)
+            bytes_total += size
+            if state == "r":
+                ready += 1
+            if state in _COPIED_STATES:
+                bytes_done += size
+            elif bytes_processed:
+                bytes_done += min(bytes_processed, size)
+                copying.append({"table": f"{schema}.{table}", "bytes_done": bytes_processed, "bytes_total": size})
+            elif syncing:
+                copying.append({"table": f"{schema}.{table}", "bytes_done": 0, "bytes_total": size})
+
+        self._samples.append((now, bytes_done))
+        while len(self._samples) > 2 and now - self._samples[0][0] > self.window:
+            self._samples.popleft()
+        oldest_time, oldest_bytes = self._samples[0]
+        throughput = (bytes_done - oldest_bytes) / (now - oldest_time) if now > oldest_time else None
+        remaining = bytes_total - bytes_done
+        eta = remaining / throughput if throughput else None
+
+        return {
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "relations_ready": ready,
+            "relations_total": len(relations),
+            "bytes_done": bytes_done,
+            "bytes_total": bytes_total,
+            "throughput_bytes_per_second": throughput,
+            "eta_seconds": 0 if remaining <= 0 else eta,
+            "copying": copying,
+        }
+
+    def __call__(self, progress: SyncProgress = None):
+        try:
+            record = self.sample()
+        except psycopg.Error as e:
+            print(f"Error {e} while sampling the sync progress on host '{self.db.conn_string}'", file=sys.stderr)
+            return None
+        self.output.write(json.dumps(record) + "\n")
+        self.output.flush()
+        return record
@@ -0,0 +1,95 @@
+import io
+import json
+
+import pytest
+
+from progress import SUBSCRIPTION_FILTER, ByteProgressTracker, next_interval, wait_for_initial_sync
+
+
+def mocked_db(mocker, rows):
+    db = mocker.MagicMock()
+    conn = db.connection.return_value.__enter__.return_value
+    conn.execute.return_value.fetchone.side_effect = rows
+    return db, conn
+
+
+def test_wait_for_initial_sync_returns_when_all_ready(mocker):
+    db, conn = mocked_db(mocker, [(0, 3), (1, 3), (3, 3)])
+    sleep = mocker.MagicMock()
+    ticks = []
+
+    progress = wait_for_initial_sync(db, ["sub_1"], on_progress=ticks.append, sleep=sleep)
+
+    assert (progress.ready, progress.total, progress.done) == (3, 3, True)
+    assert [(tick.ready, tick.total) for tick in ticks] == [(0, 3), (1, 3), (3, 3)]
+    assert sleep.call_count == 2
+    db.connection.assert_called_once()
+    query, params = conn.execute.call_args.args
+    assert query.endswith(SUBSCRIPTION_FILTER)
+    assert params == (["sub_1"],)
+
+
+def test_wait_for_initial_sync_without_relations(mocker):
+    db, _ = mocked_db(mocker, [(0, 0)])
+    sleep = mocker.MagicMock()
+
+    assert wait_for_initial_sync(db, sleep=sleep).done
+    sleep.assert_not_called()
+
+
+def test_wait_for_initial_sync_backs_off_when_stalled(mocker):
+    db, _ = mocked_db(mocker, [(1, 3)] * 5 + [(3, 3)])
+    sleep = mocker.MagicMock()
+
+    wait_for_initial_sync(db, min_interval=1, max_interval=4, sleep=sleep)
+
+    assert [call.args[0] for call in sleep.call_args_list] == [2, 4, 4, 4, 4]
+
+
+def test_wait_for_initial_sync_timeout(mocker):
+    db, _ = mocked_db(mocker, [(1, 3)] * 3)
+    mocker.patch("time.monotonic", side_effect=[0, 0, 5, 11])
+
+    with pytest.raises(TimeoutError):
+        wait_for_initial_sync(db, timeout=10, sleep=mocker.MagicMock())
+
+
+def test_next_interval_never_exceeds_bounds():
+    assert next_interval(20, progressed=False, remaining_seconds=None, min_interval=0.5, max_interval=30) == 30
+    assert next_interval(0.5, progressed=True, remaining_seconds=0.1, min_interval=0.5, max_interval=30) == 0.5
+    assert next_interval(0.5, progressed=False, remaining_seconds=None, min_interval=0.5, max_interval=0) == 0
+
+
+def test_byte_progress_tracker_computes_throughput_and_eta(mocker):
+    rows = [
+        [("s", "big", "d", 100, True), ("s", "small", "r", 0, False), ("s", "waiting", "i", 0, False)],
+        [("s", "big", "d", 500, True), ("s", "small", "r", 0, False), ("s", "waiting", "d", 0, True)],
+    ]
+    db = mocker.MagicMock()
+    conn = db.connection.return_value.__enter__.return_value
+    conn.execute.return_value.fetchall.side_effect = rows
+    sizes = {("s", "big"): 1000, ("s", "small"): 100, ("s", "waiting"): 300}
+    tracker = ByteProgressTracker(db, sizes, output=io.StringIO(), subscription_names=["sub_1"])
+
+    first = tracker.sample(now=0)
+    second = tracker.sample(now=10)
+
+    assert (first["bytes_done"], first["bytes_total"], first["eta_seconds"]) == (200, 1400, None)
+    assert (second["relations_ready"], second["relations_total"]) == (1, 3)
+    assert second["bytes_done"] == 600
+    assert second["throughput_bytes_per_second"] == 40
+    assert second["eta_seconds"] == 20
+    assert [copy["table"] for copy in second["copying"]] == ["s.big", "s.waiting"]
+    assert conn.execute.call_args.args[1] == (["sub_1"],)
+
+
+def test_byte_progress_tracker_writes_json_lines(mocker):
+    db = mocker.MagicMock()
+    db.connection.return_value.__enter__.return_value.execute.return_value.fetchall.return_value = [
+        ("s", "t", "r", 0, False)]
+    output = io.StringIO()
+
+    ByteProgressTracker(db, {("s", "t"): 10}, output=output)()
+
+    record = json.loads(output.getvalue())
+    assert (record["bytes_done"], record["bytes_total"], record["eta_seconds"]) == (10, 10, 0)
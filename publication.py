@@ -0,0 +1,137 @@
+import dataclasses
+import sys
+import time
+
+import psycopg
+
+from database import Database
+
+PUBLICATION_BATCH_SIZE = 500
+# FOR TABLES IN SCHEMA is available since PostgreSQL 15
+SCHEMA_PUBLICATION_MIN_VERSION = 150000
+
+
+@dataclasses.dataclass
+class BatchTiming:
+    query_kind: str
+    tables: int
+    duration: float
+    failed: bool = False
+
+
+@dataclasses.dataclass
+class PublicationReport:
+    timings: list = dataclasses.field(default_factory=list)
+    failed_tables: list = dataclasses.field(default_factory=list)
+
+    @property
+    def duration(self):
+        return sum(timing.duration for timing in self.timings)
+
+
+def table_list(tables):
+    return ", ".join(f"{schema}.{table}" for schema, table in tables)
+
+
+def batches(tables, batch_size):
+    batch_size = max(batch_size, 1)
+    for i in range(0, len(tables), batch_size):
+        yield tables[i:i + batch_size]
+
+
+def publication_queries(publication_name, tables, whole_schemas=(), batch_size=PUBLICATION_BATCH_SIZE,
+                        exists=False):
+    """
+    Build the ordered list of (query_kind, query, tables) creating the publication, or only adding
+    the tables when it already exists.
+
+    >>> publication_queries("pub", [("s1", "t1"), ("s1", "t2"), ("s2", "t3")], batch_size=2)[0][1]
+    'CREATE PUBLICATION pub FOR TABLE s1.t1, s1.t2;'
+    >>> publication_queries("pub", [("s1", "t1"), ("s2", "t3")], whole_schemas=["s1"])[0][1]
+    'CREATE PUBLICATION pub FOR TABLES IN SCHEMA s1;'
+    """
+    queries = []
+    whole_schemas = sorted(set(whole_schemas))
+    remaining = [(schema, table) for schema, table in tables if schema not in whole_schemas]
+    schema_tables = [(schema, table) for schema, table in tables if schema in whole_schemas]
+
+    if whole_schemas:
+        queries.append(("schema",
+                        f"CREATE PUBLICATION {publication_name} FOR TABLES IN SCHEMA {', '.join(whole_schemas)};",
+                        schema_tables))
+    for batch in batches(remaining, batch_size):
+        if queries or exists:
+            queries.append(("add", f"ALTER PUBLICATION {publication_name} ADD TABLE {table_list(batch)};", batch))
+        else:
+            queries.append(("create", f"CREATE PUBLICATION {publication_name} FOR TABLE {table_list(batch)};", batch))
+    if not queries and not exists:
+        queries.append(("create", f"CREATE PUBLICATION {publication_name};", []))
+    return queries
+
+
+class PublicationBuilder:
+    def __init__(self, db: Database, publication_name, batch_size=PUBLICATION_BATCH_SIZE):
+        self.db = db
+        self.publication_name = publication_name
+        self.batch_size = batch_size
+
+    def supports_schema_publication(self):
+        results = self.db.execute_query("SHOW server_version_num")
+        return bool(results) and int(results[0][0]) >= SCHEMA_PUBLICATION_MIN_VERSION
+
+    def published_tables(self):
+        """Tables already in the publication, None when it doesn't exist."""
+        results = self.db.execute_query(
+            f"SELECT pt.schemaname, pt.tablename FROM pg_publication p "
+            f"LEFT JOIN pg_publication_tables pt ON pt.pubname = p.pubname "
+            f"WHERE p.pubname = '{self.publication_name}'")
+        if not results:
+            return None
+        return {(schema, table) for schema, table in results if table is not None}
+
+    def build(self, tables, whole_schemas=(), resume=False) -> PublicationReport:
+        published = self.published_tables() if resume else None
+        if published is not None:
+            # Resuming an interrupted build: only the missing tables are added
+            print(f"Publication {self.publication_name} already has {len(published)} tables")
+            tables = [table for table in tables if table not in published]
+            whole_schemas = ()
+        if whole_schemas and not self.supports_schema_publication():
+            print("FOR TABLES IN SCHEMA not supported by the primary, publishing tables one batch at a time")
+            whole_schemas = ()
+
+        report = PublicationReport()
+        created = published is not None
+        with self.db.connection() as conn:
+            for query_kind, query, batch in publication_queries(self.publication_name, tables, whole_schemas,
+                                                                self.batch_size, exists=created):
+                start = time.monotonic()
+                error = self._execute(conn, query)
+                if error is not None and not created:
+                    # The publication must exist before falling back to per-table adds
+                    self._execute(conn, f"CREATE PUBLICATION {self.publication_name};")
+                if error is not None:
+                    print(f"Error {error} with query '{query}' - adding its tables one by one", file=sys.stderr)
+                    for schema, table in batch:
+                        if self._execute(conn, f"ALTER PUBLICATION {self.publication_name} "
+                                               f"ADD TABLE {schema}.{table};") is not None:
+                            report.failed_tables.append((schema, table))
+                created = True
+
+                timing = BatchTiming(query_kind, len(batch), time.monotonic() - start, error is not None)
+                report.timings.append(timing)
+                print(f"Publication {self.publication_name} batch {len(report.timings)} ({query_kind}) : "
+                      f"{timing.tables} tables in {timing.duration:.3f}s")
+
+        for schema, table in report.failed_tables:
+            print(f"Table {schema}.{table} could not be added to publication {self.publication_name}",
+                  file=sys.stderr)
+        return report
+
+    @staticmethod
+    def _execute(conn, query):
+        try:
+            conn.execute(query)
+        except psycopg.Error as e:
+            return e
+        return None
@@ -0,0 +1,92 @@
+import psycopg
+
+from publication import PublicationBuilder, publication_queries
+
+TABLES = [("s1", "t1"), ("s1", "t2"), ("s2", "t3"), ("s2", "t4"), ("s2", "t5")]
+
+
+def test_publication_queries_in_batches():
+    queries = publication_queries("pub", TABLES, batch_size=2)
+
+    assert [query for _, query, _ in queries] == [
+        "CREATE PUBLICATION pub FOR TABLE s1.t1, s1.t2;",
+        "ALTER PUBLICATION pub ADD TABLE s2.t3, s2.t4;",
+        "ALTER PUBLICATION pub ADD TABLE s2.t5;",
+    ]
+
+
+def test_publication_queries_with_whole_schema():
+    queries = publication_queries("pub", TABLES, whole_schemas=["s2"], batch_size=10)
+
+    assert [(kind, query, len(tables)) for kind, query, tables in queries] == [
+        ("schema", "CREATE PUBLICATION pub FOR TABLES IN SCHEMA s2;", 3),
+        ("add", "ALTER PUBLICATION pub ADD TABLE s1.t1, s1.t2;", 2),
+    ]
+
+
+def test_publication_queries_without_tables():
+    assert publication_queries("pub", []) == [("create", "CREATE PUBLICATION pub;", [])]
+
+
+def test_build_falls_back_to_per_table_adds(mocker):
+    db = mocker.MagicMock()
+    conn = db.connection.return_value.__enter__.return_value
+
+    def execute(query):
+        if "s2.t3, s2.t4" in query or query == "ALTER PUBLICATION pub ADD TABLE s2.t4;":
+            raise psycopg.Error("<expected error>")
+
+    conn.execute.side_effect = execute
+
+    report = PublicationBuilder(db, "pub", batch_size=2).build(TABLES)
+
+    executed = [call.args[0] for call in conn.execute.call_args_list]
+    assert executed == [
+        "CREATE PUBLICATION pub FOR TABLE s1.t1, s1.t2;",
+        "ALTER PUBLICATION pub ADD TABLE s2.t3, s2.t4;",
+        "ALTER PUBLICATION pub ADD TABLE s2.t3;",
+        "ALTER PUBLICATION pub ADD TABLE s2.t4;",
+        "ALTER PUBLICATION pub ADD TABLE s2.t5;",
+    ]
+    assert report.failed_tables == [("s2", "t4")]
+    assert [timing.failed for timing in report.timings] == [False, True, False]
+
+
+def test_build_creates_empty_publication_when_first_batch_fails(mocker):
+    db = mocker.MagicMock()
+    conn = db.connection.return_value.__enter__.return_value
+    conn.execute.side_effect = [psycopg.Error("<expected error>"), None, None]
+
+    report = PublicationBuilder(db, "pub").build(TABLES[:1])
+
+    executed = [call.args[0] for call in conn.execute.call_args_list]
+    assert executed == [
+        "CREATE PUBLICATION pub FOR TABLE s1.t1;",
+        "CREATE PUBLICATION pub;",
+        "ALTER PUBLICATION pub ADD TABLE s1.t1;",
+    ]
+    assert report.failed_tables == []
+
+
+def test_build_ignores_whole_schemas_on_old_primary(mocker):
+    db = mocker.MagicMock()
+    db.execute_query.return_value = [["140010"]]
+    conn = db.connection.return_value.__enter__.return_value
+
+    PublicationBuilder(db, "pub").build(TABLES[:2], ["s1"])
+
+    conn.execute.assert_called_once_with("CREATE PUBLICATION pub FOR TABLE s1.t1, s1.t2;")
+
+
+def test_build_resumes_an_existing_publication(mocker):
+    db = mocker.MagicMock()
+    db.execute_query.return_value = [["s1", "t1"], ["s1", "t2"]]
+    conn = db.connection.return_value.__enter__.return_value
+
+    PublicationBuilder(db, "pub", batch_size=2).build(TABLES, ["s1"], resume=True)
+
+    executed = [call.args[0] for call in conn.execute.call_args_list]
+    assert executed == [
+        "ALTER PUBLICATION pub ADD TABLE s2.t3, s2.t4;",
+        "ALTER PUBLICATION pub ADD TABLE s2.t5;",
+    ]
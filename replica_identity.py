@@ -0,0 +1,156 @@
+import dataclasses
+import sys
+
+from database import Database
+from primary import Primary
+
+# Bytes the subscriber scans per second for a table applied without index above which it is flagged
+HOTSPOT_SCANNED_BYTES_PER_SECOND = 64 * 1024 * 1024
+
+REPLICA_IDENTITY_QUERY = """
+SELECT n.nspname, c.relname, c.relreplident, pg_table_size(c.oid),
+       EXISTS (SELECT 1 FROM pg_index i WHERE i.indrelid = c.oid AND i.indisprimary),
+       -- Smallest index usable as replica identity: unique, immediate, valid, not partial, on NOT NULL columns
+       (SELECT ic.relname FROM pg_index i JOIN pg_class ic ON ic.oid = i.indexrelid
+        WHERE i.indrelid = c.oid AND i.indisunique AND i.indimmediate AND i.indisvalid
+          AND i.indpred IS NULL AND i.indexprs IS NULL
+          AND NOT EXISTS (SELECT 1 FROM pg_attribute a
+                          WHERE a.attrelid = c.oid AND a.attnum = ANY (i.indkey) AND NOT a.attnotnull)
+        ORDER BY i.indisprimary DESC, pg_relation_size(i.indexrelid) LIMIT 1),
+       coalesce(s.n_tup_upd, 0), coalesce(s.n_tup_del, 0),
+       extract(epoch FROM now() - coalesce((SELECT stats_reset FROM pg_stat_database
+                                            WHERE datname = current_database()), pg_postmaster_start_time()))
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+WHERE c.relkind = 'r' AND n.nspname IN ({schemas}) AND c.relname <> 'spatial_ref_sys'
+"""
+
+_IDENTITIES = {"d": "default", "i": "index", "f": "full", "n": "nothing"}
+
+
+@dataclasses.dataclass
+class TableIdentity:
+    schema: str
+    name: str
+    # pg_class.relreplident: d(efault), i(ndex), f(ull) or n(othing)
+    replica_identity: str
+    bytes: int
+    has_primary_key: bool
+    candidate_index: str | None = None
+    updates: int = 0
+    deletes: int = 0
+    # Seconds over which updates and deletes were counted
+    seconds: float = 0
+
+    @property
+    def write_rate(self):
+        """Updates and deletes per second."""
+        return (self.updates + self.deletes) / self.seconds if self.seconds > 0 else 0
+
+    @property
+    def lookup(self):
+        """
+        How the apply finds the rows to update or delete on the subscriber.
+
+        index: by the primary key or replica identity index, scan: a
+        sequential scan per changed row, none: updates and deletes fail on
+        the primary once the table is published.
+        """
+        if self.replica_identity == "i" or (self.replica_identity == "d" and self.has_primary_key):
+            return "index"
+        if self.replica_identity == "f":
+            return "scan"
+        return "none"
+
+    @property
+    def scanned_bytes_per_second(self):
+        return self.write_rate * self.bytes if self.lookup == "scan" else 0
+
+    def problem(self, threshold=HOTSPOT_SCANNED_BYTES_PER_SECOND):
+        """
+        >>> TableIdentity("s", "t", "f", 10 ** 9, False, updates=3600, seconds=3600).problem()
+        'apply hotspot'
+        >>> TableIdentity("s", "t", "d", 10 ** 9, False, deletes=1, seconds=3600).problem()
+        'updates fail'
+        """
+        if self.lookup == "none" and self.updates + self.deletes > 0:
+            return "updates fail"
+        if self.lookup == "scan" and self.scanned_bytes_per_second >= threshold:
+            return "apply hotspot"
+        return None
+
+    def fix(self):
+        """The replica identity letting the apply use an index, FULL when updates would fail otherwise."""
+        if self.lookup == "index":
+            return None
+        if self.has_primary_key:
+            identity = "DEFAULT"
+        elif self.candidate_index is not None:
+            identity = f"USING INDEX {self.candidate_index}"
+        elif self.lookup == "none" and self.updates + self.deletes > 0:
+            identity = "FULL"
+        else:
+            return None
+        return f"ALTER TABLE {self.schema}.{self.name} REPLICA IDENTITY {identity};"
+
+
+class ReplicaIdentityAnalyzer:
+    """
+    Classify the published tables of the primary by how the subscriber will apply their changes.
+
+    Tables applied with a sequential scan per changed row and a high write
+    rate are the main cause of a lag that keeps growing, tables without
+    replica identity make updates and deletes fail on the primary.
+    """
+
+    def __init__(self, primary: Primary, threshold=HOTSPOT_SCANNED_BYTES_PER_SECOND):
+        self.db: Database = primary.db
+        self.threshold = threshold
+
+    def analyze(self, db_schemas) -> list:
+        if not db_schemas:
+            return []
+        schemas = ", ".join(f"'{schema}'" for schema in db_schemas)
+        results = self.db.execute_query(REPLICA_IDENTITY_QUERY.format(schemas=schemas)) or []
+        return [TableIdentity(schema, name, replica_identity, size or 0, has_primary_key, candidate_index, updates, deletes, float(seconds or 0))
+                for schema, name, replica_identity, size, has_primary_key, candidate_index, updates, deletes, seconds in results]
+
+    def flagged(self, tables):
+        return [table for table in tables if table.problem(self.threshold) is not None]
+
+    def report(self, tables, output=sys.stdout):
+        counts = {}
+        for table in tables:
+            counts[table.lookup] = counts.get(table.lookup, 0) + 1
+        print(f"Replica identity : {counts.get('index', 0)} tables applied by index, "
+              f"{counts.get('scan', 0)} by sequential scan, {counts.get('none', 0)} without replica identity",
+              file=output)
+        for table in sorted(self.flagged(tables), key=lambda table: -table.scanned_bytes_per_second):
+            print(f"{table.problem(self.threshold)} : {table.schema}.{table.name} "
+                  f"identity {_IDENTITIES.get(table.replica_identity, table.replica_identity)}, "
+                  f"{table.bytes} bytes, {table.write_rate:.1f} updates and deletes per second, "
+                  f"fix : {table.fix() or 'add a primary key or a unique index on NOT NULL columns'}",
+                  file=output)
+
+    def apply(self, tables):
+        """Change the replica identity of the flagged tables having a fix, returns the statements run."""
+        applied = []
+        for table in self.flagged(tables):
+            statement = table.fix()
+            if statement is None:
+                continue
+            print(statement)
+            self.db.execute_query(statement, fetch=False)
+            # Errors are printed by execute_query, the catalog tells whether the change was made
+            if not self._identity_changed(table):
+                print(f"Error changing the replica identity of {table.schema}.{table.name}", file=sys.stderr)
+                continue
+            applied.append(statement)
+        return applied
+
+    def _identity_changed(self, table):
+        results = self.db.execute_query(
+            f"SELECT c.relreplident FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+            f"WHERE n.nspname = '{table.schema}' AND c.relname = '{table.name}'")
+        return bool(results) and results[0][0] != table.replica_identity
@@ -0,0 +1,43 @@
+import io
+
+from primary import Primary
+from replica_identity import ReplicaIdentityAnalyzer, TableIdentity
+
+
+def test_lookup_and_fix_by_replica_identity():
+    tables = [
+        TableIdentity("s", "pk", "d", 100, True),
+        TableIdentity("s", "full_pk", "f", 100, True),
+        TableIdentity("s", "full_unique", "f", 100, False, "full_unique_code_key"),
+        TableIdentity("s", "no_key", "d", 100, False, updates=1),
+        TableIdentity("s", "insert_only", "d", 100, False),
+    ]
+
+    assert [table.lookup for table in tables] == ["index", "scan", "scan", "none", "none"]
+    assert [table.fix() for table in tables] == [
+        None,
+        "ALTER TABLE s.full_pk REPLICA IDENTITY DEFAULT;",
+        "ALTER TABLE s.full_unique REPLICA IDENTITY USING INDEX full_unique_code_key;",
+        "ALTER TABLE s.no_key REPLICA IDENTITY FULL;",
+        None,
+    ]
+
+
+def test_analyzer_flags_and_fixes_hotspots(mocker):
+    db = mocker.MagicMock()
+    db.execute_query.side_effect = [
+        [("s", "events", "f", 10 ** 9, False, "events_id_key", 7200, 0, 3600.0),
+         ("s", "cities", "f", 8192, False, None, 10, 0, 3600.0),
+         ("s", "users", "d", 10 ** 9, True, "users_pkey", 10 ** 6, 0, 3600.0)],
+        None,
+        [("i",)],
+    ]
+    analyzer = ReplicaIdentityAnalyzer(Primary(db), threshold=1024 * 1024)
+
+    tables = analyzer.analyze(["s"])
+    output = io.StringIO()
+    analyzer.report(tables, output)
+
+    assert [table.name for table in analyzer.flagged(tables)] == ["events"]
+    assert "apply hotspot : s.events identity full" in output.getvalue()
+    assert analyzer.apply(tables) == ["ALTER TABLE s.events REPLICA IDENTITY USING INDEX events_id_key;"]
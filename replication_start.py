@@ -1,18 +1,82 @@
+import dataclasses
 import os
 import subprocess
 import datetime
 import sys
-import time
 import psycopg
 from psycopg.errors import Error
-import re
 import secrets
 import string
+import threading
 
+import connection_pool
+import post_data
+import sql_stream
+import tracing
+from archive_restore import RESTORE_JOBS, ArchiveRestore
 from database import Database
-from primary import Primary
+from index_scheduler import IncrementalIndexScheduler, concurrent_index
+from lag_monitor import MetricsServer
+from load_profile import VACUUM_JOBS, BulkLoadProfile
+from migration import PHASES, Migration, MigrationState, MigrationStore, Phase, item_key
+from primary import DbInfos, Primary
+from progress import ByteProgressTracker, SyncProgress, wait_for_initial_sync
+from publication import PUBLICATION_BATCH_SIZE, PublicationBuilder
+from replica_identity import HOTSPOT_SCANNED_BYTES_PER_SECOND, ReplicaIdentityAnalyzer
+from sharding import Shard, plan_shards
+from snapshot_bootstrap import SnapshotBootstrap
+from subscription_tuning import tune_subscriptions
+from wal_guard import ABORT_RATIO, REENABLE_RATIO, WARN_RATIO, WalRetentionExceeded, WalRetentionGuard
 
 WAITING_PROGRESS_IN_SECONDS = 10
+PRE_DATA_BATCH_SIZE = 1000
+
+
+@dataclasses.dataclass
+class ReplicationOptions:
+    pool_size: int = connection_pool.POOL_SIZE
+    publication_batch_size: int = PUBLICATION_BATCH_SIZE
+    publication_by_schema: bool = False
+    pre_data_batch_size: int = PRE_DATA_BATCH_SIZE
+    post_data_jobs: int = 1
+    maintenance_work_mem: str | None = None
+    max_parallel_maintenance_workers: int | None = None
+    # Build each table's secondary indexes concurrently as soon as it is ready, leaving constraints, triggers
+    # and FKs for the disabled window
+    deferred_indexes: bool = False
+    # "plain" parses pg_dump -Fp output, "archive" restores a -Fd dump with pg_restore -j
+    restore_engine: str = "plain"
+    restore_jobs: int = RESTORE_JOBS
+    archive_directory: str | None = None
+    # "subscription" copies the tables with the sync workers, "snapshot" loads them with pg_dump/pg_restore -j
+    # at the exported snapshot of the subscription slot
+    initial_copy: str = "subscription"
+    # "report" flags the tables the apply will scan or fail on, "fix" also changes their replica identity
+    # on the primary before the dump, "off" skips the analysis
+    replica_identity: str = "report"
+    hotspot_bytes_per_second: int = HOTSPOT_SCANNED_BYTES_PER_SECOND
+    # "auto" adds the fastest subscription options both servers support (binary, streaming), "off" keeps the defaults
+    subscription_tuning: str = "auto"
+    # Turn autovacuum off on the secondary tables while they are copied, then VACUUM (ANALYZE) each ready table
+    load_profile: bool = False
+    vacuum_jobs: int = VACUUM_JOBS
+    # Number of publication/subscription pairs sharing the tables
+    shards: int = 1
+    # File receiving the byte-level sync progress as JSON lines, "-" for stdout
+    progress_output: str | None = None
+    # WAL the subscription slots may retain on the primary, None to disable the guard
+    wal_budget_bytes: int | None = None
+    wal_warn_ratio: float = WARN_RATIO
+    wal_reenable_ratio: float = REENABLE_RATIO
+    wal_abort_ratio: float = ABORT_RATIO
+    # Port serving the WAL guard metrics in the Prometheus text format
+    metrics_port: int | None = None
+    # JSON file recording the completed phases so a restart continues from them, None to keep them in memory
+    state_file: str | None = None
+    # Write spans as JSON lines on stderr
+    trace_log: bool = False
+    # File receiving the spans as OpenTelemetry OTLP/JSON lines
+    trace_file: str | None = None
 
 
 def generate_password(length=32):
@@ -31,26 +95,32 @@ def get_db_connection(conn_string):
 
 
 def execute_query(conn_string, query, fetch=True):
+    if connection_pool.get_pool(conn_string) is not None:
+        return Database(conn_string, None).execute_query(query, fetch)
+
     conn = get_db_connection(conn_string)
     if conn is None:
         return None
 
-    try:
-        conn.autocommit = True
-        with conn.cursor() as cur:
-            cur.execute(query)
-            if fetch:
-                results = cur.fetchall()
-                return results
-    except Error as e:
-        print(
-            f"Error {e} with query '{query}' on host '{conn_string}'", file=sys.stderr)
-        return None
-    finally:
-        conn.close()
+    with tracing.span("sql", statement=tracing.statement_attribute(query)) as span:
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(query)
+                if fetch:
+                    results = cur.fetchall()
+                    span.set(rows=len(results))
+                    return results
+        except Error as e:
+            span.record_error(e)
+            print(
+                f"Error {e} with query '{query}' on host '{conn_string}'", file=sys.stderr)
+            return None
+        finally:
+            conn.close()
 
 
-def run_dump_restore_pre(conn_sender_string, db_schemas, conn_receiver_string):
+def pre_data_command(conn_sender_string, db_schemas):
     command = [
         "pg_dump",
         "-d", conn_sender_string,
@@ -64,34 +134,72 @@ def run_dump_restore_pre(conn_sender_string, db_schemas, conn_receiver_string):
     for schema in db_schemas:
         command.append("-n")
         command.append(schema)
+    return command
 
-    print(f" dump section pre-data")
-    print(" ".join(command))
 
-    dump = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+def is_restored_pre_data(statement):
+    # ignore "\restrict" and "\unrestrict" lines, the public schema exists already
+    return not sql_stream.is_restrict_command(statement) and statement != "CREATE SCHEMA public;"
 
-    # Connection to the database
-    with psycopg.connect(conn_receiver_string) as conn:
-        with conn.cursor() as cur:
-            try:
-                print(f"pg_restore pre begin")
-                dump_queries = dump.stdout.read()
-                result = dump_queries.replace("CREATE SCHEMA public;", "")
-                # ignore "\restrict" and "\unrestrict" lines
-                result = re.sub("\\\\(un)?restrict.*\n", "", result)
-                cur.execute(result)
 
-                # Commit of the changes
-                conn.commit()
+def run_dump_restore_pre(conn_sender_string, db_schemas, conn_receiver_string, batch_size=PRE_DATA_BATCH_SIZE,
+                         skip=0, on_commit=None):
+    command = pre_data_command(conn_sender_string, db_schemas)
+    print(f" dump section pre-data")
+    print(" ".join(command))
 
-            except Exception as e:
-                print(f"An error occurred: {e}")
-                conn.rollback()
+    with tracing.span("restore pre-data", schemas=len(db_schemas), skip=skip) as span:
+        dump = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
 
+        # Connection to the database
+        with psycopg.connect(conn_receiver_string) as conn:
+            with conn.cursor() as cur:
+                try:
+                    print(f"pg_restore pre begin")
+                    # Statements are restored while pg_dump is still writing them,
+                    # committed every batch_size statements. The first skip ones were
+                    # committed by an interrupted run, on_commit gets the new count.
+                    pending = 0
+                    position = 0
+                    for statement in sql_stream.statements(tracing.counted(dump.stdout, span)):
+                        if not is_restored_pre_data(statement):
+                            continue
+                        position += 1
+                        if position <= skip and post_data.parse_unit(statement).kind != "setting":
+                            continue
+                        cur.execute(statement)
+                        pending += 1
+                        if pending >= batch_size:
+                            conn.commit()
+                            pending = 0
+                            if on_commit is not None:
+                                on_commit(position)
+
+                    # Commit of the changes
+                    conn.commit()
+                    if on_commit is not None:
+                        on_commit(position)
+                    span.set(statements=position)
+                    restored = True
+
+                except Exception as e:
+                    span.record_error(e)
+                    print(f"An error occurred: {e}")
+                    conn.rollback()
+                    restored = False
+                finally:
+                    dump.stdout.close()
+                    dump.wait()
+        span.set(returncode=dump.returncode)
+
+    if dump.returncode != 0:
+        print(f"Error pg_dump exited with code {dump.returncode}", file=sys.stderr)
+        restored = False
     print(f"run_dump_restore_pre end")
+    return restored
 
 
-def run_dump_restore_post_onlypk(conn_sender_string, db_schemas, conn_receiver_string):
+def post_data_command(conn_sender_string, db_schemas):
     command = [
         "pg_dump",
         "-d", conn_sender_string,
@@ -103,97 +211,534 @@ def run_dump_restore_post_onlypk(conn_sender_string, db_schemas, conn_receiver_s
     for schema in db_schemas:
         command.append("-n")
         command.append(schema)
+    return command
 
+
+def dump_post_data(conn_sender_string, db_schemas) -> post_data.PostData:
+    command = post_data_command(conn_sender_string, db_schemas)
     print(f" dump section post-data")
     print(" ".join(command))
 
-    dump = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
-
-    # Connection to the database
-    with psycopg.connect(conn_receiver_string) as conn:
-        with conn.cursor() as cur:
-            try:
-                print(f"pg_restore post début")
-                dump_str = dump.stdout.read()
-                # ignore "\restrict" and "\unrestrict" lines
-                dump_str = re.sub("\\\\(un)?restrict.*\n", "", dump_str)
-                splitlines = dump_str.splitlines()
-                current_query = ""
-                for i in range(0, len(splitlines) - 1):
-                    if re.match(r'.*ADD CONSTRAINT.*PRIMARY KEY.*', splitlines[i]):
-                        current_query = current_query + \
-                                        splitlines[i - 1] + splitlines[i]
-
-                cur.execute(current_query)
+    with tracing.span("dump post-data", schemas=len(db_schemas)) as span:
+        dump = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+        try:
+            dump_post = post_data.PostData.parse(sql_stream.statements(tracing.counted(dump.stdout, span)))
+        finally:
+            dump.stdout.close()
+            dump.wait()
+        span.set(statements=len(dump_post.units), **dump_post.counts())
+    print(f"post-data statements : {dump_post.counts()}")
+    return dump_post
+
+
+def run_dump_restore_post_onlypk(conn_sender_string, db_schemas, conn_receiver_string,
+                                 dump_post: post_data.PostData = None):
+    if dump_post is None:
+        dump_post = dump_post_data(conn_sender_string, db_schemas)
+    units = dump_post.primary_keys()
+
+    with tracing.span("restore primary keys", statements=len(units)) as span:
+        # Connection to the database
+        with psycopg.connect(conn_receiver_string) as conn:
+            with conn.cursor() as cur:
+                try:
+                    print(f"pg_restore post begin")
+                    cur.execute(dump_post.script(units))
+
+                    # Commit of changes
+                    conn.commit()
+                    restored = True
+
+                except Exception as e:
+                    span.record_error(e)
+                    print(f"An error occurred: {e}")
+                    conn.rollback()
+                    restored = False
+
+    print(f"run_dump_restore_post end")
+    return restored
+
+
+def run_post_data_units(conn_receiver_string, units, jobs, maintenance_work_mem=None,
+                        max_parallel_maintenance_workers=None, stop_event=None, on_executed=None):
+    print(f"pg_restore post on {jobs} connections")
+    executor = post_data.ParallelPostDataExecutor(conn_receiver_string, jobs, maintenance_work_mem,
+                                                  max_parallel_maintenance_workers, on_executed)
+    with tracing.span("restore post-data units", jobs=jobs, statements=len(units)) as span:
+        report = executor.run(units, stop_event)
+        span.set(executed=report.executed, failures=len(report.failures), skipped=len(report.skipped))
+    print(f"pg_restore post : {report.executed} statements in {report.duration:.3f}s, "
+          f"{len(report.failures)} errors, {len(report.skipped)} skipped")
+    return report
+
+
+def run_dump_restore_post_without_pk(conn_sender_string, db_schemas, conn_receiver_string, jobs=1,
+                                     maintenance_work_mem=None, max_parallel_maintenance_workers=None,
+                                     dump_post: post_data.PostData = None):
+    if dump_post is None:
+        dump_post = dump_post_data(conn_sender_string, db_schemas)
+    units = dump_post.without_primary_keys()
+    if jobs > 1:
+        run_post_data_units(conn_receiver_string, units, jobs, maintenance_work_mem,
+                            max_parallel_maintenance_workers)
+        print(f"run_dump_restore_post_without_pk end")
+        return
+
+    with tracing.span("restore post-data", statements=len(units)) as span:
+        # Connection to the database
+        with psycopg.connect(conn_receiver_string) as conn:
+            with conn.cursor() as cur:
+                try:
+                    print(f"pg_restore post (without PK) begin")
+                    cur.execute(dump_post.script(units))
+                    conn.commit()
 
-                # Commit of changes
-                conn.commit()
+                    print(f"pg_restore post (without PK) done")
 
-            except Exception as e:
-                print(f"Une erreur s'est produite : {e}")
-                conn.rollback()
+                except Exception as e:
+                    span.record_error(e)
+                    print(f"An error occurred: {e}")
+                    conn.rollback()
 
-    print(f"run_dump_restore_post fin")
+            conn.rollback()
+    print(f"run_dump_restore_post_without_pk end")
 
 
-def run_dump_restore_post_without_pk(conn_sender_string, db_schemas, conn_receiver_string):
-    command = [
-        "pg_dump",
-        "-d", conn_sender_string,
-        "-Fp",
-        "-T", "public.spatial_ref_sys",
-        "--no-acl",
-        f"--section=post-data"
+def print_sync_progress(progress: SyncProgress):
+    if progress.done:
+        print(f"The first step of logical replication is done : {progress.ready}/{progress.total}")
+    else:
+        print(f"Replication progress : {progress.ready}/{progress.total} - retrying in {progress.interval:.1f}s")
+
+
+def chain_progress_callbacks(callbacks):
+    def on_progress(progress: SyncProgress):
+        for callback in callbacks:
+            callback(progress)
+
+    return on_progress
+
+
+def set_subscriptions_enabled(conn_secondary, subscription_names, enabled):
+    action = "ENABLE" if enabled else "DISABLE"
+    for subscription_name in subscription_names:
+        print(f"{action.capitalize()} subscription {subscription_name} on {conn_secondary}")
+        query = f"ALTER SUBSCRIPTION {subscription_name} {action};"
+        execute_query(conn_secondary, query, fetch=False)
+
+
+def drop_subscriptions(conn_primary, conn_secondary, subscription_names):
+    # DROP SUBSCRIPTION also drops the slot on the primary, the second query catches the ones left behind
+    for subscription_name in subscription_names:
+        print(f"Drop subscription {subscription_name} on {conn_secondary}")
+        execute_query(conn_secondary, f"ALTER SUBSCRIPTION {subscription_name} DISABLE;", fetch=False)
+        execute_query(conn_secondary, f"DROP SUBSCRIPTION IF EXISTS {subscription_name};", fetch=False)
+    slots = ", ".join(f"'{subscription_name}'" for subscription_name in subscription_names)
+    execute_query(conn_primary, f"SELECT pg_drop_replication_slot(slot_name) FROM pg_replication_slots "
+                                f"WHERE slot_name IN ({slots}) AND NOT active")
+
+
+@dataclasses.dataclass
+class ReplicationContext:
+    """State shared by the phases of one replication run."""
+    conn_primary: str
+    db_primary: str
+    conn_secondary: str
+    db_secondary: str
+    options: ReplicationOptions
+    migration: Migration
+    db_infos: DbInfos | None = None
+    archive: ArchiveRestore | None = None
+    connection_primary_full: str | None = None
+    replication_password: str | None = None
+    scheduler: IncrementalIndexScheduler | None = None
+    guard: WalRetentionGuard | None = None
+    metrics_server: MetricsServer | None = None
+    # Stops the post-data statements when the subscriptions have to be enabled early
+    stop_post_data: threading.Event = dataclasses.field(default_factory=threading.Event)
+    _subscription_names: list = dataclasses.field(default_factory=list)
+    _post_data: post_data.PostData | None = None
+
+    @property
+    def unique_name(self):
+        return self.migration.state.unique_name
+
+    @property
+    def db_schemas(self):
+        return self.db_infos.db_schemas
+
+    def shards(self):
+        # Planned once, a restart must publish the tables the same way
+        if "shards" not in self.migration.state.data:
+            tables = self.db_infos.tables.publication_tables()
+            table_sizes = self.db_infos.tables.table_sizes(total=True)
+            shards = plan_shards({table: table_sizes.get(table, 0) for table in tables}, self.options.shards)
+            self.migration.record("shards", [[shard.index, [list(table) for table in shard.tables], shard.bytes]
+                                             for shard in shards])
+        return [Shard(index, [tuple(table) for table in tables], size)
+                for index, tables, size in self.migration.state.data["shards"]]
+
+    def subscription_names(self):
+        if not self._subscription_names:
+            results = execute_query(
+                self.conn_secondary,
+                f"select subname from pg_subscription where subname like 'subscription_{self.db_primary}_%'")
+            self._subscription_names = [result[0] for result in results or []]
+        return self._subscription_names
+
+    def post_data(self):
+        # Dumped and parsed once, read by the primary keys, deferred indexes and post-data phases
+        if self._post_data is None:
+            self._post_data = dump_post_data(self.conn_primary, self.db_schemas)
+        return self._post_data
+
+    def subscription_options(self):
+        # Chosen once, a restart creates the remaining subscriptions the same way
+        if "subscription_options" not in self.migration.state.data:
+            options = {}
+            if self.options.subscription_tuning == "auto":
+                shards = self.shards()
+                tuning = tune_subscriptions(Database(self.conn_primary, self.db_primary),
+                                            Database(self.conn_secondary, self.db_secondary), self.db_schemas,
+                                            len(shards), sum(len(shard.tables) for shard in shards),
+                                            self.options.initial_copy != "snapshot")
+                for warning in tuning.warnings:
+                    print(f"Warning : {warning}", file=sys.stderr)
+                options = tuning.options
+            self.migration.record("subscription_options", options)
+        options = self.migration.state.data["subscription_options"]
+        print(f"Subscription options : {options or 'defaults'}")
+        return options
+
+    def load_profile(self, subscription_names=None):
+        tables = self.db_infos.tables.publication_tables()
+        table_sizes = self.db_infos.tables.table_sizes()
+        return BulkLoadProfile(Database(self.conn_secondary, self.db_secondary),
+                               {table: table_sizes.get(table, 0) for table in tables}, subscription_names,
+                               self.options.vacuum_jobs, self.migration.state.data.get("load_profile"),
+                               [key.split(".", 1) for key in self.migration.state.done_items("vacuum")],
+                               lambda table: self.migration.mark_item("vacuum", ".".join(table)))
+
+    def mark_post_data_unit(self, unit):
+        self.migration.mark_item("post_data", item_key(unit.statement))
+
+    def pending_post_data_units(self, units):
+        done = self.migration.state.done_items("post_data")
+        return [unit for unit in units if unit.kind == "setting" or item_key(unit.statement) not in done]
+
+    def wal_guard(self):
+        if self.guard is None and self.options.wal_budget_bytes is not None:
+            subscription_names = self.subscription_names()
+            # The slots are named after the subscriptions
+            self.guard = WalRetentionGuard(Database(self.conn_primary, self.db_primary), subscription_names,
+                                           self.options.wal_budget_bytes, self.options.wal_warn_ratio,
+                                           self.options.wal_reenable_ratio, self.options.wal_abort_ratio)
+
+            def abort_replication():
+                print("WAL retention budget exceeded, dropping the subscriptions and their slots", file=sys.stderr)
+                self.stop_post_data.set()
+                drop_subscriptions(self.conn_primary, self.conn_secondary, subscription_names)
+
+            self.guard.on_abort = abort_replication
+            if self.options.metrics_port is not None:
+                self.metrics_server = MetricsServer(self.options.metrics_port, self.guard.metrics).start()
+        return self.guard
+
+
+def create_role_query(password):
+    return f"CREATE USER replication LOGIN ENCRYPTED PASSWORD '{password}'; ALTER ROLE replication WITH REPLICATION"
+
+
+def grant_query(schema):
+    return f"GRANT SELECT ON ALL TABLES IN SCHEMA {schema} TO replication; GRANT USAGE ON SCHEMA {schema} TO replication"
+
+
+def subscription_query(subscription_name, connection, publication_name, initial_copy="subscription",
+                       tuning_options=None):
+    # Tables already loaded at the snapshot of the slot are not copied again
+    copy_options = ("copy_data=false, create_slot=false" if initial_copy == "snapshot"
+                    else "copy_data=true, create_slot=true")
+    tuning = "".join(f", {name}={value}" for name, value in (tuning_options or {}).items())
+    return (f"CREATE SUBSCRIPTION {subscription_name} CONNECTION '{connection}' PUBLICATION {publication_name} "
+            f"with ({copy_options}, enabled=true, slot_name='{subscription_name}'{tuning});")
+
+
+def publication_whole_schemas(db_infos: DbInfos, options: ReplicationOptions):
+    if not options.publication_by_schema or options.shards > 1:
+        return []
+    # Partitioned tables and spatial_ref_sys are not published, so their schema can't be as a whole
+    tables = db_infos.tables.publication_tables()
+    partial_schemas = {table.schema for table in db_infos.tables
+                       if table.relkind != 'r' or table.name == 'spatial_ref_sys'}
+    return sorted({schema for schema, _ in tables} - partial_schemas)
+
+
+def replication_role_exists(ctx: ReplicationContext):
+    # Verify if replication user already exist
+    results = execute_query(ctx.conn_primary, "SELECT count(rolname) FROM pg_roles WHERE rolname ='replication'")
+    if results and results[0][0] > 0:
+        print(f"user replication already exist")
+        return True
+    return False
+
+
+def create_replication_role(ctx: ReplicationContext):
+    print(f" create replication user on {ctx.conn_primary}")
+    execute_query(ctx.conn_primary, create_role_query(ctx.replication_password), fetch=False)
+    print(f"user replication created")
+
+
+def grant_replication_role(ctx: ReplicationContext):
+    for schema in ctx.db_schemas:
+        # Grant privileges on the schema
+        execute_query(ctx.conn_primary, grant_query(schema), fetch=False)
+        print(f"GRANT right on {schema} to replication user")
+
+
+def check_replica_identities(ctx: ReplicationContext):
+    if ctx.options.replica_identity == "off":
+        return
+    analyzer = ReplicaIdentityAnalyzer(Primary(Database(ctx.conn_primary, ctx.db_primary)),
+                                       ctx.options.hotspot_bytes_per_second)
+    tables = analyzer.analyze(ctx.db_schemas)
+    analyzer.report(tables)
+    if ctx.options.replica_identity == "fix":
+        # Changed before the dump, so the secondary gets the same replica identities
+        applied = analyzer.apply(tables)
+        print(f"Replica identity changed on {len(applied)} tables")
+
+
+def restore_pre_data(ctx: ReplicationContext):
+    if ctx.archive is not None:
+        return ctx.archive.restore_pre_data()
+    # Statements committed by an interrupted run are skipped
+    return run_dump_restore_pre(ctx.conn_primary, ctx.db_schemas, ctx.conn_secondary,
+                                ctx.options.pre_data_batch_size, skip=ctx.migration.state.position("pre_data"),
+                                on_commit=lambda position: ctx.migration.set_position("pre_data", position))
+
+
+def restore_primary_keys(ctx: ReplicationContext):
+    if ctx.archive is not None:
+        return ctx.archive.restore_primary_keys()
+    return run_dump_restore_post_onlypk(ctx.conn_primary, ctx.db_schemas, ctx.conn_secondary, ctx.post_data())
+
+
+def create_publications(ctx: ReplicationContext):
+    print(f"Create publication on primary {ctx.conn_primary} database {ctx.db_primary}")
+    whole_schemas = publication_whole_schemas(ctx.db_infos, ctx.options)
+    done = ctx.migration.state.done_items("publication")
+    # Tables balanced by bytes over several publication/subscription pairs
+    for shard in ctx.shards():
+        publication_name = f"publication_{ctx.unique_name}{shard.suffix(ctx.options.shards)}"
+        if publication_name in done:
+            continue
+        if ctx.options.shards > 1:
+            print(f"Shard {shard.index} : {len(shard.tables)} tables, {shard.bytes} bytes")
+        # An interrupted build is resumed with the tables missing from the publication
+        PublicationBuilder(Database(ctx.conn_primary, ctx.db_primary), publication_name,
+                           ctx.options.publication_batch_size).build(shard.tables, whole_schemas, resume=True)
+        ctx.migration.mark_item("publication", publication_name)
+
+
+def disable_autovacuum(ctx: ReplicationContext):
+    if not ctx.options.load_profile:
+        return
+    # Saved before the change, a restart gives the tables their own settings back
+    ctx.migration.record("load_profile", ctx.load_profile().disable())
+
+
+def snapshot_copy(ctx: ReplicationContext):
+    if ctx.options.initial_copy != "snapshot":
+        return
+    bootstrap = SnapshotBootstrap(ctx.conn_primary, ctx.conn_secondary, ctx.options.restore_jobs,
+                                  ctx.options.archive_directory)
+    done = ctx.migration.state.done_items("snapshot_copy")
+    for shard in ctx.shards():
+        # The slot is named after the subscription created on it
+        slot_name = f"subscription_{ctx.unique_name}{shard.suffix(ctx.options.shards)}"
+        if slot_name in done:
+            continue
+        print(f"Load {len(shard.tables)} tables at the snapshot of slot {slot_name}")
+        if not bootstrap.load(slot_name, shard.tables):
+            print(f"Error loading the tables of slot {slot_name}, exiting", file=sys.stderr)
+            return False
+        ctx.migration.mark_item("snapshot_copy", slot_name)
+
+
+def create_subscriptions(ctx: ReplicationContext):
+    tuning_options = ctx.subscription_options()
+    # Create subscriptions on secondary, each with its own slot
+    for shard in ctx.shards():
+        suffix = shard.suffix(ctx.options.shards)
+        subscription_name = f"subscription_{ctx.unique_name}{suffix}"
+        results = execute_query(ctx.conn_secondary,
+                                f"SELECT 1 FROM pg_subscription WHERE subname = '{subscription_name}'")
+        if results:
+            print(f"Subscription {subscription_name} already exists")
+            continue
+        print(f"Create subscription {subscription_name} on secondary {ctx.conn_secondary} database {ctx.db_secondary}")
+        execute_query(ctx.conn_secondary,
+                      subscription_query(subscription_name, ctx.connection_primary_full,
+                                         f"publication_{ctx.unique_name}{suffix}", ctx.options.initial_copy,
+                                         tuning_options),
+                      fetch=False)
+
+
+def wait_initial_sync(ctx: ReplicationContext):
+    # Check if replication is still running
+    subscription_names = ctx.subscription_names()
+    if not subscription_names:
+        print("No replication running, exiting")
+        return False
+
+    # Wait for the first step of replication to complete
+    print(f"Check if first step of replication is done - db {ctx.db_secondary} on host {ctx.conn_secondary} from {ctx.conn_primary} database {ctx.db_primary}")
+    options = ctx.options
+    progress_callbacks = [print_sync_progress]
+    progress_file = None
+    if options.progress_output is not None:
+        # Byte-level progress and ETA as JSON lines
+        progress_file = sys.stdout if options.progress_output == "-" else open(options.progress_output, "a")
+        progress_callbacks.append(ByteProgressTracker(Database(ctx.conn_secondary, ctx.db_secondary),
+                                                      ctx.db_infos.tables.table_sizes(),
+                                                      progress_file, subscription_names=subscription_names))
+    if options.deferred_indexes:
+        # Indexes of each table are built concurrently as soon as the table is ready
+        units = ctx.post_data().without_primary_keys()
+        ctx.scheduler = IncrementalIndexScheduler(Database(ctx.conn_secondary, ctx.db_secondary),
+                                                  ctx.pending_post_data_units(units), subscription_names,
+                                                  max(options.post_data_jobs, 1), options.maintenance_work_mem,
+                                                  options.max_parallel_maintenance_workers, ctx.mark_post_data_unit)
+        progress_callbacks.append(ctx.scheduler)
+    profile = None
+    if options.load_profile:
+        # Tables get their autovacuum settings back and are analyzed as soon as they are ready
+        profile = ctx.load_profile(subscription_names)
+        progress_callbacks.append(profile)
+    guard = ctx.wal_guard()
+    if guard is not None:
+        progress_callbacks.append(guard)
+    synced = False
+    try:
+        wait_for_initial_sync(Database(ctx.conn_secondary, ctx.db_secondary), subscription_names,
+                              on_progress=chain_progress_callbacks(progress_callbacks),
+                              max_interval=WAITING_PROGRESS_IN_SECONDS)
+        synced = True
+    except Error as e:
+        print(f"Error {e} while waiting for the first step of replication on host {ctx.conn_secondary}",
+              file=sys.stderr)
+    except WalRetentionExceeded as e:
+        print(f"Replication aborted while waiting for the first step : {e}", file=sys.stderr)
+    finally:
+        if progress_file is not None and progress_file is not sys.stdout:
+            progress_file.close()
+        if ctx.scheduler is not None:
+            print("Waiting for the post-data objects built while syncing")
+            report = ctx.scheduler.wait()
+            print(f"Post-data built while syncing : {report.executed} statements, "
+                  f"{len(report.failures)} errors")
+        if profile is not None:
+            print("Waiting for the tables analyzed while syncing")
+            profile.wait()
+    return synced and (guard is None or not guard.aborted)
+
+
+def restore_post_data(ctx: ReplicationContext):
+    options = ctx.options
+    subscription_names = ctx.subscription_names()
+    if not subscription_names:
+        print("No replication running, exiting")
+        return False
+
+    # Disable subscriptions
+    set_subscriptions_enabled(ctx.conn_secondary, subscription_names, False)
+    guard = ctx.wal_guard()
+    # pg_restore can't be stopped midway, the archive engine only warns or aborts
+    if guard is not None and ctx.archive is None:
+        def reenable_early():
+            print("WAL retention budget nearly reached, enabling the subscriptions before the end of post-data",
+                  file=sys.stderr)
+            ctx.stop_post_data.set()
+            set_subscriptions_enabled(ctx.conn_secondary, subscription_names, True)
+
+        guard.on_reenable = reenable_early
+    if guard is not None:
+        guard.start()
+
+    # Restore post section without primary keys
+    print("Restore post section - without primary key")
+    units = None
+    if ctx.scheduler is not None:
+        units = ctx.scheduler.remaining_units()
+    elif ctx.archive is None and (guard is not None or options.post_data_jobs > 1
+                                  or ctx.migration.store.path is not None):
+        # Statements run one by one so the guard can stop them and a restart can skip the done ones
+        units = ctx.post_data().without_primary_keys()
+    report = None
+    restored = True
+    if units is not None:
+        units = ctx.pending_post_data_units(units)
+        report = run_post_data_units(ctx.conn_secondary, units, max(options.post_data_jobs, 1),
+                                     options.maintenance_work_mem, options.max_parallel_maintenance_workers,
+                                     ctx.stop_post_data, ctx.mark_post_data_unit)
+    elif ctx.archive is not None:
+        restored = ctx.archive.restore_post_data_without_pk()
+    else:
+        run_dump_restore_post_without_pk(
+            ctx.conn_primary, ctx.db_schemas, ctx.conn_secondary, options.post_data_jobs,
+            options.maintenance_work_mem, options.max_parallel_maintenance_workers, ctx.post_data())
+
+    if guard is not None:
+        guard.stop()
+        if guard.aborted:
+            return False
+    if not restored:
+        return False
+
+    if report is not None and report.skipped:
+        # Resume the statements stopped by the guard, building indexes without blocking the apply
+        set_subscriptions_enabled(ctx.conn_secondary, subscription_names, True)
+        print(f"Resuming {len(report.skipped)} post-data statements on the enabled subscriptions")
+        settings = [unit for unit in units if unit.kind == "setting"]
+        run_post_data_units(ctx.conn_secondary, settings + [concurrent_index(unit) or unit for unit in report.skipped],
+                            max(options.post_data_jobs, 1), options.maintenance_work_mem,
+                            options.max_parallel_maintenance_workers, on_executed=ctx.mark_post_data_unit)
+
+
+def enable_subscriptions(ctx: ReplicationContext):
+    set_subscriptions_enabled(ctx.conn_secondary, ctx.subscription_names(), True)
+    end_time = datetime.datetime.now().strftime("%Y%m%d-%H-%M-%S")
+    print(f"end={end_time}")
+
+
+def replication_phases(ctx: ReplicationContext):
+    return [
+        Phase("roles", lambda: create_replication_role(ctx), lambda: replication_role_exists(ctx)),
+        Phase("grants", lambda: grant_replication_role(ctx)),
+        Phase("replica_identity", lambda: check_replica_identities(ctx)),
+        Phase("pre_data", lambda: restore_pre_data(ctx)),
+        Phase("primary_keys", lambda: restore_primary_keys(ctx)),
+        Phase("publication", lambda: create_publications(ctx)),
+        Phase("load_profile", lambda: disable_autovacuum(ctx)),
+        Phase("snapshot_copy", lambda: snapshot_copy(ctx)),
+        Phase("subscription", lambda: create_subscriptions(ctx)),
+        Phase("sync_wait", lambda: wait_initial_sync(ctx)),
+        Phase("post_data", lambda: restore_post_data(ctx)),
+        Phase("enable", lambda: enable_subscriptions(ctx)),
     ]
-    for schema in db_schemas:
-        command.append("-n")
-        command.append(schema)
 
-    print(f" dump section post-data without primary keys")
-    print(" ".join(command))
 
-    dump = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+def main(name, conn_primary, db_primary, conn_secondary, db_secondary, list_schema_excluded, options=None,
+         connection_primary_full=None):
+    if options is None:
+        options = ReplicationOptions()
 
-    # Connection to the database
-    with psycopg.connect(conn_receiver_string) as conn:
-        with conn.cursor() as cur:
-            try:
-                print(f"pg_restore post (without PK) début")
-                dump_str = dump.stdout.read()
-                # ignore "\restrict" and "\unrestrict" lines
-                dump_str = re.sub("\\\\(un)?restrict.*\n", "", dump_str)
-                splitlines = dump_str.splitlines()
-                current_query = ""
-                line_before = ""
-                for i in range(0, len(splitlines) - 1):
-                    # Skip primary key constraints
-                    if re.match(r'.*ADD CONSTRAINT.*PRIMARY KEY.*', splitlines[i]):
-                        line_before = ""
-                        continue
-                    else:
-                        current_query += line_before
-                        line_before = splitlines[i] + "\n"
-
-                current_query += line_before
-                cur.execute(current_query)
-                conn.commit()
-
-                print(f"pg_restore post (without PK) terminé avec succès")
-
-            except Exception as e:
-                print(f"Une erreur s'est produite : {e}")
-                conn.rollback()
-
-        conn.rollback()
-    print(f"run_dump_restore_post_without_pk fin")
-
-
-def main(name, conn_primary, db_primary, conn_secondary, db_secondary, list_schema_excluded):
     # Random replication password
     replication_password = generate_password()
 
-    # Get the primary db connexion string fron environment
-    connection_primary_full = os.environ.get('CONN_DB_PRIMARY_FULL')
+    # Get the primary db connexion string fron environment, unless given
+    if connection_primary_full is None:
+        connection_primary_full = os.environ.get('CONN_DB_PRIMARY_FULL')
 
     print(f"START SCRIPT")
     print(f"python {name} {conn_primary} {db_primary} {conn_secondary} {db_secondary}")
@@ -202,159 +747,122 @@ def main(name, conn_primary, db_primary, conn_secondary, db_secondary, list_sche
     today = datetime.datetime.now().strftime("%Y%m%d-%H-%M-%S")
     print(f"\n\nStarting script : {name} at {today}\n")
 
-    date_start = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    unique_name = f"{db_primary}_{date_start}"
-
-    # Retrieve DB Infos
-    primary = Primary(Database(conn_primary, db_primary))
-    db_infos = primary.retrieve_db_infos(list_schema_excluded)
-    db_schemas = db_infos.db_schemas
-    print(f"$today - Starting pg_dump from server {conn_primary} database {db_primary} {db_infos.db_size}")
-    print(f"db_schemas : {db_infos.db_schemas}")
-    print(f"db_size : {db_infos.db_size}")
-    print(f"db_tables : {db_infos.db_tables}")
-
-    # # Check if replication is already started
-    query = f"select subslotname from pg_subscription where subname like 'subscription_{db_secondary}_%'"
-    print(f"psql \"{conn_secondary}\" --no-align -tc \"{query}\"")
-    results = execute_query(conn_secondary, query)
-    if results is None:
-        print(
-            f"Error on query {query} on host {conn_secondary}", file=sys.stderr)
-
+    # A restart continues the run recorded in the state file, with its unique name
+    store = MigrationStore(options.state_file)
+    state = store.load()
+    if state is None:
+        date_start = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        state = MigrationState(f"{db_primary}_{date_start}", db_primary, db_secondary)
+    elif (state.db_primary, state.db_secondary) != (db_primary, db_secondary):
+        print(f"State file {options.state_file} belongs to the replication of {state.db_primary} "
+              f"to {state.db_secondary}", file=sys.stderr)
+        sys.exit(1)
     else:
-
-        # Check if replication is already started
-        if not results:
-
-            print("Replication not in progress")
-            print(f"{today} - Starting process : {name} {conn_primary} {db_primary} - {conn_secondary} database {db_secondary}")
-
-            print(f" create replication user on {conn_primary}")
-            # Verify if replication user already exist
-            results = execute_query(
-                conn_primary, "SELECT count(rolname) FROM pg_roles WHERE rolname ='replication'")
-            if results and results[0][0] > 0:
-                print(f"user replication already exist")
-            else:
-                execute_query(conn_primary, f"CREATE USER replication LOGIN ENCRYPTED PASSWORD '{replication_password}'; "
-                                            f"ALTER ROLE replication WITH REPLICATION", fetch=False)
-                print(f"user replication created")
-
-            for schema in db_schemas:
-                # Grant privileges on the schema
-                execute_query(conn_primary, f"GRANT SELECT ON ALL TABLES IN SCHEMA {schema} TO replication; "
-                                            f"GRANT USAGE ON SCHEMA {schema} TO replication", fetch=False)
-                print(f"GRANT right on {schema} to replication user")
-
-            # Section pre-data
-            run_dump_restore_pre(conn_primary,
-                                 db_schemas, conn_secondary)
-
-            # Section post-data
-            run_dump_restore_post_onlypk(
-                conn_primary, db_schemas, conn_secondary)
-
-            # Create publication on primary
-            print(
-                f"Create publication on primary {conn_primary} database {db_primary}")
-            execute_query(conn_primary,
-                          f"CREATE PUBLICATION publication_{unique_name};", fetch=False)
-            # Add tables to publication
-            query_publication = f"select schemaname, relname from pg_stat_user_tables where relname <> 'spatial_ref_sys'"
-            if db_infos.schema_excluded_str != "":
-                query_publication = query_publication + f" AND schemaname NOT IN ({db_infos.schema_excluded_str})"
-            results = execute_query(conn_primary, query_publication)
-            if results:
-                for schema, table in results:
-                    print(
-                        f"Add table {schema}.{table} to publication {unique_name}")
-                    execute_query(conn_primary,
-                                  f"ALTER PUBLICATION publication_{unique_name} ADD TABLE {schema}.{table};", fetch=False)
-
-            # Create subscription on secondary
-            subscription_name = f"subscription_{unique_name}"
-            print(
-                f"Create subscription on secondary {conn_secondary} database {db_secondary}")
-            execute_query(conn_secondary,
-                          f"CREATE SUBSCRIPTION {subscription_name} CONNECTION '{connection_primary_full}' PUBLICATION publication_{unique_name} with (copy_data=true, create_slot=true, enabled=true, slot_name='{subscription_name}');",
-                          fetch=False)
-
-        # Check if replication is still running
-        results = execute_query(
-            conn_secondary, f"select subname from pg_subscription where subname like 'subscription_{db_primary}_%'")
-        if results:
-            subscription_name = results[0][0]
-            # Wait for the first step of replication to complete
-            while True:
-                print(
-                    f"Check if first step of replication is done - db {db_secondary} on host {conn_secondary} from {conn_primary} database {db_primary}")
-
-                query = "select a.* from pg_subscription_rel a inner join pg_class on srrelid=pg_class.oid where relname <> 'spatial_ref_sys' and srsubstate <> 'r';"
+        print(f"Resuming replication {state.unique_name}, completed phases : {', '.join(state.completed)}")
+    migration = Migration(state, store)
+
+    # One connection pool per endpoint, shared by Primary and every query below
+    connection_pool.open_pool(conn_primary, options.pool_size)
+    connection_pool.open_pool(conn_secondary, options.pool_size)
+    completed = False
+    ctx = ReplicationContext(conn_primary, db_primary, conn_secondary, db_secondary, options, migration,
+                             connection_primary_full=connection_primary_full,
+                             replication_password=replication_password)
+    # Spans of the phases, statements and dumps as JSON logs and/or OpenTelemetry spans, of this migration only
+    exporters = []
+    if options.trace_log:
+        exporters.append(tracing.JsonLogExporter())
+    if options.trace_file is not None:
+        exporters.append(tracing.OtlpFileExporter(options.trace_file))
+    try:
+        with tracing.span("replication", exporters=exporters or None, unique_name=state.unique_name,
+                          db_primary=db_primary, db_secondary=db_secondary) as root_span:
+            try:
+                # Retrieve DB Infos
+                primary = Primary(Database(conn_primary, db_primary))
+                ctx.db_infos = primary.retrieve_db_infos(list_schema_excluded)
+                print(f"$today - Starting pg_dump from server {conn_primary} database {db_primary} {ctx.db_infos.db_size}")
+                print(f"db_schemas : {ctx.db_infos.db_schemas}")
+                print(f"db_size : {ctx.db_infos.db_size}")
+                print(f"db_tables : {ctx.db_infos.db_tables}")
+
+                if options.restore_engine == "archive":
+                    # One schema dump in directory format restored with pg_restore -j
+                    ctx.archive = ArchiveRestore(conn_primary, ctx.db_schemas, conn_secondary,
+                                                 options.restore_jobs, options.archive_directory)
+
+                # # Check if replication is already started
+                query = f"select subslotname from pg_subscription where subname like 'subscription_{db_secondary}_%'"
+                print(f"psql \"{conn_secondary}\" --no-align -tc \"{query}\"")
                 results = execute_query(conn_secondary, query)
-                if not results:
-                    break
-
-                try:
-                    execute_query(conn_secondary, query)
+                if results is None:
                     print(
-                        "The first step of logical replication is not finished - retrying later")
-
-                    # Log progress
-                    progress_query = """
-                                     with ready as (select count(a.*) as ready
-                                                    from pg_subscription_rel a
-                                                             inner join pg_class on srrelid = pg_class.oid
-                                                    where relname <> 'spatial_ref_sys'
-                                                      and srsubstate = 'r'),
-                                          total as (select count(a.*) as total
-                                                    from pg_subscription_rel a
-                                                             inner join pg_class on srrelid = pg_class.oid
-                                                    where relname <> 'spatial_ref_sys')
-                                     select *
-                                     from ready,
-                                          total; \
-                                     """
-                    results = execute_query(conn_secondary, progress_query)
-                    print(
-                        f"Replication progress : {results[0][0]}/{results[0][1]}")
-
-                    time.sleep(WAITING_PROGRESS_IN_SECONDS)
-                except:
-                    # If the query fails, it means there are no more tables in non-ready state
-                    break
-
-            # Disable subscription
-            print(f"Disable subscription on {conn_secondary}")
-            query = f"ALTER SUBSCRIPTION {subscription_name} DISABLE;"
-            execute_query(conn_secondary, query, fetch=False)
-
-            # Restore post section without primary keys
-            print("Restore post section - without primary key")
-            run_dump_restore_post_without_pk(
-                conn_primary, db_schemas, conn_secondary)
-
-            # Enable subscription
-            print(f"Enable subscription on {conn_secondary}")
-            query = f"ALTER SUBSCRIPTION {subscription_name} ENABLE;"
-            execute_query(conn_secondary, query, fetch=False)
-
-            end_time = datetime.datetime.now().strftime("%Y%m%d-%H-%M-%S")
-            print(f"end={end_time}")
-        else:
-            print("No replication running, exiting")
+                        f"Error on query {query} on host {conn_secondary}", file=sys.stderr)
+
+                else:
+                    if not results:
+                        print("Replication not in progress")
+                        print(f"{today} - Starting process : {name} {conn_primary} {db_primary} - {conn_secondary} database {db_secondary}")
+                    elif not state.completed:
+                        # Started without a state file, only the remaining phases can be run
+                        for phase in PHASES[:PHASES.index("subscription") + 1]:
+                            migration.complete(phase)
+
+                    completed = migration.run(replication_phases(ctx))
+
+            finally:
+                if ctx.guard is not None:
+                    ctx.guard.stop()
+                if ctx.metrics_server is not None:
+                    ctx.metrics_server.stop()
+                if ctx.archive is not None:
+                    ctx.archive.close()
+                for label, conn_string in (("primary", conn_primary), ("secondary", conn_secondary)):
+                    print(f"Connection pool {label} : {connection_pool.pool_stats(conn_string)}")
+                    connection_pool.close_pool(conn_string)
+            root_span.set(completed=completed)
+    finally:
+        for exporter in exporters:
+            tracing.close_exporter(exporter)
 
     print("end")
+    return completed
 
 
 if __name__ == '__main__':
     # Initialisation of replication
     script_name = os.path.basename(__file__)
+    # Read-only dry run printing the statements and the estimated duration of each phase
+    plan = "--plan" in sys.argv
+    if plan:
+        sys.argv.remove("--plan")
+    # Once the writes are frozen on the primary: wait for the subscriptions to catch up and copy the sequences
+    cutover = "--cutover" in sys.argv
+    if cutover:
+        sys.argv.remove("--cutover")
+    # Chunked comparison of the published tables of both databases
+    verify = "--verify" in sys.argv
+    if verify:
+        sys.argv.remove("--verify")
     connection_primary = sys.argv[1]
     db_name_primary = sys.argv[2]
     connection_secondary = sys.argv[3]
     db_name_secondary = sys.argv[4] if len(sys.argv) > 4 else db_name_primary
     schema_excluded_list = sys.argv[5] if len(sys.argv) > 5 else None
-    schema_excluded = schema_excluded_list.split(',')
-
-    main(script_name, connection_primary, db_name_primary, connection_secondary, db_name_secondary, schema_excluded)
+    schema_excluded = schema_excluded_list.split(',') if schema_excluded_list else None
+
+    if plan:
+        import planner
+        planner.main(connection_primary, db_name_primary, db_name_secondary, schema_excluded)
+    elif cutover:
+        import cutover as cutover_command
+        report = cutover_command.main(connection_primary, db_name_primary, connection_secondary, schema_excluded)
+        sys.exit(0 if report is not None and report.completed else 1)
+    elif verify:
+        import verifier
+        verification = verifier.main(connection_primary, db_name_primary, connection_secondary, db_name_secondary,
+                                     schema_excluded)
+        sys.exit(0 if verification.passed else 1)
+    else:
+        main(script_name, connection_primary, db_name_primary, connection_secondary, db_name_secondary,
+             schema_excluded)
@@ -11,6 +11,8 @@ from testcontainers.compose import DockerCompose
 from testcontainers.core.wait_strategies import LogMessageWaitStrategy
 
 import replication_start
+from database import Database
+from primary import Primary
 
 FAKE_TIME = datetime.datetime(2026, 1, 22, 10, 1, 25)
 
@@ -117,6 +119,15 @@ def test_main_with_excluded_schema():
                 assert count_records(conn, schema, table) == 2
 
 
+@pytest.mark.slow
+def test_retrieve_db_infos_lists_no_information_schema_table():
+    db_infos = Primary(Database(get_source_url(), "foo_db")).retrieve_db_infos(None)
+
+    tables = db_infos.tables.publication_tables()
+    assert ("included", "table_to_replicate") in tables
+    assert all(schema != "information_schema" for schema, _ in tables)
+
+
 def detect_pg_dump_version() -> str | Any:
     pg_dump_version_output = subprocess.check_output(["pg_dump", "--version"], text=True, stderr=None)
     print("Detected pg_dump version : " + pg_dump_version_output)
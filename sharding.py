@@ -0,0 +1,34 @@
+import dataclasses
+import heapq
+
+
+@dataclasses.dataclass
+class Shard:
+    index: int
+    tables: list = dataclasses.field(default_factory=list)
+    bytes: int = 0
+
+    def suffix(self, shard_count):
+        # A single shard keeps the historical publication and subscription names
+        return "" if shard_count <= 1 else f"_{self.index}"
+
+
+def plan_shards(table_sizes: dict, shard_count) -> list:
+    """
+    Spread tables over shard_count shards balanced by bytes.
+
+    Largest tables are placed first, each one in the lightest shard so far
+    (longest processing time first). Empty shards are dropped.
+
+    >>> [(shard.tables, shard.bytes) for shard in plan_shards({"a": 10, "b": 7, "c": 5, "d": 4}, 2)]
+    [(['a', 'd'], 14), (['b', 'c'], 12)]
+    """
+    shard_count = max(shard_count, 1)
+    shards = [Shard(index) for index in range(shard_count)]
+    heap = [(0, index) for index in range(shard_count)]
+    for table, size in sorted(table_sizes.items(), key=lambda item: (-(item[1] or 0), item[0])):
+        shard_bytes, index = heapq.heappop(heap)
+        shards[index].tables.append(table)
+        shards[index].bytes += size or 0
+        heapq.heappush(heap, (shards[index].bytes, index))
+    return [shard for shard in shards if shard.tables or shard_count == 1]
@@ -0,0 +1,25 @@
+from sharding import plan_shards
+
+
+def test_plan_shards_balances_bytes():
+    sizes = {("s", f"t{i}"): size for i, size in enumerate([900, 500, 400, 300, 200, 100, 0])}
+
+    shards = plan_shards(sizes, 3)
+
+    assert [shard.bytes for shard in shards] == [900, 800, 700]
+    assert sorted(table for shard in shards for table in shard.tables) == sorted(sizes)
+
+
+def test_plan_shards_drops_empty_shards():
+    shards = plan_shards({"a": 1, "b": 2}, 4)
+
+    assert [shard.tables for shard in shards] == [["b"], ["a"]]
+    assert [shard.suffix(4) for shard in shards] == ["_0", "_1"]
+
+
+def test_plan_single_shard_keeps_names():
+    shards = plan_shards({}, 1)
+
+    assert len(shards) == 1
+    assert shards[0].tables == []
+    assert shards[0].suffix(1) == ""
@@ -0,0 +1,153 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import psycopg
+
+import tracing
+from database import Database
+from publication import batches, table_list
+
+SNAPSHOT_JOBS = 4
+TRUNCATE_BATCH_SIZE = 500
+
+
+def table_pattern(schema, table):
+    """
+    pg_dump -t pattern matching exactly one table.
+
+    >>> table_pattern("included", "My Table")
+    '"included"."My Table"'
+    """
+    return '"{}"."{}"'.format(schema.replace('"', '""'), table.replace('"', '""'))
+
+
+class ExportedSnapshotSlot:
+    """
+    Logical replication slot created with an exported snapshot.
+
+    The slot is created on a replication connection, and its snapshot can be
+    imported by other sessions (pg_dump --snapshot) only while that
+    connection stays open and idle. Changes committed after the snapshot are
+    the ones streamed from the slot, so data loaded at the snapshot followed
+    by a subscription on the slot misses nothing and applies nothing twice.
+    """
+
+    def __init__(self, conn_string, slot_name, plugin="pgoutput"):
+        self.conn_string = conn_string
+        self.slot_name = slot_name
+        self.plugin = plugin
+        self.consistent_point = None
+        self.snapshot_name = None
+        self._conn = None
+
+    def __enter__(self):
+        self._conn = psycopg.connect(self.conn_string, replication="database", autocommit=True)
+        try:
+            # Replication commands only run through the simple query protocol, used without parameters
+            row = self._conn.execute(
+                f'CREATE_REPLICATION_SLOT "{self.slot_name}" LOGICAL {self.plugin} EXPORT_SNAPSHOT').fetchone()
+        except psycopg.Error:
+            self._conn.close()
+            raise
+        _, self.consistent_point, self.snapshot_name, _ = row
+        print(f"Slot {self.slot_name} created at {self.consistent_point}, snapshot {self.snapshot_name}")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Ends the snapshot, the slot stays
+        self._conn.close()
+        self._conn = None
+
+
+def drop_slot(conn_string, slot_name):
+    Database(conn_string, None).execute_query(
+        f"SELECT pg_drop_replication_slot(slot_name) FROM pg_replication_slots WHERE slot_name = '{slot_name}'")
+
+
+def dump_data_command(conn_string, snapshot_name, tables, directory, jobs):
+    command = [
+        "pg_dump",
+        "-d", conn_string,
+        "-Fd",
+        "-j", str(jobs),
+        "-f", directory,
+        f"--snapshot={snapshot_name}",
+        "--section=data",
+        "--no-acl",
+        "--no-owner",
+    ]
+    for schema, table in tables:
+        command.append("-t")
+        command.append(table_pattern(schema, table))
+    return command
+
+
+def restore_data_command(conn_string, directory, jobs):
+    return [
+        "pg_restore",
+        "-d", conn_string,
+        "-j", str(jobs),
+        "--data-only",
+        "--no-acl",
+        "--no-owner",
+        directory
+    ]
+
+
+def run_command(name, command, **attributes):
+    print(" ".join(command))
+    with tracing.span(name, **attributes) as span:
+        result = subprocess.run(command)
+        span.set(returncode=result.returncode)
+    if result.returncode != 0:
+        print(f"Error {command[0]} exited with code {result.returncode}", file=sys.stderr)
+        return False
+    return True
+
+
+class SnapshotBootstrap:
+    """
+    Initial copy of the published tables done by pg_dump/pg_restore -j instead of the sync workers.
+
+    For each subscription, the slot is created first with an exported
+    snapshot, the tables are dumped in parallel at that snapshot, then
+    restored in parallel on the secondary. The subscription is then created
+    on the existing slot with copy_data=false.
+    """
+
+    def __init__(self, conn_primary, conn_secondary, jobs=SNAPSHOT_JOBS, directory=None):
+        self.conn_primary = conn_primary
+        self.conn_secondary = conn_secondary
+        self.jobs = max(jobs, 1)
+        self.directory = directory
+
+    def truncate(self, tables):
+        for batch in batches(tables, TRUNCATE_BATCH_SIZE):
+            Database(self.conn_secondary, None).execute_query(f"TRUNCATE {table_list(batch)}", fetch=False)
+
+    def load(self, slot_name, tables):
+        # Left by an interrupted load, its snapshot is gone and the data copied so far is dropped with it
+        drop_slot(self.conn_primary, slot_name)
+        self.truncate(tables)
+
+        work_directory = tempfile.mkdtemp(prefix="pg_logical_replication_data_", dir=self.directory)
+        archive = os.path.join(work_directory, "data")
+        loaded = False
+        try:
+            with tracing.span("snapshot load", slot=slot_name, tables=len(tables), jobs=self.jobs):
+                with ExportedSnapshotSlot(self.conn_primary, slot_name) as slot:
+                    # pg_dump workers import the snapshot when they start, the connection is kept until then
+                    dumped = run_command("pg_dump data", dump_data_command(
+                        self.conn_primary, slot.snapshot_name, tables, archive, self.jobs), slot=slot_name)
+                loaded = dumped and run_command("pg_restore data", restore_data_command(
+                    self.conn_secondary, archive, self.jobs), slot=slot_name)
+        except psycopg.Error as e:
+            print(f"Error {e} creating slot {slot_name} on host {self.conn_primary}", file=sys.stderr)
+        finally:
+            shutil.rmtree(work_directory, ignore_errors=True)
+            if not loaded:
+                drop_slot(self.conn_primary, slot_name)
+        return loaded
@@ -0,0 +1,41 @@
+from snapshot_bootstrap import SnapshotBootstrap, dump_data_command
+
+
+def test_dump_data_command_at_snapshot():
+    command = dump_data_command("host=pg1", "00000003-00000002-1", [("s", "t"), ("s", "My Table")], "/tmp/data", 8)
+
+    assert "--snapshot=00000003-00000002-1" in command
+    assert command[command.index("-j") + 1] == "8"
+    assert [command[i + 1] for i, arg in enumerate(command) if arg == "-t"] == ['"s"."t"', '"s"."My Table"']
+
+
+def test_load_dumps_at_the_slot_snapshot_then_restores(mocker):
+    conn = mocker.patch("psycopg.connect").return_value
+    conn.execute.return_value.fetchone.return_value = ("subscription_a", "0/16B3748", "00000003-00000002-1", "pgoutput")
+    queries = mocker.patch("database.Database.execute_query")
+    run = mocker.patch("subprocess.run")
+    run.return_value.returncode = 0
+
+    assert SnapshotBootstrap("host=pg1", "host=pg2", jobs=4).load("subscription_a", [("s", "t")])
+
+    assert "CREATE_REPLICATION_SLOT \"subscription_a\" LOGICAL pgoutput EXPORT_SNAPSHOT" in conn.execute.call_args[0][0]
+    dump, restore = [call.args[0] for call in run.call_args_list]
+    assert dump[0] == "pg_dump" and "--snapshot=00000003-00000002-1" in dump
+    assert restore[0] == "pg_restore" and "--data-only" in restore
+    assert [call.args[0] for call in queries.call_args_list] == [
+        "SELECT pg_drop_replication_slot(slot_name) FROM pg_replication_slots WHERE slot_name = 'subscription_a'",
+        "TRUNCATE s.t",
+    ]
+
+
+def test_failed_load_drops_the_slot(mocker):
+    conn = mocker.patch("psycopg.connect").return_value
+    conn.execute.return_value.fetchone.return_value = ("subscription_a", "0/16B3748", "00000003-00000002-1", "pgoutput")
+    queries = mocker.patch("database.Database.execute_query")
+    run = mocker.patch("subprocess.run")
+    run.return_value.returncode = 1
+
+    assert not SnapshotBootstrap("host=pg1", "host=pg2").load("subscription_a", [("s", "t")])
+
+    assert run.call_count == 1
+    assert "pg_drop_replication_slot" in queries.call_args_list[-1].args[0]
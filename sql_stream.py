@@ -0,0 +1,179 @@
+import re
+
+_NORMAL = 0
+_QUOTE = 1
+_ESCAPE_QUOTE = 2
+_IDENTIFIER = 3
+_BLOCK_COMMENT = 4
+_DOLLAR = 5
+
+_NORMAL_SPECIALS = re.compile(r"""[;'"$/-]""")
+_ESCAPE_QUOTE_SPECIALS = re.compile(r"[\\']")
+_BLOCK_COMMENT_SPECIALS = re.compile(r"/\*|\*/")
+_DOLLAR_TAG = re.compile(r"\$([A-Za-z_\u0080-\uffff][A-Za-z0-9_\u0080-\uffff]*)?\$")
+_LEADING = re.compile(r"\s*(?:--[^\n]*(?:\n|$)\s*)*")
+_RESTRICT = re.compile(r"\\(un)?restrict\b")
+
+
+def _is_identifier_char(char):
+    return char.isalnum() or char in "_$"
+
+
+class SqlStatementSplitter:
+    """
+    Incremental splitter of a SQL script into statements, fed line by line.
+
+    Semicolons inside string literals, quoted identifiers, comments and
+    dollar-quoted bodies don't end a statement. Leading comments are
+    dropped and psql meta-commands (lines starting with a backslash) are
+    returned as statements of their own.
+
+    >>> splitter = SqlStatementSplitter()
+    >>> splitter.feed("CREATE FUNCTION f() RETURNS text AS $$ SELECT ';' $$\\n")
+    []
+    >>> splitter.feed("LANGUAGE sql; SELECT 1;\\n")
+    ["CREATE FUNCTION f() RETURNS text AS $$ SELECT ';' $$\\nLANGUAGE sql;", 'SELECT 1;']
+    """
+
+    def __init__(self):
+        self._parts = []
+        self._state = _NORMAL
+        self._comment_depth = 0
+        self._dollar_tag = None
+
+    def feed(self, line):
+        statements = []
+        position = 0
+        length = len(line)
+
+        if self._state == _NORMAL and not self._parts:
+            position = _LEADING.match(line).end()
+            if line.startswith("\\", position):
+                statements.append(line[position:].rstrip())
+                return statements
+
+        start = position
+        while position < length:
+            if self._state == _NORMAL:
+                match = _NORMAL_SPECIALS.search(line, position)
+                if match is None:
+                    break
+                position = match.start()
+                char = line[position]
+                if char == ";":
+                    self._parts.append(line[start:position + 1])
+                    statements.append("".join(self._parts).strip())
+                    self._parts = []
+                    position = _LEADING.match(line, position + 1).end()
+                    start = position
+                    continue
+                if char == "'":
+                    escaped = (position > 0 and line[position - 1] in "eE"
+                               and (position == 1 or not _is_identifier_char(line[position - 2])))
+                    self._state = _ESCAPE_QUOTE if escaped else _QUOTE
+                    position += 1
+                elif char == '"':
+                    self._state = _IDENTIFIER
+                    position += 1
+                elif char == "-":
+                    if line.startswith("--", position):
+                        # Comment runs until the end of the line
+                        break
+                    position += 1
+                elif char == "/":
+                    if line.startswith("/*", position):
+                        self._state = _BLOCK_COMMENT
+                        self._comment_depth = 1
+                        position += 2
+                    else:
+                        position += 1
+                else:
+                    tag = _DOLLAR_TAG.match(line, position)
+                    if tag is not None and (position == 0 or not _is_identifier_char(line[position - 1])):
+                        self._state = _DOLLAR
+                        self._dollar_tag = tag.group(0)
+                        position = tag.end()
+                    else:
+                        position += 1
+            elif self._state == _QUOTE:
+                position = line.find("'", position)
+                if position < 0:
+                    break
+                position += 1
+                if line.startswith("'", position):
+                    position += 1
+                else:
+                    self._state = _NORMAL
+            elif self._state == _ESCAPE_QUOTE:
+                match = _ESCAPE_QUOTE_SPECIALS.search(line, position)
+                if match is None:
+                    break
+                position = match.end()
+                if match.group(0) == "\\":
+                    position += 1
+                elif line.startswith("'", position):
+                    position += 1
+                else:
+                    self._state = _NORMAL
+            elif self._state == _IDENTIFIER:
+                position = line.find('"', position)
+                if position < 0:
+                    break
+                position += 1
+                if line.startswith('"', position):
+                    position += 1
+                else:
+                    self._state = _NORMAL
+            elif self._state == _BLOCK_COMMENT:
+                match = _BLOCK_COMMENT_SPECIALS.search(line, position)
+                if match is None:
+                    break
+                position = match.end()
+                self._comment_depth += 1 if match.group(0) == "/*" else -1
+                if self._comment_depth == 0:
+                    self._state = _NORMAL
+            else:
+                position = line.find(self._dollar_tag, position)
+                if position < 0:
+                    break
+                position += len(self._dollar_tag)
+                self._state = _NORMAL
+                self._dollar_tag = None
+
+        if start < length:
+            self._parts.append(line[start:])
+        return statements
+
+    def flush(self):
+        """Return the trailing statement without a terminating semicolon, if any."""
+        statement = "".join(self._parts).strip()
+        self._parts = []
+        self._state = _NORMAL
+        return statement or None
+
+
+def statements(lines):
+    """
+    Yield the statements of a SQL script as soon as they are complete.
+
+    >>> list(statements(["-- header\\n", "SET a = 1;\\n", "\\\\restrict key\\n", "SELECT 'a;b';\\n"]))
+    ['SET a = 1;', '\\\\restrict key', "SELECT 'a;b';"]
+    """
+    splitter = SqlStatementSplitter()
+    for line in lines:
+        yield from splitter.feed(line)
+    statement = splitter.flush()
+    if statement is not None:
+        yield statement
+
+
+def is_restrict_command(statement):
+    """
+    Tell whether the statement is a psql \\restrict or \\unrestrict meta-command.
+
+    >>> is_restrict_command("\\\\unrestrict abc")
+    True
+    >>> is_restrict_command("SELECT 1;")
+    False
+    """
+    return _RESTRICT.match(statement) is not None
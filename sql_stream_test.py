@@ -0,0 +1,72 @@
+from sql_stream import SqlStatementSplitter, is_restrict_command, statements
+
+
+def split(script):
+    return list(statements(script.splitlines(keepends=True)))
+
+
+def test_statements_skip_leading_comments():
+    script = """--
+-- PostgreSQL database dump
+--
+
+SET statement_timeout = 0;
+SELECT 1; -- trailing comment
+"""
+    assert split(script) == ["SET statement_timeout = 0;", "SELECT 1;"]
+
+
+def test_statements_keep_semicolons_in_literals_and_identifiers():
+    script = """CREATE TABLE "we;ird" (a text DEFAULT 'x''y;', b text DEFAULT E'it\\'s;');
+COMMENT ON TABLE t IS 'multi
+line; comment';
+"""
+    assert split(script) == [
+        """CREATE TABLE "we;ird" (a text DEFAULT 'x''y;', b text DEFAULT E'it\\'s;');""",
+        "COMMENT ON TABLE t IS 'multi\nline; comment';",
+    ]
+
+
+def test_statements_keep_semicolons_in_comments():
+    script = """/* block ; /* nested ; */ still */ SELECT 1
+-- inner ; comment
+;
+"""
+    assert split(script) == ["/* block ; /* nested ; */ still */ SELECT 1\n-- inner ; comment\n;"]
+
+
+def test_statements_with_dollar_quoting():
+    script = """CREATE FUNCTION f() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $_$
+BEGIN
+  RETURN $x$;$x$;
+END;
+$_$;
+SELECT a$b FROM t;
+"""
+    assert split(script) == [
+        "CREATE FUNCTION f() RETURNS trigger\n    LANGUAGE plpgsql\n    AS $_$\nBEGIN\n  RETURN $x$;$x$;\nEND;\n$_$;",
+        "SELECT a$b FROM t;",
+    ]
+
+
+def test_statements_return_meta_commands_alone():
+    script = """\\restrict abcdef
+SET a = 1;
+\\unrestrict abcdef
+"""
+    result = split(script)
+
+    assert result == ["\\restrict abcdef", "SET a = 1;", "\\unrestrict abcdef"]
+    assert [is_restrict_command(statement) for statement in result] == [True, False, True]
+
+
+def test_splitter_returns_statements_as_soon_as_complete():
+    splitter = SqlStatementSplitter()
+
+    assert splitter.feed("CREATE TABLE t (\n") == []
+    assert splitter.feed("  id int);\n") == ["CREATE TABLE t (\n  id int);"]
+    assert splitter.feed("SELECT 1") == []
+    assert splitter.flush() == "SELECT 1"
+    assert splitter.flush() is None
@@ -0,0 +1,124 @@
+import dataclasses
+
+from database import Database
+
+# Binary transfer, streaming of large transactions and parallel apply
+BINARY_MIN_VERSION = 140000
+STREAMING_MIN_VERSION = 140000
+PARALLEL_STREAMING_MIN_VERSION = 160000
+# Types created by users and extensions, their oids differ from one server to the other
+FIRST_NORMAL_OBJECT_ID = 16384
+
+SETTINGS_QUERY = """
+SELECT name, setting FROM pg_settings
+WHERE name IN ('server_version_num', 'max_sync_workers_per_subscription', 'max_logical_replication_workers',
+               'max_parallel_apply_workers_per_subscription', 'max_worker_processes', 'max_wal_senders',
+               'max_replication_slots')
+"""
+
+# Column types of the published tables that can't be sent in binary
+BINARY_BLOCKERS_QUERY = """
+SELECT DISTINCT format_type(a.atttypid, NULL)
+FROM pg_attribute a
+JOIN pg_class c ON c.oid = a.attrelid
+JOIN pg_namespace n ON n.oid = c.relnamespace
+JOIN pg_type t ON t.oid = a.atttypid
+JOIN pg_type b ON b.oid = coalesce(nullif(t.typbasetype, 0), t.oid)
+LEFT JOIN pg_type e ON e.oid = b.typelem AND b.typelem <> 0
+WHERE c.relkind = 'r' AND a.attnum > 0 AND NOT a.attisdropped AND n.nspname IN ({schemas})
+  AND (b.typsend::oid = 0 OR b.typreceive::oid = 0 OR b.oid >= {first_normal} OR e.oid >= {first_normal})
+ORDER BY 1
+"""
+
+
+@dataclasses.dataclass
+class ServerSettings:
+    settings: dict = dataclasses.field(default_factory=dict)
+
+    @property
+    def version(self):
+        return self.get("server_version_num", 0)
+
+    def get(self, name, default=None):
+        value = self.settings.get(name)
+        return int(value) if value is not None else default
+
+
+@dataclasses.dataclass
+class SubscriptionTuning:
+    # Subscription parameters added to the historical ones, as written in CREATE SUBSCRIPTION
+    options: dict = dataclasses.field(default_factory=dict)
+    warnings: list = dataclasses.field(default_factory=list)
+
+
+def server_settings(db: Database) -> ServerSettings:
+    return ServerSettings({name: setting for name, setting in db.execute_query(SETTINGS_QUERY) or []})
+
+
+def binary_blockers(db: Database, db_schemas):
+    if not db_schemas:
+        return []
+    schemas = ", ".join(f"'{schema}'" for schema in db_schemas)
+    results = db.execute_query(BINARY_BLOCKERS_QUERY.format(schemas=schemas, first_normal=FIRST_NORMAL_OBJECT_ID))
+    # Unknown when the query failed, binary is not used then
+    return [result[0] for result in results] if results is not None else ["unknown"]
+
+
+def choose_options(primary: ServerSettings, secondary: ServerSettings, blockers, subscriptions=1, tables=0,
+                   copy_data=True) -> SubscriptionTuning:
+    """
+    Fastest subscription options both servers support, and the settings capping the parallelism.
+
+    >>> tuning = choose_options(ServerSettings({"server_version_num": "160004"}),
+    ...                         ServerSettings({"server_version_num": "170002",
+    ...                                         "max_sync_workers_per_subscription": "2",
+    ...                                         "max_logical_replication_workers": "4"}), [], subscriptions=2)
+    >>> tuning.options
+    {'binary': 'true', 'streaming': 'parallel'}
+    >>> tuning.warnings[0]
+    'max_logical_replication_workers = 4 caps the 2 subscriptions, 6 workers are needed'
+    """
+    tuning = SubscriptionTuning()
+    version = min(primary.version, secondary.version)
+
+    if version >= BINARY_MIN_VERSION and not blockers:
+        tuning.options["binary"] = "true"
+    elif version >= BINARY_MIN_VERSION:
+        tuning.warnings.append(f"binary transfer disabled by the column types {', '.join(blockers)}")
+
+    if version >= PARALLEL_STREAMING_MIN_VERSION:
+        tuning.options["streaming"] = "parallel"
+    elif version >= STREAMING_MIN_VERSION:
+        tuning.options["streaming"] = "on"
+
+    sync_workers = secondary.get("max_sync_workers_per_subscription", 2) if copy_data else 0
+    parallel_apply = (secondary.get("max_parallel_apply_workers_per_subscription", 2)
+                      if tuning.options.get("streaming") == "parallel" else 0)
+    if tables > subscriptions * sync_workers > 0:
+        tuning.warnings.append(f"max_sync_workers_per_subscription = {sync_workers} copies at most "
+                               f"{sync_workers} tables at once per subscription")
+    # An apply worker per subscription, with its sync and parallel apply workers
+    workers = subscriptions * (1 + max(sync_workers, parallel_apply))
+    max_workers = secondary.get("max_logical_replication_workers")
+    if max_workers is not None and max_workers < workers:
+        tuning.warnings.append(f"max_logical_replication_workers = {max_workers} caps the {subscriptions} "
+                               f"subscriptions, {workers} workers are needed")
+    max_processes = secondary.get("max_worker_processes")
+    if max_processes is not None and max_workers is not None and max_processes <= max_workers:
+        tuning.warnings.append(f"max_worker_processes = {max_processes} leaves no room for the "
+                               f"{max_workers} logical replication workers and the launcher")
+    # Each sync worker uses a temporary slot and a WAL sender of its own
+    senders = subscriptions * (1 + sync_workers)
+    for name in ("max_wal_senders", "max_replication_slots"):
+        value = primary.get(name)
+        if value is not None and value < senders:
+            tuning.warnings.append(f"{name} = {value} on the primary is below the {senders} needed")
+    return tuning
+
+
+def tune_subscriptions(db_primary: Database, db_secondary: Database, db_schemas, subscriptions=1, tables=0,
+                       copy_data=True) -> SubscriptionTuning:
+    primary = server_settings(db_primary)
+    return choose_options(primary, server_settings(db_secondary),
+                          binary_blockers(db_primary, db_schemas) if primary.version >= BINARY_MIN_VERSION else [],
+                          subscriptions, tables, copy_data)
@@ -0,0 +1,46 @@
+from subscription_tuning import ServerSettings, choose_options, tune_subscriptions
+
+
+def settings(version, **values):
+    return ServerSettings({"server_version_num": str(version), **{name: str(value) for name, value in values.items()}})
+
+
+def test_no_options_before_postgresql_14():
+    tuning = choose_options(settings(130010), settings(170002), [])
+
+    assert tuning.options == {}
+
+
+def test_streaming_on_and_binary_blocked_by_user_types():
+    tuning = choose_options(settings(150005), settings(160004), ["s.mood", "geometry"])
+
+    assert tuning.options == {"streaming": "on"}
+    assert tuning.warnings == ["binary transfer disabled by the column types s.mood, geometry"]
+
+
+def test_worker_settings_capping_the_copy():
+    tuning = choose_options(settings(160004, max_wal_senders=4), settings(160004, max_sync_workers_per_subscription=2,
+                                                                          max_logical_replication_workers=8,
+                                                                          max_worker_processes=8),
+                            [], subscriptions=2, tables=100)
+
+    assert tuning.warnings == [
+        "max_sync_workers_per_subscription = 2 copies at most 2 tables at once per subscription",
+        "max_worker_processes = 8 leaves no room for the 8 logical replication workers and the launcher",
+        "max_wal_senders = 4 on the primary is below the 6 needed",
+    ]
+    snapshot = choose_options(settings(160004), settings(160004, max_sync_workers_per_subscription=2),
+                              [], tables=100, copy_data=False)
+    assert snapshot.warnings == []
+
+
+def test_tune_subscriptions_reads_both_servers(mocker):
+    db_primary = mocker.MagicMock()
+    db_primary.execute_query.side_effect = [[("server_version_num", "170002")], []]
+    db_secondary = mocker.MagicMock()
+    db_secondary.execute_query.return_value = [("server_version_num", "170002")]
+
+    tuning = tune_subscriptions(db_primary, db_secondary, ["s"])
+
+    assert tuning.options == {"binary": "true", "streaming": "parallel"}
+    assert "'s'" in db_primary.execute_query.call_args[0][0]
@@ -0,0 +1,221 @@
+import contextlib
+import dataclasses
+import json
+import os
+import secrets
+import sys
+import threading
+import time
+
+SERVICE_NAME = "pg-logical-replication-helper"
+# Statements are cut in span attributes, pg_dump output can be megabytes long
+MAX_STATEMENT_LENGTH = 500
+
+_exporters = []
+_exporters_lock = threading.Lock()
+_local = threading.local()
+
+
+@dataclasses.dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: str | None = None
+    start_ns: int = 0
+    end_ns: int | None = None
+    attributes: dict = dataclasses.field(default_factory=dict)
+    error: str | None = None
+    # Exporters of the trace, given to its root span, None for the ones of the process
+    exporters: list | None = dataclasses.field(default=None, repr=False, compare=False)
+
+    @property
+    def duration(self):
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, key, amount=1):
+        """Increment a counter attribute, such as rows or bytes."""
+        self.attributes[key] = self.attributes.get(key, 0) + amount
+
+    def record_error(self, error):
+        self.error = f"{type(error).__name__}: {error}"
+
+
+class _NoopSpan(Span):
+    def set(self, **attributes):
+        pass
+
+    def add(self, key, amount=1):
+        pass
+
+    def record_error(self, error):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan("noop", "", "")
+
+
+def add_exporter(exporter):
+    with _exporters_lock:
+        _exporters.append(exporter)
+    return exporter
+
+
+def remove_exporter(exporter):
+    with _exporters_lock:
+        if exporter in _exporters:
+            _exporters.remove(exporter)
+    close_exporter(exporter)
+
+
+def close_exporter(exporter):
+    close = getattr(exporter, "close", None)
+    if close is not None:
+        close()
+
+
+def current_span() -> Span:
+    stack = getattr(_local, "stack", None)
+    return stack[-1] if stack else _NOOP_SPAN
+
+
+def record_error(error):
+    """Attach an error handled by the caller to the current span."""
+    current_span().record_error(error)
+
+
+def statement_attribute(statement):
+    return statement if len(statement) <= MAX_STATEMENT_LENGTH else statement[:MAX_STATEMENT_LENGTH] + "..."
+
+
+@contextlib.contextmanager
+def span(name, parent: Span = None, exporters=None, **attributes):
+    """
+    Time a block as a child of parent, by default the current span of this thread.
+
+    A root span given exporters sends its whole trace to them only, so
+    migrations running in threads of one process keep their spans apart.
+    Other traces go to the exporters registered with add_exporter, nothing
+    is recorded while there is none. An exception leaving the block is
+    recorded on the span and raised again.
+    """
+    stack = getattr(_local, "stack", None)
+    if parent is None or parent is _NOOP_SPAN:
+        parent = stack[-1] if stack else None
+    if parent is not None:
+        exporters = parent.exporters
+    if not (_exporters if exporters is None else exporters):
+        yield _NOOP_SPAN
+        return
+
+    if stack is None:
+        stack = _local.stack = []
+    current = Span(name, parent.trace_id if parent else secrets.token_hex(16), secrets.token_hex(8),
+                   parent.span_id if parent else None, time.time_ns(), attributes=attributes, exporters=exporters)
+    stack.append(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.record_error(e)
+        raise
+    finally:
+        current.end_ns = time.time_ns()
+        stack.pop()
+        if exporters is None:
+            with _exporters_lock:
+                exporters = list(_exporters)
+        for exporter in exporters:
+            exporter(current)
+
+
+def counted(lines, current: Span, key="bytes"):
+    """Yield lines while adding their length to a span counter."""
+    for line in lines:
+        current.add(key, len(line))
+        yield line
+
+
+class JsonLogExporter:
+    """One JSON object per finished span."""
+
+    def __init__(self, output=sys.stderr):
+        self.output = output
+        self._lock = threading.Lock()
+
+    def __call__(self, finished: Span):
+        record = {
+            "time": finished.end_ns / 1e9,
+            "event": "span",
+            "name": finished.name,
+            "duration": finished.duration,
+            "trace_id": finished.trace_id,
+            "span_id": finished.span_id,
+            "parent_id": finished.parent_id,
+            "status": "error" if finished.error else "ok",
+            "error": finished.error,
+            "attributes": finished.attributes,
+        }
+        with self._lock:
+            self.output.write(json.dumps(record, default=str) + "\n")
+            self.output.flush()
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def otlp_record(finished: Span):
+    """
+    A span in the OTLP/JSON layout of the OpenTelemetry file exporter.
+
+    >>> record = otlp_record(Span("phase", "a" * 32, "b" * 16, None, 1, 2, {"rows": 3}))
+    >>> record["resourceSpans"][0]["scopeSpans"][0]["spans"][0]["attributes"]
+    [{'key': 'rows', 'value': {'intValue': '3'}}]
+    """
+    otlp_span = {
+        "traceId": finished.trace_id,
+        "spanId": finished.span_id,
+        "name": finished.name,
+        "kind": 1,
+        "startTimeUnixNano": str(finished.start_ns),
+        "endTimeUnixNano": str(finished.end_ns),
+        "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in finished.attributes.items()
+                       if value is not None],
+        "status": {"code": 2, "message": finished.error} if finished.error else {"code": 1},
+    }
+    if finished.parent_id:
+        otlp_span["parentSpanId"] = finished.parent_id
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}},
+                                        {"key": "process.pid", "value": {"intValue": str(os.getpid())}}]},
+            "scopeSpans": [{"scope": {"name": SERVICE_NAME}, "spans": [otlp_span]}],
+        }]
+    }
+
+
+class OtlpFileExporter:
+    """Finished spans appended to a file as OTLP/JSON lines, readable by OpenTelemetry collectors."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "a")
+        self._lock = threading.Lock()
+
+    def __call__(self, finished: Span):
+        with self._lock:
+            self._file.write(json.dumps(otlp_record(finished)) + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
@@ -0,0 +1,113 @@
+import io
+import json
+import threading
+
+import pytest
+
+import tracing
+
+
+@pytest.fixture
+def spans():
+    finished = []
+    tracing.add_exporter(finished.append)
+    yield finished
+    tracing.remove_exporter(finished.append)
+
+
+def test_child_spans_share_the_trace_of_their_parent(spans):
+    with tracing.span("phase", phase="pre_data") as parent:
+        with tracing.span("sql") as child:
+            child.add("rows", 2)
+            child.add("rows")
+
+    assert [span.name for span in spans] == ["sql", "phase"]
+    assert child.trace_id == parent.trace_id
+    assert child.parent_id == parent.span_id
+    assert parent.parent_id is None
+    assert child.attributes == {"rows": 3}
+    assert parent.end_ns >= child.end_ns
+
+
+def test_explicit_parent_from_another_thread(spans):
+    with tracing.span("restore post-data units") as parent:
+        pass
+    with tracing.span("sql", parent) as child:
+        pass
+
+    assert child.parent_id == parent.span_id
+
+
+def test_root_span_exporters_get_their_trace_only():
+    finished = {"a": [], "b": []}
+    barrier = threading.Barrier(2)
+
+    def migrate(name):
+        with tracing.span("replication", exporters=[finished[name].append]) as root:
+            barrier.wait()
+            with tracing.span("phase", phase=name):
+                barrier.wait()
+            # Worker threads join the trace through their explicit parent
+            worker = threading.Thread(target=statement, args=(root,))
+            worker.start()
+            worker.join()
+
+    def statement(parent):
+        with tracing.span("sql", parent):
+            pass
+
+    threads = [threading.Thread(target=migrate, args=(name,)) for name in finished]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for name, spans in finished.items():
+        assert [span.name for span in spans] == ["phase", "sql", "replication"]
+        assert spans[0].attributes == {"phase": name}
+        assert {span.trace_id for span in spans} == {spans[-1].trace_id}
+
+
+def test_exception_is_recorded_and_raised(spans):
+    with pytest.raises(ValueError):
+        with tracing.span("sql"):
+            raise ValueError("syntax error")
+
+    assert spans[0].error == "ValueError: syntax error"
+
+
+def test_no_span_without_exporter():
+    with tracing.span("sql") as span:
+        span.set(rows=1)
+
+    assert span is tracing.current_span()
+    assert span.attributes == {}
+
+
+def test_json_log_exporter(spans):
+    output = io.StringIO()
+    exporter = tracing.add_exporter(tracing.JsonLogExporter(output))
+    try:
+        with tracing.span("phase", phase="roles"):
+            pass
+    finally:
+        tracing.remove_exporter(exporter)
+
+    record = json.loads(output.getvalue())
+    assert (record["name"], record["status"], record["attributes"]) == ("phase", "ok", {"phase": "roles"})
+
+
+def test_otlp_file_exporter(tmp_path, spans):
+    path = tmp_path / "spans.jsonl"
+    exporter = tracing.add_exporter(tracing.OtlpFileExporter(str(path)))
+    try:
+        with tracing.span("phase"):
+            with tracing.span("sql", statement="select 1"):
+                pass
+    finally:
+        tracing.remove_exporter(exporter)
+
+    child, parent = [json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"][0]
+                     for line in path.read_text().splitlines()]
+    assert child["parentSpanId"] == parent["spanId"]
+    assert child["attributes"] == [{"key": "statement", "value": {"stringValue": "select 1"}}]
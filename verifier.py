@@ -0,0 +1,413 @@
+import argparse
+import concurrent.futures
+import dataclasses
+import sys
+import threading
+import time
+
+import psycopg
+
+import connection_pool
+from cutover import CATCH_UP_TIMEOUT_IN_SECONDS, SUBSCRIPTIONS_QUERY, wait_for_lsn
+from database import Database
+from migration import Migration, MigrationState, MigrationStore
+from primary import Primary
+from publication import batches
+
+VERIFY_JOBS = 4
+CHUNK_ROWS = 100000
+# Mismatching ranges are split in this many parts until they hold at most DIFF_ROWS rows, compared row by row
+SPLIT_PARTS = 8
+DIFF_ROWS = 1000
+# Keys of differing rows kept per chunk
+MAX_REPORTED_KEYS = 100
+# Hashes of a mismatching chunk taken again once the secondary applied the primary's WAL
+RECHECKS = 3
+TABLES_BATCH_SIZE = 500
+
+# Columns in the primary's order and the primary key, chunks are key ranges
+TABLES_QUERY = """
+SELECT n.nspname, c.relname, pg_table_size(c.oid), greatest(c.reltuples, 0)::bigint,
+       (SELECT array_agg(a.attname::text ORDER BY a.attnum) FROM pg_attribute a
+        WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped),
+       k.columns, k.types
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+LEFT JOIN LATERAL (
+    SELECT array_agg(a.attname::text ORDER BY key.position) AS columns,
+           array_agg(format_type(a.atttypid, a.atttypmod) ORDER BY key.position) AS types
+    FROM pg_index i
+    CROSS JOIN unnest(i.indkey) WITH ORDINALITY AS key(attnum, position)
+    JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = key.attnum
+    WHERE i.indrelid = c.oid AND i.indisprimary
+) k ON true
+WHERE c.relkind = 'r' AND (n.nspname, c.relname) IN ({tables})
+"""
+
+# Rows are hashed from their text output, the same on both servers with these settings
+SESSION_SETTINGS = ("SET LOCAL TimeZone = 'UTC'; SET LOCAL DateStyle = 'ISO, YMD'; "
+                    "SET LOCAL IntervalStyle = 'postgres'; SET LOCAL extra_float_digits = 3; "
+                    "SET LOCAL bytea_output = 'hex'")
+
+# Order-independent aggregate: the number of rows and the sum of 64 bits of the md5 of each row
+HASH_QUERY = ("SELECT count(*), coalesce(sum(('x' || left(md5(ROW({columns})::text), 16))::bit(64)::bigint), 0) "
+              "FROM {table}{where}")
+ROWS_QUERY = "SELECT {key}, md5(ROW({columns})::text) FROM {table}{where}"
+BOUNDARY_QUERY = "SELECT {key} FROM {table}{where} ORDER BY {order} LIMIT 1 OFFSET {offset}"
+CURRENT_LSN_QUERY = "SELECT pg_current_wal_lsn()::text"
+
+
+def quote(name):
+    """
+    >>> quote('order')
+    '"order"'
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+
+@dataclasses.dataclass
+class VerifiedTable:
+    schema: str
+    name: str
+    bytes: int
+    rows: int
+    columns: list
+    # Primary key columns and types, empty when the table is compared as a whole
+    key: list = dataclasses.field(default_factory=list)
+    key_types: list = dataclasses.field(default_factory=list)
+
+    @property
+    def full_name(self):
+        return f"{self.schema}.{self.name}"
+
+    @property
+    def qualified_name(self):
+        return f"{quote(self.schema)}.{quote(self.name)}"
+
+    @property
+    def row_bytes(self):
+        return self.bytes / self.rows if self.rows > 0 else 0
+
+    def range_predicate(self, lower, upper):
+        """
+        WHERE clause of the key range lower < key <= upper and its parameters, None for an open bound.
+
+        >>> table = VerifiedTable("s", "t", 0, 0, ["a", "b"], ["a", "b"], ["integer", "text"])
+        >>> table.range_predicate(["1", "x"], None)
+        (' WHERE ("a", "b") > (%s::integer, %s::text)', ['1', 'x'])
+        """
+        row = f"({', '.join(quote(column) for column in self.key)})"
+        placeholders = f"({', '.join(f'%s::{key_type}' for key_type in self.key_types)})"
+        conditions, params = [], []
+        if lower is not None:
+            conditions.append(f"{row} > {placeholders}")
+            params += lower
+        if upper is not None:
+            conditions.append(f"{row} <= {placeholders}")
+            params += upper
+        return (f" WHERE {' AND '.join(conditions)}" if conditions else ""), params
+
+    def query(self, template, lower=None, upper=None, **fields):
+        where, params = self.range_predicate(lower, upper)
+        return template.format(table=self.qualified_name, where=where,
+                               columns=", ".join(quote(column) for column in self.columns),
+                               key=", ".join(f"{quote(column)}::text" for column in self.key),
+                               order=", ".join(quote(column) for column in self.key), **fields), params
+
+
+@dataclasses.dataclass
+class VerificationReport:
+    tables: int = 0
+    chunks: int = 0
+    matched: int = 0
+    # Chunk key -> differences, as recorded in the state
+    mismatched: dict = dataclasses.field(default_factory=dict)
+    # Chunks the primary kept changing during every recheck
+    changing: list = dataclasses.field(default_factory=list)
+    # Chunk key -> error of the chunks that could not be hashed, verified again on the next run
+    failed: dict = dataclasses.field(default_factory=dict)
+    duration: float = 0
+
+    @property
+    def passed(self):
+        return not self.mismatched and not self.changing and not self.failed
+
+
+class Throttle:
+    """Pace the chunks so that at most bytes_per_second of table data are read from each server."""
+
+    def __init__(self, bytes_per_second=None):
+        self.bytes_per_second = bytes_per_second
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        if not self.bytes_per_second:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + amount / self.bytes_per_second
+        if start > now:
+            time.sleep(start - now)
+
+
+class Verifier:
+    """
+    Compare the published tables of the primary and the secondary chunk by chunk.
+
+    Each table is split into primary key ranges of chunk_rows rows, walked
+    on the primary key index of the primary. A chunk is hashed on both
+    servers at once: its row count and the sum of the md5 of its rows. A
+    mismatching chunk is hashed again once the subscriptions applied the
+    primary's WAL up to the position of the primary's hash, and reported
+    only when the primary's hash did not change meanwhile; it is then split
+    until the differing rows are found. Tables without primary key are
+    compared as a single chunk. jobs bounds the hash queries running on
+    each server, bytes_per_second the table data they read. Verified
+    chunks are marked in the migration state, so a restart skips them.
+    """
+
+    def __init__(self, primary: Database, secondary: Database, migration: Migration, subscription_names=(),
+                 jobs=VERIFY_JOBS, chunk_rows=CHUNK_ROWS, bytes_per_second=None, rechecks=RECHECKS,
+                 lag_timeout=CATCH_UP_TIMEOUT_IN_SECONDS):
+        self.primary = primary
+        self.secondary = secondary
+        self.migration = migration
+        self.subscription_names = list(subscription_names)
+        self.jobs = max(jobs, 1)
+        self.chunk_rows = max(chunk_rows, 1)
+        self.throttle = Throttle(bytes_per_second)
+        self.rechecks = rechecks
+        self.lag_timeout = lag_timeout
+        self._secondary_hashes = None
+        self._lock = threading.Lock()
+        self._results = dict(migration.state.data.get("verify_results", {}))
+        self._failures = {}
+
+    def tables(self, publication_tables) -> list:
+        tables = []
+        for batch in batches(list(publication_tables), TABLES_BATCH_SIZE):
+            keys = ", ".join(f"('{schema}', '{table}')" for schema, table in batch)
+            for schema, name, size, rows, columns, key, key_types in \
+                    self.primary.execute_query(TABLES_QUERY.format(tables=keys)) or []:
+                tables.append(VerifiedTable(schema, name, size or 0, rows or 0, list(columns or []),
+                                            list(key or []), list(key_types or [])))
+        return tables
+
+    def boundaries(self, table: VerifiedTable, lower=None, upper=None, rows=None, db: Database = None):
+        """Upper keys of the successive chunks of rows rows between lower and upper, walked on the primary by default."""
+        rows = rows or self.chunk_rows
+        found = []
+        if not table.key:
+            return found
+        with (db or self.primary).connection() as conn:
+            while True:
+                query, params = table.query(BOUNDARY_QUERY, lower, upper, offset=rows - 1)
+                result = conn.execute(query, params).fetchone()
+                if result is None:
+                    return found
+                lower = list(result)
+                found.append(lower)
+
+    @staticmethod
+    def chunks(boundaries):
+        """
+        >>> list(Verifier.chunks([["10"], ["20"]]))
+        [(0, None, ['10']), (1, ['10'], ['20']), (2, ['20'], None)]
+        """
+        lower = None
+        for index, upper in enumerate(boundaries + [None]):
+            yield index, lower, upper
+            lower = upper
+
+    def verify(self, tables) -> VerificationReport:
+        start = time.monotonic()
+        report = VerificationReport(tables=len(tables))
+        saved = self.migration.state.data.get("verify_boundaries", {})
+        missing = [table for table in tables if table.full_name not in saved]
+        # Recorded once, a restart verifies the same chunks
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as executor:
+            for table, boundaries in zip(missing, executor.map(self.boundaries, missing)):
+                saved[table.full_name] = boundaries
+        if missing:
+            self.migration.record("verify_boundaries", saved)
+
+        done = self.migration.state.done_items("verify")
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as executor, \
+                concurrent.futures.ThreadPoolExecutor(self.jobs) as self._secondary_hashes:
+            futures = []
+            for table in tables:
+                for index, lower, upper in self.chunks(saved[table.full_name]):
+                    chunk_key = f"{table.full_name}:{index}"
+                    report.chunks += 1
+                    if chunk_key not in done:
+                        futures.append(executor.submit(self._verify_chunk, table, chunk_key, lower, upper))
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+        self.migration.flush()
+
+        for chunk_key, result in self._results.items():
+            if result["status"] == "mismatch":
+                report.mismatched[chunk_key] = result
+            elif result["status"] == "changing":
+                report.changing.append(chunk_key)
+        report.failed = dict(self._failures)
+        report.matched = report.chunks - len(report.mismatched) - len(report.changing) - len(report.failed)
+        report.duration = time.monotonic() - start
+        return report
+
+    def _verify_chunk(self, table, chunk_key, lower, upper):
+        try:
+            status, primary_hash, secondary_hash = self._compare(table, lower, upper)
+            if status == "match":
+                # A mismatched or changing chunk of a previous run matches now
+                with self._lock:
+                    if self._results.pop(chunk_key, None) is not None:
+                        self.migration.record("verify_results", dict(self._results))
+                self.migration.mark_item("verify", chunk_key)
+                return
+            result = {"status": status, "primary": list(map(str, primary_hash)),
+                      "secondary": list(map(str, secondary_hash))}
+            if status == "mismatch" and table.key:
+                result.update(self._drill_down(table, lower, upper, primary_hash, secondary_hash))
+            # Left out of the verified chunks, a restart verifies it again
+            with self._lock:
+                self._results[chunk_key] = result
+                self.migration.record("verify_results", dict(self._results))
+        except psycopg.Error as e:
+            print(f"Error {e} while verifying chunk {chunk_key}, it is verified again on the next run",
+                  file=sys.stderr)
+            with self._lock:
+                self._failures[chunk_key] = str(e)
+
+    def _hash(self, db: Database, table, lower, upper, lsn=False):
+        query, params = table.query(HASH_QUERY, lower, upper)
+        with db.connection() as conn:
+            with conn.transaction():
+                conn.execute(SESSION_SETTINGS)
+                result = tuple(conn.execute(query, params).fetchone())
+            if lsn:
+                return result, conn.execute(CURRENT_LSN_QUERY).fetchone()[0]
+        return result
+
+    def _compare(self, table, lower, upper):
+        """match, mismatch or changing, with the last hashes of the primary and the secondary."""
+        self.throttle.consume(min(table.rows, self.chunk_rows) * table.row_bytes if table.key else table.bytes)
+        secondary = self._secondary_hashes.submit(self._hash, self.secondary, table, lower, upper)
+        primary_hash = self._hash(self.primary, table, lower, upper)
+        secondary_hash = secondary.result()
+        if primary_hash == secondary_hash:
+            return "match", primary_hash, secondary_hash
+        for _ in range(self.rechecks):
+            primary_hash, lsn = self._hash(self.primary, table, lower, upper, lsn=True)
+            if self.subscription_names:
+                # Changes still being applied are not mismatches
+                with self.secondary.connection() as conn:
+                    if not wait_for_lsn(conn, self.subscription_names, lsn, self.lag_timeout):
+                        return "changing", primary_hash, secondary_hash
+            secondary_hash = self._hash(self.secondary, table, lower, upper)
+            if primary_hash == secondary_hash:
+                return "match", primary_hash, secondary_hash
+            if self._hash(self.primary, table, lower, upper) == primary_hash:
+                return "mismatch", primary_hash, secondary_hash
+        return "changing", primary_hash, secondary_hash
+
+    def _drill_down(self, table, lower, upper, primary_hash, secondary_hash):
+        rows = max(primary_hash[0], secondary_hash[0])
+        if rows <= DIFF_ROWS:
+            return self._diff(table, lower, upper)
+        # Walked on the server holding more rows, so that each part holds fewer rows than the range
+        db = self.primary if primary_hash[0] >= secondary_hash[0] else self.secondary
+        bounds = self.boundaries(table, lower, upper, -(-rows // SPLIT_PARTS), db)
+        if not bounds:
+            return self._diff(table, lower, upper)
+        differences = {"missing": [], "extra": [], "different": []}
+        for _, part_lower, part_upper in self.chunks(bounds):
+            part_lower = part_lower if part_lower is not None else lower
+            part_upper = part_upper if part_upper is not None else upper
+            status, primary_hash, secondary_hash = self._compare(table, part_lower, part_upper)
+            if status != "mismatch":
+                continue
+            for kind, keys in self._drill_down(table, part_lower, part_upper, primary_hash, secondary_hash).items():
+                differences[kind] += keys[:MAX_REPORTED_KEYS - len(differences[kind])]
+        return differences
+
+    def _diff(self, table, lower, upper):
+        """Keys missing on the secondary, only on the secondary, and of rows differing on both."""
+        query, params = table.query(ROWS_QUERY, lower, upper)
+        rows = []
+        for db in (self.primary, self.secondary):
+            with db.connection() as conn:
+                with conn.transaction():
+                    conn.execute(SESSION_SETTINGS)
+                    rows.append({tuple(row[:-1]): row[-1] for row in conn.execute(query, params).fetchall()})
+        primary_rows, secondary_rows = rows
+        return {
+            "missing": [list(key) for key in primary_rows if key not in secondary_rows][:MAX_REPORTED_KEYS],
+            "extra": [list(key) for key in secondary_rows if key not in primary_rows][:MAX_REPORTED_KEYS],
+            "different": [list(key) for key, row_hash in primary_rows.items()
+                          if key in secondary_rows and secondary_rows[key] != row_hash][:MAX_REPORTED_KEYS],
+        }
+
+
+def print_report(report: VerificationReport, output=sys.stdout):
+    print(f"Verified {report.tables} tables in {report.chunks} chunks in {report.duration:.3f}s : "
+          f"{report.matched} matching, {len(report.mismatched)} mismatching, {len(report.changing)} still changing, "
+          f"{len(report.failed)} failed", file=output)
+    for chunk_key, result in report.mismatched.items():
+        print(f"mismatch : {chunk_key} rows and hash {result['primary']} on the primary, "
+              f"{result['secondary']} on the secondary", file=output)
+        for kind in ("missing", "extra", "different"):
+            if result.get(kind):
+                print(f"  {kind} : {result[kind]}", file=output)
+    for chunk_key in report.changing:
+        print(f"changing : {chunk_key} kept changing on the primary, verify it again", file=output)
+    for chunk_key, error in report.failed.items():
+        print(f"failed : {chunk_key} {error}", file=output)
+
+
+def main(conn_primary, db_primary, conn_secondary, db_secondary, list_schema_excluded=None, jobs=VERIFY_JOBS,
+         chunk_rows=CHUNK_ROWS, bytes_per_second=None, state_file=None):
+    store = MigrationStore(state_file)
+    state = store.load() or MigrationState(f"verify_{db_primary}", db_primary, db_secondary)
+    primary = Database(conn_primary, db_primary)
+    secondary = Database(conn_secondary, db_secondary)
+    # Hash queries, the boundary walk and the lag checks borrow their connections from the pools
+    connection_pool.open_pool(conn_primary, jobs * 2)
+    connection_pool.open_pool(conn_secondary, jobs * 2)
+    try:
+        db_infos = Primary(primary).retrieve_db_infos(list_schema_excluded)
+        with secondary.connection() as conn:
+            subscription_names = [result[0] for result in
+                                  conn.execute(SUBSCRIPTIONS_QUERY, (f"subscription_{db_primary}_%",)).fetchall()]
+        verifier = Verifier(primary, secondary, Migration(state, store), subscription_names, jobs, chunk_rows,
+                            bytes_per_second)
+        report = verifier.verify(verifier.tables(db_infos.tables.publication_tables()))
+    finally:
+        connection_pool.close_pool(conn_primary)
+        connection_pool.close_pool(conn_secondary)
+    print_report(report)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare the published tables of the primary and the secondary "
+                                                 "by chunks of primary key ranges")
+    parser.add_argument("connection_primary")
+    parser.add_argument("db_name_primary")
+    parser.add_argument("connection_secondary")
+    parser.add_argument("db_name_secondary", nargs="?")
+    parser.add_argument("schema_excluded_list", nargs="?")
+    parser.add_argument("--jobs", type=int, default=VERIFY_JOBS, help="hash queries running at once on each server")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    parser.add_argument("--max-bytes-per-second", type=int, default=None,
+                        help="table data read per second from each server")
+    parser.add_argument("--state-file", default=None, help="JSON file recording the verified chunks")
+    args = parser.parse_args()
+
+    verification = main(args.connection_primary, args.db_name_primary, args.connection_secondary,
+                        args.db_name_secondary or args.db_name_primary,
+                        args.schema_excluded_list.split(",") if args.schema_excluded_list else None,
+                        args.jobs, args.chunk_rows, args.max_bytes_per_second, args.state_file)
+    sys.exit(0 if verification.passed else 1)
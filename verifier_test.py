@@ -0,0 +1,120 @@
+import psycopg
+
+from migration import Migration, MigrationState
+from verifier import Throttle, VerifiedTable, Verifier
+
+TABLE = VerifiedTable("s", "t", 8192, 3, ["id", "name"], ["id"], ["integer"])
+
+
+def mocked_database(mocker, hashes, rows=()):
+    """Database answering the hash queries with hashes in turn and the row queries with rows."""
+    hashes = iter(hashes)
+    conn = mocker.MagicMock()
+
+    def execute(query, params=None):
+        result = mocker.MagicMock()
+        if query.startswith("SELECT count(*)"):
+            result.fetchone.return_value = next(hashes)
+        elif query.startswith("SELECT pg_current_wal_lsn()"):
+            result.fetchone.return_value = ("0/20",)
+        elif "ORDER BY" in query:
+            result.fetchone.return_value = None
+        else:
+            result.fetchall.return_value = list(rows)
+        return result
+
+    conn.execute.side_effect = execute
+    db = mocker.MagicMock()
+    db.connection.return_value.__enter__.return_value = conn
+    return db
+
+
+def test_matching_chunk_is_marked_verified(mocker):
+    migration = Migration(MigrationState("verify_db", "db", "db"))
+    verifier = Verifier(mocked_database(mocker, [(3, 42)]), mocked_database(mocker, [(3, 42)]), migration)
+
+    report = verifier.verify([TABLE])
+
+    assert report.chunks == 1 and report.matched == 1
+    assert migration.state.done_items("verify") == {"s.t:0"}
+    assert migration.state.data["verify_boundaries"] == {"s.t": []}
+
+
+def test_stable_mismatch_is_drilled_down_to_the_rows(mocker):
+    wait = mocker.patch("verifier.wait_for_lsn", return_value=True)
+    primary = mocked_database(mocker, [(2, 1), (2, 1), (2, 1)], [("1", "a"), ("2", "b")])
+    secondary = mocked_database(mocker, [(2, 5), (2, 5)], [("1", "a"), ("3", "c")])
+    migration = Migration(MigrationState("verify_db", "db", "db"))
+    verifier = Verifier(primary, secondary, migration, ["sub_1"], rechecks=1)
+
+    report = verifier.verify([TABLE])
+
+    wait.assert_called_once()
+    assert report.mismatched["s.t:0"]["missing"] == [["2"]]
+    assert report.mismatched["s.t:0"]["extra"] == [["3"]]
+    assert migration.state.data["verify_results"]["s.t:0"]["status"] == "mismatch"
+
+
+def test_chunk_changing_on_the_primary_is_not_a_mismatch(mocker):
+    mocker.patch("verifier.wait_for_lsn", return_value=True)
+    primary = mocked_database(mocker, [(2, 1), (2, 2), (2, 3), (2, 4), (2, 5)])
+    secondary = mocked_database(mocker, [(2, 0), (2, 1), (2, 3)])
+    verifier = Verifier(primary, secondary, Migration(MigrationState("verify_db", "db", "db")), ["sub_1"],
+                        rechecks=2)
+
+    report = verifier.verify([TABLE])
+
+    assert report.changing == ["s.t:0"]
+    assert not report.mismatched
+
+
+def test_restart_verifies_a_changing_chunk_again(mocker):
+    state = MigrationState("verify_db", "db", "db", data={"verify_boundaries": {"s.t": []}})
+    migration = Migration(state)
+    mocker.patch("verifier.wait_for_lsn", return_value=False)
+    Verifier(mocked_database(mocker, [(2, 1), (2, 2)]), mocked_database(mocker, [(2, 0)]), migration,
+             ["sub_1"]).verify([TABLE])
+    assert state.done_items("verify") == set()
+
+    report = Verifier(mocked_database(mocker, [(2, 3)]), mocked_database(mocker, [(2, 3)]), migration,
+                      ["sub_1"]).verify([TABLE])
+
+    assert report.matched == 1 and report.passed
+    assert state.done_items("verify") == {"s.t:0"}
+    assert state.data["verify_results"] == {}
+
+
+def test_chunk_failing_on_a_server_is_not_matched(mocker):
+    secondary = mocker.MagicMock()
+    secondary.connection.return_value.__enter__.side_effect = psycopg.errors.UndefinedTable("no table s.t")
+    migration = Migration(MigrationState("verify_db", "db", "db"))
+    verifier = Verifier(mocked_database(mocker, [(3, 42)]), secondary, migration)
+
+    report = verifier.verify([TABLE])
+
+    assert report.failed == {"s.t:0": "no table s.t"}
+    assert report.matched == 0 and not report.passed
+    assert migration.state.done_items("verify") == set()
+
+
+def test_restart_skips_verified_chunks(mocker):
+    state = MigrationState("verify_db", "db", "db", items={"verify": ["s.t:0"]},
+                           data={"verify_boundaries": {"s.t": []}})
+    primary = mocked_database(mocker, [])
+    verifier = Verifier(primary, mocked_database(mocker, []), Migration(state))
+
+    report = verifier.verify([TABLE])
+
+    primary.connection.assert_not_called()
+    assert report.chunks == 1 and report.matched == 1
+
+
+def test_throttle_paces_the_reads(mocker):
+    mocker.patch("time.monotonic", return_value=100.0)
+    sleep = mocker.patch("time.sleep")
+    throttle = Throttle(bytes_per_second=1000)
+
+    throttle.consume(500)
+    throttle.consume(500)
+
+    sleep.assert_called_once_with(0.5)
@@ -0,0 +1,135 @@
+import sys
+import threading
+
+import psycopg
+
+from database import Database
+
+WAL_GUARD_INTERVAL_IN_SECONDS = 10
+# Share of the WAL budget at which the guard warns, re-enables the subscriptions early and aborts
+WARN_RATIO = 0.5
+REENABLE_RATIO = 0.8
+ABORT_RATIO = 1.0
+
+LEVELS = ("ok", "warn", "reenable", "abort")
+OK, WARN, REENABLE, ABORT = range(len(LEVELS))
+
+RETAINED_WAL_QUERY = """
+    SELECT slot_name, pg_wal_lsn_diff(pg_current_wal_lsn(), restart_lsn)::bigint
+    FROM pg_replication_slots
+    WHERE slot_name = ANY(%s)
+"""
+
+
+class WalRetentionExceeded(Exception):
+    pass
+
+
+class WalRetentionGuard:
+    """
+    Keep the WAL retained on the primary by the subscription slots within a budget.
+
+    Each check compares pg_wal_lsn_diff(pg_current_wal_lsn(), restart_lsn) of
+    the slots with the thresholds derived from the budget: a warning first,
+    then on_reenable is called to shorten the disabled window, then on_abort
+    as a last resort. Each reaction is called once. The guard runs either as
+    an on_progress callback of wait_for_initial_sync, raising
+    WalRetentionExceeded once aborted, or in a background thread with start.
+    """
+
+    def __init__(self, db: Database, slot_names, budget_bytes, warn_ratio=WARN_RATIO,
+                 reenable_ratio=REENABLE_RATIO, abort_ratio=ABORT_RATIO):
+        self.db = db
+        self.slot_names = list(slot_names)
+        self.budget_bytes = budget_bytes
+        self.thresholds = {
+            WARN: int(budget_bytes * warn_ratio),
+            REENABLE: int(budget_bytes * reenable_ratio),
+            ABORT: int(budget_bytes * abort_ratio),
+        }
+        self.on_reenable = None
+        self.on_abort = None
+        self.level = OK
+        self.peak_level = OK
+        self.retained = {}
+        self._reacted = set()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def aborted(self):
+        return self.peak_level >= ABORT
+
+    def level_for(self, retained_bytes):
+        """
+        Level reached by an amount of retained WAL.
+
+        >>> WalRetentionGuard(None, [], 1000).level_for(850)
+        2
+        """
+        level = OK
+        for threshold_level, threshold in self.thresholds.items():
+            if retained_bytes >= threshold:
+                level = max(level, threshold_level)
+        return level
+
+    def check(self):
+        with self.db.connection() as conn:
+            rows = conn.execute(RETAINED_WAL_QUERY, (self.slot_names,)).fetchall()
+        self.retained = {slot_name: retained for slot_name, retained in rows if retained is not None}
+        retained_bytes = max(self.retained.values(), default=0)
+        level = self.level_for(retained_bytes)
+        if level != self.level:
+            print(f"WAL retained by the replication slots : {retained_bytes} bytes of a {self.budget_bytes} "
+                  f"bytes budget, level {LEVELS[level]}", file=sys.stderr if level > OK else sys.stdout)
+        self.level = level
+        self.peak_level = max(self.peak_level, level)
+        for threshold_level, reaction in ((REENABLE, self.on_reenable), (ABORT, self.on_abort)):
+            if self.peak_level >= threshold_level and reaction is not None and threshold_level not in self._reacted:
+                self._reacted.add(threshold_level)
+                reaction()
+        return level
+
+    def __call__(self, progress=None):
+        try:
+            self.check()
+        except psycopg.Error as e:
+            print(f"Error {e} while checking the WAL retained on host '{self.db.conn_string}'", file=sys.stderr)
+        if self.aborted:
+            raise WalRetentionExceeded(f"WAL retained by the replication slots exceeds "
+                                       f"{self.thresholds[ABORT]} bytes")
+
+    def start(self, interval=WAL_GUARD_INTERVAL_IN_SECONDS):
+        def watch():
+            while not self._stop_event.is_set() and not self.aborted:
+                try:
+                    self.check()
+                except psycopg.Error as e:
+                    print(f"Error {e} while checking the WAL retained on host '{self.db.conn_string}'",
+                          file=sys.stderr)
+                self._stop_event.wait(interval)
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=watch, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def metrics(self):
+        """(name, help, labels, value) metrics, as rendered by lag_monitor.format_prometheus."""
+        metrics = [
+            ("wal_guard_budget_bytes", "WAL retention budget of the replication slots", {}, self.budget_bytes),
+            ("wal_guard_level", "WAL guard level: 0 ok, 1 warn, 2 reenable, 3 abort", {}, self.level),
+        ]
+        for level, threshold in self.thresholds.items():
+            metrics.append(("wal_guard_threshold_bytes", "WAL retained at which the guard reacts",
+                            {"level": LEVELS[level]}, threshold))
+        for slot_name, retained in self.retained.items():
+            metrics.append(("wal_guard_retained_bytes", "WAL retained on the primary by the slot",
+                            {"slot": slot_name}, retained))
+        return metrics
@@ -0,0 +1,47 @@
+import pytest
+
+from lag_monitor import format_prometheus
+from wal_guard import ABORT, REENABLE, WARN, WalRetentionExceeded, WalRetentionGuard
+
+
+def mocked_guard(mocker, retained_rows):
+    db = mocker.MagicMock()
+    db.connection.return_value.__enter__.return_value.execute.return_value.fetchall.side_effect = retained_rows
+    return WalRetentionGuard(db, ["subscription_1"], 1000)
+
+
+def test_guard_reacts_once_per_threshold(mocker):
+    guard = mocked_guard(mocker, [[("subscription_1", 600)], [("subscription_1", 850)],
+                                  [("subscription_1", 900)], [("subscription_1", 700)]])
+    guard.on_reenable = mocker.Mock()
+    guard.on_abort = mocker.Mock()
+
+    levels = [guard.check() for _ in range(4)]
+
+    assert levels == [WARN, REENABLE, REENABLE, WARN]
+    guard.on_reenable.assert_called_once()
+    guard.on_abort.assert_not_called()
+    assert not guard.aborted
+
+
+def test_guard_raises_once_aborted(mocker):
+    guard = mocked_guard(mocker, [[("subscription_1", 1200)]])
+    guard.on_abort = mocker.Mock()
+
+    with pytest.raises(WalRetentionExceeded):
+        guard()
+
+    guard.on_abort.assert_called_once()
+    assert guard.peak_level == ABORT
+
+
+def test_guard_metrics(mocker):
+    guard = mocked_guard(mocker, [[("subscription_1", 600)]])
+    guard.check()
+
+    text = format_prometheus(guard.metrics())
+
+    assert "pg_logical_replication_wal_guard_budget_bytes 1000" in text
+    assert 'pg_logical_replication_wal_guard_threshold_bytes{level="reenable"} 800' in text
+    assert 'pg_logical_replication_wal_guard_retained_bytes{slot="subscription_1"} 600' in text
+    assert "pg_logical_replication_wal_guard_level 1" in text